@@ -0,0 +1,364 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for tag_data.
+
+Each bench_xxx() function prints its results, run them from the command line :
+  python bench_tag_data.py
+  python bench_tag_data.py gtk    # also with a TagDataGadget open
+
+The suite times the main operations on a generated tree and catalogue and
+writes the results in a json file, to compare two runs (a regression is a
+time more than 'threshold' slower) :
+  python bench_tag_data.py suite [new.json] [width=10 depth=4 nb_photos=20000 ...]
+  python bench_tag_data.py compare old.json new.json [threshold]
+"""
+__docformat__ = "restructuredtext en"
+
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from tag_data import TagDataTree, TagXMLLoader, TagDataSearch
+
+# Run in a fresh interpreter : import the non-UI API and tell how long it took,
+# and whether gtk came with it.
+STARTUP_SCRIPT = """
+import sys, time
+start = time.time()
+import tag_data
+elapsed = time.time() - start
+print elapsed, ('gtk' in sys.modules)
+"""
+
+# sec ******************************************************************************
+def bench_startup(repeat=10):
+    """
+    Measure the time to import the non-UI API (TagDataTree, TagDataSearch),
+    each time in a new interpreter, so that nothing is already cached.
+
+    :Returns:
+    - (best import time, best whole process time) in seconds
+    """
+    print "*** bench_startup()"
+    here = os.path.dirname( os.path.abspath(__file__) )
+    import_times = []
+    process_times = []
+    for i in range(repeat):
+        start = time.time()
+        output = subprocess.check_output( [sys.executable, '-c', STARTUP_SCRIPT],
+                                          cwd=here )
+        process_times.append( time.time() - start )
+        elapsed, gtk_loaded = output.split()
+        import_times.append( float(elapsed) )
+        if gtk_loaded != 'False':
+            print "WARNING : importing tag_data also imported gtk"
+    print "import tag_data : best %.2f ms, mean %.2f ms" % (
+        1000.0 * min(import_times), 1000.0 * sum(import_times) / repeat)
+    print "whole process   : best %.2f ms, mean %.2f ms" % (
+        1000.0 * min(process_times), 1000.0 * sum(process_times) / repeat)
+    return min(import_times), min(process_times)
+
+def make_tags(nb_tags=None, width=20, depth=None):
+    """
+    :Returns:
+    - a TagDataTree where every tag has 'width' subtags, breadth first,
+      until there are 'nb_tags' tags or 'depth' levels (that is
+      width + width**2 + ... + width**depth tags), whichever comes first
+    """
+    tag_data = TagDataTree()
+    level = [None]
+    nb_levels = 0
+    while depth is None or nb_levels < depth:
+        next_level = []
+        for parent in level:
+            for i in range(width):
+                if nb_tags is not None and len(tag_data.tag_id) >= nb_tags:
+                    return tag_data
+                next_level.append(
+                    tag_data.add_check_unique( parent, 'tag%d' % len(tag_data.tag_id) ))
+        level = next_level
+        nb_levels += 1
+    return tag_data
+
+def make_catalogue(tag_data, nb_photos=20000, keywords_per_photo=5,
+                   vocabulary=2000, unknown=0.1, seed=0):
+    """
+    :Params:
+    - tag_data : the TagDataTree where keywords are taken
+    - vocabulary : number of different keywords used by the photos
+    - unknown : part of the vocabulary that is not a tag
+
+    :Returns:
+    - list of 'nb_photos' keyword lists, the same for the same 'seed'
+    """
+    generator = random.Random( seed )
+    tags = sorted( tag_data.tag_id )
+    nb_unknown = int( vocabulary * unknown )
+    words = generator.sample( tags, min(len(tags), vocabulary - nb_unknown) )
+    words.extend( ['unknown%d' % i for i in range(nb_unknown)] )
+    return [generator.sample( words, min(len(words), keywords_per_photo) )
+            for i in range(nb_photos)]
+
+def flush_events():
+    import gtk
+    while gtk.events_pending():
+        gtk.main_iteration( False )
+
+def bench_bulk(nb_tags=50000, lazy=False):
+    """
+    Load and select 'nb_tags' tags with a TagDataGadget open : row by row,
+    in a TagDataTree.bulk_edit (the view stays attached to the model) and
+    in a TagDataGadget.bulk_edit (the view is detached). Needs gtk and a
+    display.
+
+    :Returns:
+    - dictionary {(operation, mode) : seconds}
+    """
+    print "*** bench_bulk(%d tags, lazy=%s)" % (nb_tags, lazy)
+    import gtk
+    from tag_data_gtk import TagDataGadget
+    fd, xml_file_name = tempfile.mkstemp( suffix='.xml' )
+    os.close( fd )
+    make_tags( nb_tags ).write( xml_file_name )
+
+    def load_row_by_row(tag_data, gadget):
+        TagXMLLoader( tag_data ).parse_file( xml_file_name )
+    def load_tree_bulk(tag_data, gadget):
+        tag_data.load( xml_file_name )
+    def load_gadget_bulk(tag_data, gadget):
+        with gadget.bulk_edit():
+            tag_data.load( xml_file_name )
+    def select_row_by_row(tag_data, gadget):
+        for node in tag_data.tag_id.values():
+            tag_data.set_selected( node, True )
+    def select_tree_bulk(tag_data, gadget):
+        tag_data.select_all()
+    def select_gadget_bulk(tag_data, gadget):
+        with gadget.bulk_edit():
+            tag_data.select_all()
+    modes = [('row by row', load_row_by_row, select_row_by_row),
+             ('TagDataTree.bulk_edit', load_tree_bulk, select_tree_bulk),
+             ('TagDataGadget.bulk_edit', load_gadget_bulk, select_gadget_bulk)]
+    times = {}
+    try:
+        for mode, load, select in modes:
+            tag_data = TagDataTree()
+            window = gtk.Window( gtk.WINDOW_TOPLEVEL )
+            window.set_size_request( 200, 600 )
+            gadget = TagDataGadget( tag_data, lazy=lazy )
+            window.add( gadget )
+            window.show_all()
+            flush_events()
+            for operation, function in (('load', load), ('select', select)):
+                start = time.time()
+                function( tag_data, gadget )
+                flush_events()
+                times[(operation, mode)] = time.time() - start
+                print "%-6s %-24s : %8.3f s" % (operation, mode, times[(operation, mode)])
+            gadget.tag_mirror.detach()
+            window.destroy()
+            flush_events()
+    finally:
+        os.remove( xml_file_name )
+    return times
+
+# sec ************************************************************************ SUITE
+SUITE_PARAMS = {'width': 10, 'depth': 4, 'nb_photos': 20000,
+                'keywords_per_photo': 5, 'vocabulary': 2000, 'unknown': 0.1,
+                'nb_patterns': 3, 'repeat': 3, 'seed': 0}
+
+def time_calls(function, repeat, setup=None):
+    """
+    :Returns:
+    - the times of 'repeat' calls to function(), in seconds, each after
+      an untimed call to setup() if given
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        function()
+        times.append( time.time() - start )
+    return times
+
+def bench_suite(**params):
+    """
+    Time, 'repeat' times each, with a tree and a catalogue made with the
+    parameters of SUITE_PARAMS (overriden by 'params') :
+    - add_check_unique : making the tree
+    - write, load : the XML of the tree
+    - select_all, get_selected_tag_strpath, clean_selected : selection walks
+    - look_for : every keyword of the catalogue, with a new TagDataSearch
+    - is_matched_by : every photo of the catalogue
+    - is_matched_by_ids : the same, with the ids of the keywords
+
+    :Returns:
+    - dictionary {'params', 'python', 'platform', 'date',
+                  'results' : {name : {'best', 'mean', 'times'}}}
+    """
+    params = dict( SUITE_PARAMS, **params )
+    print "*** bench_suite(%s)" % ', '.join(
+        ['%s=%s' % (key, params[key]) for key in sorted(params)])
+    repeat = params['repeat']
+    results = {}
+    def timed(name, function, setup=None):
+        times = time_calls( function, repeat, setup )
+        results[name] = {'best': min(times), 'mean': sum(times) / len(times),
+                         'times': times}
+        print "%-26s : best %9.4f s, mean %9.4f s" % (
+            name, min(times), sum(times) / len(times))
+
+    trees = []
+    timed( 'add_check_unique',
+           lambda : trees.append( make_tags( width=params['width'],
+                                             depth=params['depth'] )))
+    tag_data = trees[-1]
+    catalogue = make_catalogue( tag_data, params['nb_photos'],
+                                params['keywords_per_photo'],
+                                params['vocabulary'], params['unknown'],
+                                params['seed'] )
+    fd, xml_file_name = tempfile.mkstemp( suffix='.xml' )
+    os.close( fd )
+    try:
+        timed( 'write', lambda : tag_data.write( xml_file_name ))
+        timed( 'load', lambda : TagDataTree().load( xml_file_name ))
+    finally:
+        os.remove( xml_file_name )
+
+    timed( 'select_all', tag_data.select_all, tag_data.clean_selected )
+    timed( 'get_selected_tag_strpath', tag_data.get_selected_tag_strpath )
+    timed( 'clean_selected', tag_data.clean_selected, tag_data.select_all )
+
+    # patterns : the first tags of the second level
+    patterns = []
+    for root in tag_data.get_children(None):
+        patterns.extend( [tag_data.strpath( node )
+                          for node in tag_data.get_children( root )[:1]] )
+    patterns = patterns[:params['nb_patterns']]
+    def look_for():
+        search = TagDataSearch( patterns, tag_data )
+        for keywords in catalogue:
+            for keyword in keywords:
+                search.look_for( keyword )
+    timed( 'look_for', look_for )
+    search = TagDataSearch( patterns, tag_data )
+    def is_matched_by():
+        for keywords in catalogue:
+            search.is_matched_by( keywords )
+    timed( 'is_matched_by', is_matched_by )
+    id_catalogue = [tag_data.ids( keywords ) for keywords in catalogue]
+    def is_matched_by_ids():
+        for ids in id_catalogue:
+            search.is_matched_by( ids )
+    timed( 'is_matched_by_ids', is_matched_by_ids )
+
+    return {'params': params, 'python': sys.version.split()[0],
+            'platform': platform.platform(), 'date': time.strftime( '%Y-%m-%d %H:%M:%S' ),
+            'results': results}
+
+def write_results(run, filename):
+    """
+    Export a run of bench_suite to a json file.
+    """
+    results_file = open( filename, 'w' )
+    try:
+        json.dump( run, results_file, indent=2, sort_keys=True )
+    finally:
+        results_file.close()
+def read_results(filename):
+    results_file = open( filename )
+    try:
+        return json.load( results_file )
+    finally:
+        results_file.close()
+
+# below, the difference is noise
+MIN_DIFFERENCE = 0.001
+def compare_results(old_run, new_run, threshold=0.2):
+    """
+    Print, for each benchmark of both runs, the best times and their ratio.
+    The runs should have been made with the same params.
+
+    :Returns:
+    - list of the names of the benchmarks more than 'threshold' slower
+      (0.2 is 20%) in 'new_run', and by more than MIN_DIFFERENCE seconds
+    """
+    print "*** compare_results(threshold=%d%%)" % (100 * threshold)
+    if old_run['params'] != new_run['params']:
+        print "WARNING : the runs have different params"
+        for key in sorted( set(old_run['params']) | set(new_run['params']) ):
+            if old_run['params'].get( key ) != new_run['params'].get( key ):
+                print "  %s : %s -> %s" % (key, old_run['params'].get( key ),
+                                           new_run['params'].get( key ))
+    regressions = []
+    old_results, new_results = old_run['results'], new_run['results']
+    for name in sorted( set(old_results) & set(new_results) ):
+        old_time, new_time = old_results[name]['best'], new_results[name]['best']
+        ratio = new_time / max( old_time, 1e-9 )
+        flag = ''
+        if abs(new_time - old_time) < MIN_DIFFERENCE:
+            pass
+        elif ratio > 1.0 + threshold:
+            flag = 'REGRESSION'
+            regressions.append( name )
+        elif ratio < 1.0 - threshold:
+            flag = 'faster'
+        print "%-26s : %9.4f s -> %9.4f s  x%5.2f  %s" % (name, old_time, new_time,
+                                                         ratio, flag)
+    for name in sorted( set(old_results) ^ set(new_results) ):
+        print "%-26s : only in one run" % name
+    return regressions
+
+# sec ************************************************************************* MAIN
+def parse_params(args):
+    """
+    :Returns:
+    - (dictionary of the 'key=value' in 'args', with the type of SUITE_PARAMS,
+       the other argument as the name of the results file, None if none)
+    """
+    params = {}
+    filename = None
+    for arg in args:
+        if '=' not in arg:
+            if filename is not None:
+                raise ValueError( 'more than one results file: '+filename+', '+arg )
+            filename = arg
+            continue
+        key, value = arg.split( '=', 1 )
+        if key not in SUITE_PARAMS:
+            raise ValueError( 'unknown param: '+key )
+        params[key] = type(SUITE_PARAMS[key])( value )
+    return params, filename
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        params, filename = parse_params( sys.argv[2:] )
+        run = bench_suite( **params )
+        if filename is not None:
+            write_results( run, filename )
+    elif len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        threshold = 0.2
+        if len(sys.argv) > 4:
+            threshold = float( sys.argv[4] )
+        regressions = compare_results( read_results( sys.argv[2] ),
+                                       read_results( sys.argv[3] ), threshold )
+        sys.exit( 1 if regressions else 0 )
+    else:
+        bench_startup()
+        if len(sys.argv) > 1 and sys.argv[1] == 'gtk':
+            bench_bulk( lazy=False )
+            bench_bulk( lazy=True )
+
+
+# sec ************************************************************************** END
+
+# Local Variables:
+# coding:utf-8
+# End:
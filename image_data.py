@@ -0,0 +1,727 @@
+# image_data.py
+# -*- coding: utf-8 -*-
+"""
+Store information about images and their tags (keywords), and read these
+keywords from the metadata of the image files.
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import re
+import json
+import struct
+import sys
+import heapq
+import multiprocessing
+from xml.sax.saxutils import unescape
+from array import array
+from bisect import bisect_left, insort
+
+from tag_data import TagDataTree, TagSearchCache, TagData_FormatWarning, write_atomic, \
+    _ascii_or_unicode, _json_tag
+
+# Binary index : header, image names then keywords separated by '\0' (each
+# padded to 4 bytes), then int32 arrays, little endian, of the length of the
+# posting of each keyword and of all the postings one after the other.
+INDEX_MAGIC = 'PYXIIMGS'
+INDEX_VERSION = 1
+# magic, version, flags, nb of images, size of names, nb of keywords, size of keywords
+INDEX_HEADER = struct.Struct( '<8sHHIIII' )
+
+# Scan cache : a header line, then one json line per image
+# [path, mtime, size, keywords or null if unreadable]
+SCAN_MAGIC = 'PYXISCAN'
+SCAN_VERSION = 1
+
+# **********************************************************************************
+# ******************************************************************** ImageTagIndex
+# **********************************************************************************
+class ImageTagIndex(object):
+    """
+    Inverted index of images by keyword, beside a TagDataTree.
+
+    'self.images' is the list of image names, an image is known by its index.
+    Removed images are None.
+    'self.image_id' is a dictionary {image : index}
+    'self.keywords' is the list of the keywords, a keyword is known by its
+    index (its keyword id), and 'self.keyword_id' is a dictionary
+    {keyword : keyword id}. Keyword ids are never reused.
+    'self.image_keywords' is the list of the keyword ids of each image, as
+    arrays.
+    'self.postings' is the list, by keyword id, of the sorted arrays of the
+    indexes of the images with this keyword.
+
+    Keywords are kept as they are in the images, so that they survive a
+    rename in the TagDataTree and may be unknown to it : their ids are not
+    the ones of the tree, tag_ids gives those. Queries on a tag and its
+    subtags (images_under) resolve them through the tree, and merge the
+    postings of the subtree. Merged postings are cached until the tree or the
+    index change.
+    """
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, tag_data, filename=None, cache_size=1000):
+        """
+        :Params:
+        - tag_data : the TagDataTree of the keywords
+        - filename : index to load, if any
+        """
+        self.tag_data = tag_data
+        self.images = []
+        self.image_id = {}
+        self.keywords = []
+        self.keyword_id = {}
+        self.image_keywords = []
+        self.postings = []
+        # incremented by every change, with tag_data.revision for the cache
+        self.revision = 0
+        self.merged = TagSearchCache( cache_size )
+        # id in the tree of each keyword id, at 'tree_ids_revision'
+        self.tree_ids = None
+        self.tree_ids_revision = None
+
+        self.filename = filename
+        if self.filename != None:
+            self.load( self.filename )
+
+    # sec ----------------------------------------------------------------- keywords
+    def intern(self, keyword):
+        """
+        :Return:
+        - the keyword id of 'keyword', given to it if new
+        """
+        keyword_id = self.keyword_id.get( keyword )
+        if keyword_id is None:
+            if isinstance(keyword, str):
+                keyword = intern( keyword )
+            keyword_id = len(self.keywords)
+            self.keywords.append( keyword )
+            self.keyword_id[keyword] = keyword_id
+            self.postings.append( array('i') )
+        return keyword_id
+    def intern_all(self, keywords):
+        """
+        :Return:
+        - sorted array of the keyword ids of 'keywords', without duplicates
+        """
+        return array( 'i', sorted( set( [self.intern( keyword ) for keyword in keywords] )))
+    def tag_ids(self, image):
+        """
+        :Return:
+        - list of the ids in the TagDataTree (see TagDataTree.ids) of the
+          keywords of 'image', None for the ones that are not tags
+        """
+        if self.tree_ids_revision != (self.tag_data.revision, len(self.keywords)):
+            self.tree_ids = self.tag_data.ids( self.keywords )
+            self.tree_ids_revision = (self.tag_data.revision, len(self.keywords))
+        tree_ids = self.tree_ids
+        return [tree_ids[keyword_id]
+                for keyword_id in self.image_keywords[self.image_id[image]]]
+
+    # sec -------------------------------------------------------- add/remove/update
+    def add_image(self, image, keywords):
+        """
+        Add (or update) 'image' with its list of 'keywords'.
+
+        :Returns:
+        - index of the image
+        """
+        index = self.image_id.get( image )
+        if index is not None:
+            self.update_image( image, keywords )
+            return index
+        index = len(self.images)
+        self.images.append( image )
+        self.image_id[image] = index
+        keyword_ids = self.intern_all( keywords )
+        self.image_keywords.append( keyword_ids )
+        for keyword_id in keyword_ids:
+            # new images have the greatest index
+            self.postings[keyword_id].append( index )
+        self.revision += 1
+        return index
+    def update_image(self, image, keywords):
+        """
+        Change the keywords of an image already in the index.
+        """
+        index = self.image_id[image]
+        old_keyword_ids = set( self.image_keywords[index] )
+        keyword_ids = self.intern_all( keywords )
+        for keyword_id in old_keyword_ids - set(keyword_ids):
+            self.remove_posting( keyword_id, index )
+        for keyword_id in set(keyword_ids) - old_keyword_ids:
+            insort( self.postings[keyword_id], index )
+        self.image_keywords[index] = keyword_ids
+        self.revision += 1
+    def remove_image(self, image):
+        """
+        Remove 'image' from the index.
+        """
+        index = self.image_id.pop( image )
+        for keyword_id in self.image_keywords[index]:
+            self.remove_posting( keyword_id, index )
+        self.images[index] = None
+        self.image_keywords[index] = array( 'i' )
+        self.revision += 1
+    def remove_posting(self, keyword_id, index):
+        posting = self.postings[keyword_id]
+        del posting[bisect_left( posting, index )]
+
+    def is_in(self, image):
+        return image in self.image_id
+    def get_keywords(self, image):
+        keywords = self.keywords
+        return [keywords[keyword_id]
+                for keyword_id in self.image_keywords[self.image_id[image]]]
+    def __len__(self):
+        return len(self.image_id)
+
+    # sec ------------------------------------------------------------------ queries
+    def images_with(self, keyword):
+        """
+        :Return:
+        - sorted array of the indexes of the images with exactly 'keyword'.
+          Must not be modified.
+        """
+        keyword_id = self.keyword_id.get( keyword )
+        if keyword_id is None:
+            return array( 'i' )
+        return self.postings[keyword_id]
+    def images_under(self, pattern):
+        """
+        Images with the tag of 'pattern' (a tag or a strpath .X.Y.tag) or one
+        of its subtags, by merging the postings of the subtree.
+        Costs the size of the result (and of the subtree), not the number
+        of images.
+
+        :Return:
+        - sorted array of the indexes of the images. Must not be modified.
+        """
+        revision = (self.tag_data.revision, self.revision)
+        merged = self.merged.get( pattern, revision )
+        if merged is not None:
+            return merged
+        node = self.tag_data.pattern_node( pattern )
+        if node is None:
+            merged = array( 'i' )
+        else:
+            tag_nodes = self.tag_data.tag_nodes
+            postings = []
+            for sub_node in self.tag_data.hierarchy_index().subtree( node ):
+                keyword_id = self.keyword_id.get( tag_nodes[sub_node].tag )
+                if keyword_id is not None and len(self.postings[keyword_id]) > 0:
+                    postings.append( self.postings[keyword_id] )
+            if len(postings) == 1:
+                merged = postings[0]
+            else:
+                merged = array( 'i' )
+                last = -1
+                for index in heapq.merge( *postings ):
+                    if index != last:
+                        merged.append( index )
+                        last = index
+        self.merged.put( pattern, merged )
+        return merged
+    def count_under(self, pattern):
+        """
+        :Return:
+        - number of images under 'pattern' (see images_under)
+        """
+        return len(self.images_under( pattern ))
+    def image_names(self, indexes):
+        """
+        :Return:
+        - list of the names of the images of 'indexes'
+        """
+        return [self.images[index] for index in indexes]
+
+    # sec ---------------------------------------------------------------------- I/O
+    def write(self, index_file_name):
+        """
+        Write the index in its binary format (see INDEX_HEADER), atomically.
+        """
+        images = '\0'.join( [_to_utf8( image or '' ) for image in self.images] )
+        keywords = sorted( [keyword for keyword, posting in zip(self.keywords, self.postings)
+                            if len(posting) > 0] )
+        postings = [self.postings[self.keyword_id[keyword]] for keyword in keywords]
+        lengths = array( 'i', [len(posting) for posting in postings] )
+        all_postings = array( 'i' )
+        for posting in postings:
+            all_postings.extend( posting )
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            all_postings.byteswap()
+        keywords = '\0'.join( [_to_utf8( keyword ) for keyword in keywords] )
+        header = INDEX_HEADER.pack( INDEX_MAGIC, INDEX_VERSION, 0,
+                                    len(self.images), len(images),
+                                    len(lengths), len(keywords) )
+        write_atomic( index_file_name, [header,
+                                        images, '\0' * (-len(images) % 4),
+                                        keywords, '\0' * (-len(keywords) % 4),
+                                        lengths.tostring(), all_postings.tostring()] )
+        self.filename = index_file_name
+    def load(self, index_file_name):
+        """
+        Replace the content of the index by the one of 'index_file_name'.
+
+        :Throws:
+        - TagData_FormatWarning if not an index of INDEX_VERSION
+        """
+        index_file = open( index_file_name, 'rb' )
+        try:
+            data = index_file.read()
+        finally:
+            index_file.close()
+        if len(data) < INDEX_HEADER.size:
+            raise TagData_FormatWarning( index_file_name+' is not an image index' )
+        (magic, version, flags, nb_images, images_size,
+         nb_keywords, keywords_size) = INDEX_HEADER.unpack_from( data )
+        if magic != INDEX_MAGIC:
+            raise TagData_FormatWarning( index_file_name+' is not an image index' )
+        if version != INDEX_VERSION:
+            raise TagData_FormatWarning( '%s is an image index of version %d, not %d'
+                                         % (index_file_name, version, INDEX_VERSION) )
+        offset = INDEX_HEADER.size
+        images = [_ascii_or_unicode( image ) or None
+                  for image in data[offset:offset+images_size].split('\0')]
+        offset += images_size + (-images_size % 4)
+        keywords = [_ascii_or_unicode( keyword )
+                    for keyword in data[offset:offset+keywords_size].split('\0')]
+        offset += keywords_size + (-keywords_size % 4)
+        lengths = array( 'i' )
+        lengths.fromstring( data[offset:offset+4*nb_keywords] )
+        offset += 4 * nb_keywords
+        all_postings = array( 'i' )
+        all_postings.fromstring( data[offset:] )
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            all_postings.byteswap()
+        if nb_images == 0:
+            images = []
+        if nb_keywords == 0:
+            keywords = []
+        if len(images) != nb_images or len(keywords) != nb_keywords or \
+                len(all_postings) != sum(lengths):
+            raise TagData_FormatWarning( index_file_name+' is truncated' )
+
+        self.images = images
+        self.image_id = dict( [(image, index) for index, image in enumerate(images)
+                               if image is not None] )
+        image_keywords = [array( 'i' ) for image in images]
+        self.keywords = []
+        self.keyword_id = {}
+        self.postings = []
+        offset = 0
+        for keyword, length in zip(keywords, lengths):
+            keyword_id = self.intern( keyword )
+            posting = all_postings[offset:offset+length]
+            offset += length
+            self.postings[keyword_id] = posting
+            for index in posting:
+                image_keywords[index].append( keyword_id )
+        self.image_keywords = image_keywords
+        self.tree_ids_revision = None
+        self.revision += 1
+        self.filename = index_file_name
+# **********************************************************************************
+
+# sec ******************************************************************************
+def _to_utf8(name):
+    if isinstance(name, unicode):
+        return name.encode( 'utf-8' )
+    return name
+
+# sec ******************************************************************************
+# JPEG markers and APPn signatures holding keywords
+JPEG_SOI = '\xff\xd8'
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+JPEG_APP1 = 0xE1
+JPEG_APP13 = 0xED
+EXIF_SIGNATURE = 'Exif\0\0'
+XMP_SIGNATURE = 'http://ns.adobe.com/xap/1.0/\0'
+PHOTOSHOP_SIGNATURE = 'Photoshop 3.0\0'
+# EXIF tag of Windows keywords (UTF-16LE, separated by ';')
+EXIF_XPKEYWORDS = 0x9C9E
+# Photoshop resource of IPTC-IIM data, and IPTC record:dataset of keywords
+PHOTOSHOP_IPTC = 0x0404
+IPTC_KEYWORDS = (2, 25)
+XMP_SUBJECT = re.compile( r'<dc:subject>(.*?)</dc:subject>', re.S )
+XMP_LI = re.compile( r'<rdf:li[^>]*>(.*?)</rdf:li>', re.S )
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.jpe')
+
+def read_keywords(image_file_name):
+    """
+    Read the keywords of a JPEG image from its XMP (dc:subject), IPTC
+    (2:25 Keywords) and EXIF (XPKeywords) metadata. Only the APP1 and APP13
+    segments before the image data are read, the others are skipped.
+
+    :Returns:
+    - list of keywords, without duplicates, void if not a JPEG image
+    """
+    keywords = []
+    image_file = open( image_file_name, 'rb' )
+    try:
+        if image_file.read(2) != JPEG_SOI:
+            return keywords
+        while True:
+            marker = image_file.read(2)
+            if len(marker) < 2 or marker[0] != '\xff':
+                break
+            marker = ord(marker[1])
+            if marker == JPEG_SOS or marker == JPEG_EOI:
+                break
+            if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                # no length for these markers
+                continue
+            length = image_file.read(2)
+            if len(length) < 2:
+                break
+            length = struct.unpack( '>H', length )[0] - 2
+            if marker == JPEG_APP1 or marker == JPEG_APP13:
+                segment = image_file.read( length )
+                if marker == JPEG_APP13:
+                    keywords.extend( _iptc_keywords(segment) )
+                elif segment.startswith( XMP_SIGNATURE ):
+                    keywords.extend( _xmp_keywords(segment[len(XMP_SIGNATURE):]) )
+                elif segment.startswith( EXIF_SIGNATURE ):
+                    keywords.extend( _exif_keywords(segment[len(EXIF_SIGNATURE):]) )
+            else:
+                image_file.seek( length, os.SEEK_CUR )
+    finally:
+        image_file.close()
+    # without duplicates, in order
+    seen = set()
+    return [keyword for keyword in keywords
+            if keyword not in seen and not seen.add( keyword )]
+
+def _keyword(text):
+    """
+    :Return:
+    - 'text' (unicode) as str if ascii, as ElementTree does
+    """
+    return _json_tag( text.strip() )
+def _xmp_keywords(xmp):
+    keywords = []
+    for subject in XMP_SUBJECT.findall( xmp ):
+        for keyword in XMP_LI.findall( subject ):
+            keyword = unescape( keyword, {'&quot;' : '"', '&apos;' : "'"} )
+            keywords.append( _keyword(keyword.decode( 'utf-8', 'replace' )) )
+    return keywords
+def _iptc_keywords(segment):
+    if not segment.startswith( PHOTOSHOP_SIGNATURE ):
+        return []
+    keywords = []
+    offset = len(PHOTOSHOP_SIGNATURE)
+    # Photoshop image resources : '8BIM', id, pascal name (even), size, data (even)
+    while segment[offset:offset+4] == '8BIM':
+        resource_id = struct.unpack_from( '>H', segment, offset+4 )[0]
+        name_length = ord(segment[offset+6])
+        offset += 6 + name_length + 1 + ((name_length + 1) % 2)
+        size = struct.unpack_from( '>I', segment, offset )[0]
+        offset += 4
+        if resource_id == PHOTOSHOP_IPTC:
+            keywords.extend( _iim_keywords(segment[offset:offset+size]) )
+        offset += size + (size % 2)
+    return keywords
+def _iim_keywords(iim):
+    keywords = []
+    offset = 0
+    # datasets : 0x1C, record, dataset, size (short form only), data
+    while offset + 5 <= len(iim) and iim[offset] == '\x1c':
+        record, dataset, size = struct.unpack_from( '>BBH', iim, offset+1 )
+        if size & 0x8000:
+            break
+        offset += 5
+        if (record, dataset) == IPTC_KEYWORDS:
+            data = iim[offset:offset+size]
+            try:
+                keyword = data.decode( 'utf-8' )
+            except UnicodeError:
+                keyword = data.decode( 'latin-1' )
+            keywords.append( _keyword(keyword) )
+        offset += size
+    return keywords
+def _exif_keywords(tiff):
+    if tiff[:2] == 'II':
+        order = '<'
+    elif tiff[:2] == 'MM':
+        order = '>'
+    else:
+        return []
+    # only IFD0 holds XPKeywords
+    ifd = struct.unpack_from( order+'I', tiff, 4 )[0]
+    if ifd + 2 > len(tiff):
+        return []
+    nb_entries = struct.unpack_from( order+'H', tiff, ifd )[0]
+    for entry in range(nb_entries):
+        offset = ifd + 2 + 12 * entry
+        if offset + 12 > len(tiff):
+            break
+        tag, value_type, count = struct.unpack_from( order+'HHI', tiff, offset )
+        if tag == EXIF_XPKEYWORDS:
+            if count > 4:
+                offset = struct.unpack_from( order+'I', tiff, offset+8 )[0]
+            else:
+                offset += 8
+            text = tiff[offset:offset+count].decode( 'utf-16-le', 'replace' )
+            return [_keyword(keyword) for keyword in text.rstrip(u'\0').split(u';')
+                    if keyword.strip()]
+    return []
+
+def _read_keywords_of(image_file_name):
+    """
+    For the process pool of scan_keywords.
+
+    :Returns:
+    - (image_file_name, keywords), keywords being None if the image could
+      not be read.
+    """
+    try:
+        return image_file_name, read_keywords( image_file_name )
+    except (IOError, OSError, struct.error, IndexError):
+        return image_file_name, None
+
+def iter_images(root, extensions=IMAGE_EXTENSIONS):
+    """
+    Generate the paths of the image files under the directory 'root'.
+    """
+    for directory, subdirectories, files in os.walk( root ):
+        subdirectories.sort()
+        for name in sorted(files):
+            if os.path.splitext( name )[1].lower() in extensions:
+                yield os.path.join( directory, name )
+
+def scan_keywords(root, processes=None, chunk_size=256):
+    """
+    Read the keywords of all the images under 'root' with a pool of
+    'processes' processes (as many as CPUs by default, 1 for no pool).
+    Results come in no particular order, as soon as they are read.
+
+    :Returns:
+    - generator of lists of at most 'chunk_size' (image, keywords),
+      keywords being None for unreadable images.
+    """
+    return _map_keywords( iter_images( root ), processes, chunk_size )
+
+def _map_keywords(images, processes=None, chunk_size=256):
+    """
+    Read the keywords of the 'images', see scan_keywords.
+    """
+    pool = None
+    if processes == 1:
+        results = (_read_keywords_of( image ) for image in images)
+    else:
+        pool = multiprocessing.Pool( processes )
+        results = pool.imap_unordered( _read_keywords_of, images,
+                                       max(1, chunk_size // 4) )
+    try:
+        chunk = []
+        for result in results:
+            chunk.append( result )
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        if pool is not None:
+            # also when the caller stops early
+            pool.terminate()
+            pool.join()
+
+# **********************************************************************************
+# ******************************************************************** ImageScanCache
+# **********************************************************************************
+class ImageScanCache(object):
+    """
+    Keywords read from the images, with the mtime and size of the image
+    files when read, so that a rescan only reads new or changed images.
+
+    'self.entries' is a dictionary {path : (mtime, size, keywords)},
+    keywords being None for an unreadable image.
+
+    The cache is written atomically, at the end of a rescan and every
+    'checkpoint' images read : an interrupted rescan only loses the
+    images read since the last checkpoint.
+    """
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, filename=None):
+        """
+        :Params:
+        - filename : cache file, loaded if it exists
+        """
+        self.entries = {}
+        self.filename = filename
+        if self.filename != None and os.path.exists( self.filename ):
+            self.load( self.filename )
+
+    def __len__(self):
+        return len(self.entries)
+    def get_keywords(self, path):
+        """
+        :Returns:
+        - keywords of 'path', None if unknown or unreadable.
+        """
+        entry = self.entries.get( path )
+        if entry is None:
+            return None
+        return entry[2]
+
+    # sec ------------------------------------------------------------------- rescan
+    def rescan(self, root, index=None, processes=None, chunk_size=256,
+               checkpoint=10000):
+        """
+        Update the cache with the images under 'root' : read the new images
+        and the ones whose mtime or size changed, forget the deleted ones.
+        If given, the ImageTagIndex 'index' gets the same changes (and the
+        images of the cache it does not know yet).
+
+        :Returns:
+        - a dictionary with the number of images skipped (unchanged), reread
+          (new or changed), failed (unreadable among reread) and removed.
+        """
+        stats = {'skipped' : 0, 'reread' : 0, 'failed' : 0, 'removed' : 0}
+        to_read = {}
+        seen = set()
+        for path in iter_images( root ):
+            try:
+                info = os.stat( path )
+            except OSError:
+                continue
+            seen.add( path )
+            entry = self.entries.get( path )
+            if entry is not None and entry[0] == info.st_mtime \
+                    and entry[1] == info.st_size:
+                stats['skipped'] += 1
+                if index is not None and entry[2] and not index.is_in( path ):
+                    index.add_image( path, entry[2] )
+            else:
+                to_read[path] = (info.st_mtime, info.st_size)
+
+        # deleted images : known under 'root' but not seen
+        prefix = os.path.join( root, '' )
+        for path in [path for path in self.entries
+                     if path.startswith( prefix ) and path not in seen]:
+            del self.entries[path]
+            stats['removed'] += 1
+            if index is not None and index.is_in( path ):
+                index.remove_image( path )
+
+        since_checkpoint = 0
+        for chunk in _map_keywords( sorted(to_read), processes, chunk_size ):
+            for path, keywords in chunk:
+                mtime, size = to_read[path]
+                self.entries[path] = (mtime, size, keywords)
+                stats['reread'] += 1
+                if keywords is None:
+                    stats['failed'] += 1
+                if index is not None:
+                    if keywords:
+                        index.add_image( path, keywords )
+                    elif index.is_in( path ):
+                        index.remove_image( path )
+            since_checkpoint += len(chunk)
+            if self.filename != None and since_checkpoint >= checkpoint:
+                self.write( self.filename )
+                since_checkpoint = 0
+        if self.filename != None and (stats['reread'] or stats['removed']):
+            self.write( self.filename )
+        return stats
+
+    # sec ---------------------------------------------------------------------- I/O
+    def iter_lines(self):
+        """
+        Generate the lines of the cache file, images in order.
+        Images whose path is not utf-8 are not kept, they will be read again.
+        """
+        yield '%s %d\n' % (SCAN_MAGIC, SCAN_VERSION)
+        for path in sorted(self.entries):
+            mtime, size, keywords = self.entries[path]
+            try:
+                yield json.dumps( [_ascii_or_unicode( path ), mtime, size, keywords] ) + '\n'
+            except UnicodeError:
+                continue
+    def write(self, cache_file_name):
+        """
+        Write the cache, atomically.
+        """
+        write_atomic( cache_file_name, self.iter_lines() )
+        self.filename = cache_file_name
+    def load(self, cache_file_name):
+        """
+        Replace the content of the cache by the one of 'cache_file_name'.
+
+        :Throws:
+        - TagData_FormatWarning if not a scan cache of SCAN_VERSION
+        """
+        cache_file = open( cache_file_name, 'rb' )
+        try:
+            header = cache_file.readline().split()
+            if len(header) != 2 or header[0] != SCAN_MAGIC:
+                raise TagData_FormatWarning( cache_file_name+' is not a scan cache' )
+            if header[1] != str(SCAN_VERSION):
+                raise TagData_FormatWarning( '%s is a scan cache of version %s, not %d'
+                                             % (cache_file_name, header[1], SCAN_VERSION) )
+            entries = {}
+            for line in cache_file:
+                path, mtime, size, keywords = json.loads( line )
+                if keywords is not None:
+                    keywords = [_keyword( keyword ) for keyword in keywords]
+                entries[_to_utf8( path )] = (mtime, size, keywords)
+        finally:
+            cache_file.close()
+        self.entries = entries
+        self.filename = cache_file_name
+# **********************************************************************************
+
+# sec ******************************************************************************
+def test_index():
+    print "*** test_index()"
+    data = TagDataTree()
+    data.build_example()
+    index = ImageTagIndex( data )
+    index.add_image( "bob_lac.jpg", ['Bob', 'Lac'] )
+    index.add_image( "montagne.jpg", ['Montagne'] )
+    index.add_image( "famille.jpg", ['Bob', 'Marcel', 'Louise'] )
+    index.add_image( "inconnu.jpg", ['Inconnu'] )
+    for pattern in ['Gens', '.Nature', 'Bob', '.Nature.Lac', 'Inconnu']:
+        print pattern, " : ", index.image_names( index.images_under(pattern) )
+    index.remove_image( "bob_lac.jpg" )
+    index.update_image( "montagne.jpg", ['Montagne', 'Marcel'] )
+    print "Gens : ", index.image_names( index.images_under('Gens') )
+
+def test_scan(root='.'):
+    print "*** test_scan()"
+    data = TagDataTree()
+    data.build_example()
+    index = ImageTagIndex( data )
+    for chunk in scan_keywords( root ):
+        for image, keywords in chunk:
+            if keywords:
+                index.add_image( image, keywords )
+    print len(index), "images with keywords"
+
+def test_rescan(root='.', cache_file_name='scan_cache.json'):
+    print "*** test_rescan()"
+    data = TagDataTree()
+    data.build_example()
+    index = ImageTagIndex( data )
+    cache = ImageScanCache( cache_file_name )
+    print "first  : ", cache.rescan( root, index )
+    print "second : ", cache.rescan( root, index )
+    print len(index), "images with keywords"
+
+# sec ************************************************************************* MAIN
+if __name__ == "__main__":
+    test_index()
+    if len(sys.argv) > 1:
+        test_scan( sys.argv[1] )
+        test_rescan( sys.argv[1] )
+
+
+# sec ************************************************************************** END
+
+# Local Variables:
+# coding:utf-8
+# End:
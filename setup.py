@@ -2,7 +2,7 @@ from distutils.core import setup
 
 setup( name='pyxitag',
        version='0.01',
-       py_modules=['tag_data'],
+       py_modules=['tag_data', 'tag_data_gtk', 'image_data'],
        author='Alain Dutech',
        author_email='snowgoon88@gmail.com',
        url='http://nothing.yet.org',
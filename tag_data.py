@@ -2,12 +2,222 @@
 # -*- coding: utf-8 -*-
 """
 Store information about tags
+
+No GTK here : the user interface (TagDataGadget, TagDataApplication, TagGLADE)
+is in tag_data_gtk, so gtk is only imported when a UI is used.
 """
 __docformat__ = "restructuredtext en"
 
-import gtk
 import xml.etree.ElementTree as ET
+from xml.parsers import expat
+from xml.sax.saxutils import escape
 import os
+import re
+import sys
+import tempfile
+import shutil
+import time
+import json
+import struct
+import mmap
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+from itertools import izip, islice
+from collections import OrderedDict, Mapping
+from heapq import nlargest
+from contextlib import contextmanager
+
+# Binary snapshot : header, tags separated by '\0' (padded to 4 bytes), then
+# int32 arrays, little endian, of the parent and of the end of the subtree
+# (see TagHierarchyIndex) of each node, nodes being numbered in preorder.
+SNAPSHOT_MAGIC = 'PYXISNAP'
+SNAPSHOT_VERSION = 1
+# magic, version, flags, nb of nodes (with root), size of the tags
+SNAPSHOT_HEADER = struct.Struct( '<8sHHII' )
+
+# sec ******************************************************************************
+def write_atomic(filename, chunks, buffer_size=1024*1024):
+    """
+    Write the str 'chunks' in a temporary file, next to 'filename', then
+    rename it as 'filename' : 'filename' is either the old file or the
+    complete new one, never a partly written one.
+    """
+    directory, basename = os.path.split( os.path.abspath(filename) )
+    tmp_fd, tmp_name = tempfile.mkstemp( prefix=basename+'.', suffix='.tmp',
+                                         dir=directory )
+    try:
+        tmp_file = os.fdopen( tmp_fd, 'wb', buffer_size )
+        try:
+            for chunk in chunks:
+                tmp_file.write( chunk )
+            tmp_file.flush()
+            os.fsync( tmp_file.fileno() )
+        finally:
+            tmp_file.close()
+        if os.path.exists( filename ):
+            os.chmod( tmp_name, os.stat(filename).st_mode & 0o7777 )
+        else:
+            os.chmod( tmp_name, 0o644 )
+        if os.name == 'nt' and os.path.exists( filename ):
+            # no atomic replace on Windows with python 2
+            os.remove( filename )
+        os.rename( tmp_name, filename )
+    except:
+        if os.path.exists( tmp_name ):
+            os.remove( tmp_name )
+        raise
+
+def _ascii_or_unicode(name):
+    try:
+        name.decode( 'ascii' )
+        return name
+    except UnicodeError:
+        return name.decode( 'utf-8' )
+
+def _trigrams(key):
+    # with a space before, so that the start counts more
+    key = u' ' + key
+    return set( [key[index:index+3] for index in xrange(len(key) - 2)] )
+def _prefix_distance(query, key, max_distance):
+    """
+    :Return:
+    - the edit distance between 'query' and the closest prefix of 'key',
+      max_distance + 1 if more than max_distance
+    """
+    # row[j] : distance between the query so far and key[:j]
+    row = range( len(key) + 1 )
+    for i, char in enumerate(query):
+        new_row = [i + 1]
+        for j in xrange(len(key)):
+            new_row.append( min( row[j+1] + 1, new_row[j] + 1,
+                                 row[j] + (char != key[j]) ))
+        row = new_row
+        if min(row) > max_distance:
+            return max_distance + 1
+    return min(row)
+
+def _json_tag(value):
+    # json gives unicode, keep ascii tags as str
+    if isinstance(value, unicode):
+        try:
+            return value.encode( 'ascii' )
+        except UnicodeError:
+            pass
+    return value
+
+def fold(text):
+    """
+    :Return:
+    - 'text' (str in utf-8, or unicode) as lower case unicode without accents,
+      for searching
+    """
+    if not isinstance(text, unicode):
+        text = text.decode( 'utf-8', 'replace' )
+    text = unicodedata.normalize( 'NFKD', text.lower() )
+    return u''.join( [char for char in text if not unicodedata.combining( char )] )
+
+def is_snapshot(filename):
+    """
+    :Return:
+    - True if 'filename' starts as a binary snapshot (else it should be XML)
+    """
+    tag_file = open( filename, 'rb' )
+    try:
+        return tag_file.read( len(SNAPSHOT_MAGIC) ) == SNAPSHOT_MAGIC
+    finally:
+        tag_file.close()
+
+def journal_name(db_file_name, generation):
+    return '%s.journal.%d' % (db_file_name, generation)
+def journal_generations(db_file_name):
+    """
+    :Return:
+    - the sorted generations of the journal files of 'db_file_name' (see
+      TagDataJournal)
+    """
+    directory, basename = os.path.split( os.path.abspath(db_file_name) )
+    prefix = basename + '.journal.'
+    generations = []
+    for name in os.listdir( directory ):
+        if name.startswith( prefix ) and name[len(prefix):].isdigit():
+            generations.append( int(name[len(prefix):]) )
+    return sorted(generations)
+
+def write_outside_journal(db_file_name, generation, iter_xml):
+    """
+    Write the chunks of iter_xml( generation ) as 'db_file_name', by
+    write_atomic. The journals of 'db_file_name' left, if any, do not fit the
+    new XML : it gets a generation past theirs, so that they are not replayed
+    on it even after a crash, and they are removed.
+    """
+    generations = journal_generations( db_file_name )
+    if generations:
+        generation = max( generation, generations[-1] + 1 )
+    write_atomic( db_file_name, iter_xml( generation ) )
+    for old_generation in generations:
+        os.remove( journal_name( db_file_name, old_generation ) )
+
+def xml_to_snapshot(xml_file_name, snapshot_file_name):
+    """
+    Convert a XML file of tags to a binary snapshot.
+    """
+    TagDataTree( xml_file_name ).write_snapshot( snapshot_file_name )
+
+def snapshot_to_xml(snapshot_file_name, xml_file_name):
+    """
+    Convert a binary snapshot of tags to a XML file.
+    """
+    tag_data = TagDataTree()
+    tag_data.load_snapshot( snapshot_file_name )
+    tag_data.write( xml_file_name )
+
+# **********************************************************************************
+# ************************************************************************** TagNode
+# **********************************************************************************
+class TagNode(object):
+    """
+    A node of TagDataTree. Nodes are stored in 'TagDataTree.tag_nodes' and
+    refer to each other by index:
+    - tag : string
+    - selected : boolean
+    - editable : boolean
+    - parent : index of the parent node (-1 for the root)
+    - children : list of indexes of the children nodes
+    """
+    __slots__ = ('tag', 'selected', 'editable', 'parent', 'children')
+    def __init__(self, tag, parent, selected=False, editable=True):
+        self.tag = tag
+        self.selected = selected
+        self.editable = editable
+        self.parent = parent
+        self.children = []
+# **********************************************************************************
+
+# **********************************************************************************
+# ********************************************************************** TagStrpaths
+# **********************************************************************************
+class TagStrpaths(Mapping):
+    """
+    The 'tag_set' of a TagDataTree : a read-only dictionary {tag : .X.Y.tag}
+    of the tags of 'tag_id', whose strpaths are not stored but made from the
+    parents of the node when asked. A rename or a move costs nothing, and
+    the names of the ancestors are not copied in every strpath.
+    """
+    def __init__(self, tag_data):
+        self.tag_data = tag_data
+    def __getitem__(self, tag):
+        return self.tag_data.strpath( self.tag_data.tag_id[tag] )
+    def __contains__(self, tag):
+        return tag in self.tag_data.tag_id
+    def __iter__(self):
+        return iter(self.tag_data.tag_id)
+    def __len__(self):
+        return len(self.tag_data.tag_id)
+    def __repr__(self):
+        return repr( dict(self.iteritems()) )
+# **********************************************************************************
 
 # **********************************************************************************
 # ********************************************************************** TagDataTree
@@ -23,41 +233,91 @@ class TagDataTree(object):
 
     Through 'self.to_save', the tags are monitored for change since last load or write.
 
-    'self.tag_treestore' is a gtk.Tree representation of the data
-    'self.tag_set' is a dictionary {tag : .X.Y.tag}
-    'self.tag_element' is an ElementTree version of the tags (XML struct)
+    'self.tag_nodes' is the list of TagNode, a node is known by its index.
+    The node 0 is an invisible root, 'None' can be used instead of it.
+    'self.tag_id' is a dictionary {tag : index of node} : the index is the
+    id of the tag, a dense int, to use instead of the tag in searches (see
+    ids), and the strpaths follow the parents.
+    'self.tag_set' is a read-only dictionary {tag : .X.Y.tag} (a TagStrpaths)
+    'self.selected_nodes' is the set of the selected nodes, kept with the
+    'selected' of the TagNode, so that the selection costs what is selected.
+    'self.tag_element' is an ElementTree version of the tags (XML struct), only
+    built on demand by to_element
+    'self.observers' are told about every change (see add_observer), this is how
+    a gtk.TreeStore can mirror the tags when a UI is attached.
+    'self.revision' is incremented by every change of the tags or of their
+    hierarchy, it tells when 'self.hierarchy' (a TagHierarchyIndex) is outdated.
+    'self.probe' is an optional TagDataProbe, told about every loaded tag.
+    'self.journal' is the TagDataJournal of the tags, if any, and
+    'self.generation' the number of compactions of this journal the file
+    includes (saved in the XML).
+
+    Threads : one thread changes the tags (the writer, e.g. the gtk one),
+    holding 'self.lock' for each change and for a whole bulk_edit. Other
+    threads read a version() : an immutable copy, published again when the
+    tags have changed. Copies share the TagNode with the tree, 'self.shared'
+    is the list of the last copy, and a shared TagNode is copied before
+    being changed (see writable).
+    'self.edits' counts the changes of the selected and editable flags,
+    which do not change 'self.revision'.
     """
+    ROOT = 0
+    # more changes of the selection at once are done as a bulk_edit
+    BULK_SIZE = 1000
     # sec --------------------------------------------------------------------- init
-    def __init__(self, filename = None):
+    def __init__(self, filename = None, probe = None, publish = True):
         """
         Create void data structure and populate it.
+
+        :Params:
+        - publish : False for a copy, which is its own version (see version)
         """
-        # Build up the data structure as a gtk.TreeStore with 3 column
-        self.tag_treestore = gtk.TreeStore(str, 'gboolean', 'gboolean')
+        # Build up the data structure as a list of TagNode, with an invisible root
+        self.tag_nodes = [TagNode(None, -1, False, False)]
         # self.build_default()
         # Create an 'ElementTree' version.
         self.tag_element = None
         # Create the set of tags (for ensuring unicity of tags)
-        self.tag_set = {}
+        self.tag_id = {}
+        self.tag_set = TagStrpaths( self )
+        self.selected_nodes = set()
         # To monitor changes
         self.to_save = False
+        self.observers = []
+        self.bulk_depth = 0
+        self.bulk_observers = None
+        self.revision = 0
+        self.hierarchy = None
+        self.probe = probe
+        self.journal = None
+        self.generation = 0
+        # for the threads
+        self.lock = threading.RLock()
+        self.shared = None
+        self.published = None
+        self.edits = 0
 
         self.filename = filename
         if self.filename != None:
-            self.load( self.filename )
+            if is_snapshot( self.filename ):
+                self.load_snapshot( self.filename )
+            else:
+                self.load( self.filename )
+        elif publish:
+            self.publish()
         
     def build_default(self):
         """
-        Populate self.tag_treestore with default values. Only for test.
+        Populate self.tag_nodes with default values. Only for test.
         """
-        gens_node = self.tag_treestore.append(None, ("Gens", False, False))
-        self.tag_treestore.append(gens_node, ("Bob", False, False))
-        self.tag_treestore.append(gens_node, ("Marcel", False, False))
-        self.tag_treestore.append(gens_node, ("Louise", False, False))
-        nature_node = self.tag_treestore.append(None, ("Nature", False, False))
-        self.tag_treestore.append(nature_node, ("Foret", False, False))
-        self.tag_treestore.append(nature_node, ("Lac", False, False))
-        self.tag_treestore.append(nature_node, ("Montagne", False, False))
+        gens_node = self.append_node(None, "Gens", False, False)
+        self.append_node(gens_node, "Bob", False, False)
+        self.append_node(gens_node, "Marcel", False, False)
+        self.append_node(gens_node, "Louise", False, False)
+        nature_node = self.append_node(None, "Nature", False, False)
+        self.append_node(nature_node, "Foret", False, False)
+        self.append_node(nature_node, "Lac", False, False)
+        self.append_node(nature_node, "Montagne", False, False)
 
         self.to_save = True
     def build_example(self):
@@ -66,167 +326,675 @@ class TagDataTree(object):
         """
         try:
             gens_node = self.add_check_unique(None, "Gens")
-            self.tag_treestore.set( gens_node, 1, True )
+            self.set_selected( gens_node, True )
             bob_node = self.add_check_unique(gens_node, "Bob")
-            #self.tag_treestore.set( bob_node, 1, True )
+            #self.set_selected( bob_node, True )
             self.add_check_unique(gens_node, "Marcel")
             self.add_check_unique(gens_node, "Louise")
             nature_node = self.add_check_unique(None, "Nature")
             self.add_check_unique(nature_node, "Foret")
             self.add_check_unique(nature_node, "Lac")
             montagne_node = self.add_check_unique(nature_node, "Montagne")
-            self.tag_treestore.set( montagne_node, 1, True )
+            self.set_selected( montagne_node, True )
         except TagData_UnicityWarning as e:
             print "@@@",e.__class__.__name__, e
             print self.dump_str()
 
+    # sec ---------------------------------------------------------------- observers
+    def add_observer(self, observer):
+        """
+        'observer' will be told about every change through
+        - observer.on_tag_added( node )
+        - observer.on_tag_changed( node )
+        - observer.on_tag_moving( node ) : before the subtree is moved, only
+          if the observer has this method
+        - observer.on_tag_moved( node ) : after the subtree is moved
+        - observer.on_tag_removed( node ) : before the subtree is freed
+        - observer.on_tags_reset() : at the end of a bulk_edit, instead of
+          all the above, the observer must rebuild from the tree
+        """
+        self.observers.append( observer )
+    def remove_observer(self, observer):
+        if self.bulk_observers is not None and observer in self.bulk_observers:
+            self.bulk_observers.remove( observer )
+        else:
+            self.observers.remove( observer )
+
+    @contextmanager
+    def bulk_edit(self):
+        """
+        Context manager for many changes at once :
+          with tag_data.bulk_edit():
+              ...
+        The observers are not told about each change, they are told once
+        by on_tags_reset() at the end of the outermost bulk_edit.
+        The lock is held all along : the readers get the version() from
+        before until the end.
+        """
+        self.lock.acquire()
+        self.bulk_depth += 1
+        if self.bulk_depth == 1:
+            self.bulk_observers = self.observers
+            self.observers = []
+        try:
+            yield self
+        finally:
+            self.bulk_depth -= 1
+            try:
+                if self.bulk_depth == 0:
+                    self.edits += 1
+                    # with the ones added meanwhile
+                    self.observers = self.bulk_observers + self.observers
+                    self.bulk_observers = None
+                    # an observer may stop observing on reset
+                    for observer in list(self.observers):
+                        observer.on_tags_reset()
+            finally:
+                self.lock.release()
+
     # sec ---------------------------------------------------------------------- I/O
     def write(self, db_file_name):
         """
         Ecrit dans un fichier au format XML.
-        """
-        self.to_element()
-        tree = ET.ElementTree( self.tag_element )
-        tree.write(db_file_name)
+        The XML is generated by iter_xml straight from the tree, and written
+        with write_atomic : a crash while saving leaves the file as it was.
+        With a journal on 'db_file_name', the journal is compacted instead,
+        else its journals left are dropped (see write_outside_journal).
+        """
+        if self.journal is not None and self.journal.db_file_name == db_file_name:
+            self.journal.compact( background=False )
+            self.to_save = False
+            return
+        if self.probe is not None:
+            start = time.time()
+        write_outside_journal( db_file_name, self.generation, self.iter_xml )
+        if self.probe is not None:
+            self.probe.add_time( 'write', time.time() - start )
 
         self.filename = db_file_name
         self.to_save = False
+    def iter_xml(self, generation=None):
+        """
+        Generate the XML version of the tree, as utf-8 str chunks, by an
+        iterative walk of the tree, with 'generation' (self.generation by
+        default) as the generation of its journals.
+        """
+        if generation is None:
+            generation = self.generation
+        if generation:
+            yield "<?xml version='1.0' encoding='utf-8'?>\n<root generation='%d'>" \
+                % generation
+        else:
+            yield "<?xml version='1.0' encoding='utf-8'?>\n<root>"
+        # one iterator on children for each open tag
+        stack = [iter( self.get_children(None) )]
+        while stack:
+            for node in stack[-1]:
+                tag_node = self.tag_nodes[node]
+                tag = tag_node.tag
+                if isinstance(tag, unicode):
+                    tag = tag.encode( 'utf-8' )
+                if tag_node.children:
+                    yield '<tag>' + escape( tag )
+                    stack.append( iter(tag_node.children) )
+                    break
+                yield '<tag>' + escape( tag ) + '</tag>'
+            else:
+                stack.pop()
+                if stack:
+                    yield '</tag>'
+        yield '</root>\n'
+
+    def write_snapshot(self, snapshot_file_name):
+        """
+        Write the tags in the binary snapshot format (see SNAPSHOT_HEADER),
+        with the TagHierarchyIndex, so that loading needs no check and no walk.
+        """
+        index = self.hierarchy_index()
+        tag_nodes = self.tag_nodes
+        names = []
+        parents = array( 'i', [-1] )
+        for node in index.order[1:]:
+            tag_node = tag_nodes[node]
+            tag = tag_node.tag
+            if isinstance(tag, unicode):
+                tag = tag.encode( 'utf-8' )
+            names.append( tag )
+            parents.append( index.first[tag_node.parent] )
+        last = array( 'i', [index.last[node] for node in index.order] )
+        if sys.byteorder == 'big':
+            parents.byteswap()
+            last.byteswap()
+        names = '\0'.join( names )
+        header = SNAPSHOT_HEADER.pack( SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0,
+                                       len(index.order), len(names) )
+        write_atomic( snapshot_file_name, [header, names, '\0' * (-len(names) % 4),
+                                           parents.tostring(), last.tostring()] )
+    def load_snapshot(self, snapshot_file_name, use_mmap=False):
+        """
+        Replace the tags by those of a binary snapshot, read at once (or
+        mapped in memory with 'use_mmap'). Tags are not checked one by one,
+        their TagHierarchyIndex comes with the snapshot.
+
+        :Throws:
+        - TagData_FormatWarning if not a snapshot, or not of SNAPSHOT_VERSION
+        """
+        self.filename = snapshot_file_name
+        snapshot_file = open( snapshot_file_name, 'rb' )
+        try:
+            if use_mmap:
+                data = mmap.mmap( snapshot_file.fileno(), 0, access=mmap.ACCESS_READ )
+            else:
+                data = snapshot_file.read()
+        finally:
+            snapshot_file.close()
+        try:
+            if len(data) < SNAPSHOT_HEADER.size:
+                raise TagData_FormatWarning( snapshot_file_name+' is not a snapshot' )
+            magic, version, flags, nb_nodes, names_size = SNAPSHOT_HEADER.unpack_from( data )
+            if magic != SNAPSHOT_MAGIC:
+                raise TagData_FormatWarning( snapshot_file_name+' is not a snapshot' )
+            if version != SNAPSHOT_VERSION:
+                raise TagData_FormatWarning( '%s is a snapshot of version %d, not %d'
+                                             % (snapshot_file_name, version,
+                                                SNAPSHOT_VERSION) )
+            offset = SNAPSHOT_HEADER.size
+            names = data[offset:offset+names_size]
+            offset += names_size + (-names_size % 4)
+            parents = array( 'i' )
+            parents.fromstring( data[offset:offset+4*nb_nodes] )
+            offset += 4 * nb_nodes
+            last = array( 'i' )
+            last.fromstring( data[offset:offset+4*nb_nodes] )
+        finally:
+            if use_mmap:
+                data.close()
+        if sys.byteorder == 'big':
+            parents.byteswap()
+            last.byteswap()
+        parents = parents.tolist()
+        # as ElementTree, keep ascii tags as str
+        try:
+            names.decode( 'ascii' )
+            names = [intern( name ) for name in names.split( '\0' )]
+        except UnicodeError:
+            names = [_ascii_or_unicode( name ) for name in names.split( '\0' )]
+        if nb_nodes == 1:
+            names = []
+        if len(names) != nb_nodes - 1 or len(last) != nb_nodes:
+            raise TagData_FormatWarning( snapshot_file_name+' is truncated' )
+
+        # observers rebuild from the new tags at once
+        with self.bulk_edit():
+            self.clear()
+            tag_nodes = [TagNode(None, -1, False, False)]
+            tag_nodes.extend( [TagNode(name, parent, False, True)
+                               for name, parent in izip(names, parents[1:])] )
+            for node in xrange(1, nb_nodes):
+                tag_nodes[parents[node]].children.append( node )
+            self.tag_id = dict( izip(names, xrange(1, nb_nodes)) )
+            if len(self.tag_id) != nb_nodes - 1:
+                self.tag_id = {}
+                raise TagData_FormatWarning( snapshot_file_name+' has duplicated tags' )
+            self.tag_nodes = tag_nodes
+            self.revision += 1
+            self.hierarchy = TagHierarchyIndex.from_preorder( self.revision, last.tolist() )
+            self.generation = 0
+        self.to_save = False
+        self.publish()
     
     def load(self, db_file_name):
         """
         Lit dans un fichier au format XML.
+        The file is streamed through a TagXMLLoader : nodes are added as the
+        XML elements arrive, without building the whole document in memory.
+
+        :Throws:
+        - TagData_UnicityWarning, with the line and column of the duplicate
         """
         self.filename = db_file_name
-        tree = ET.parse( db_file_name)
-        self.element_to_tagnode( tree.getroot(), None)
+        if self.probe is not None:
+            start = time.time()
+        with self.bulk_edit():
+            loader = TagXMLLoader( self )
+            loader.parse_file( db_file_name )
+            self.generation = loader.generation
+            if self.journal is not None and self.journal.db_file_name == db_file_name:
+                self.journal.reload()
+        if self.probe is not None:
+            self.probe.add_time( 'load', time.time() - start )
     
         self.to_save = False
+        self.publish()
+
+    def copy(self):
+        """
+        :Return:
+        - a TagDataTree with the same tags, selection and filename, but no
+          observer : a snapshot that a worker thread can write while this
+          one is changed. The TagNode are shared, and copied by the tree
+          that changes them (see writable), so a copy costs the number of
+          tags, not their size.
+        """
+        with self.lock:
+            shared = list(self.tag_nodes)
+            self.shared = shared
+            tag_data = TagDataTree( publish=False )
+            tag_data.published = tag_data
+            tag_data.tag_nodes = list(shared)
+            tag_data.shared = shared
+            tag_data.tag_id = dict(self.tag_id)
+            tag_data.selected_nodes = set(self.selected_nodes)
+            tag_data.revision = self.revision
+            tag_data.edits = self.edits
+            # never changed once built
+            tag_data.hierarchy = self.hierarchy
+            tag_data.filename = self.filename
+            tag_data.to_save = self.to_save
+            tag_data.generation = self.generation
+        return tag_data
+    def version(self):
+        """
+        :Return:
+        - the last published copy of the tags, published again first if the
+          tags have changed. It must not be changed, and any thread can read
+          it, for example with TagDataSearch( ..., pin=True ).
+          A reader never waits for the writer : while a change or a
+          bulk_edit runs, it gets the version from before : there is one
+          from the start (see publish).
+        """
+        version = self.published
+        if version.revision == self.revision and version.edits == self.edits:
+            return version
+        if not self.lock.acquire( False ):
+            return version
+        try:
+            # the writer itself, in a bulk_edit
+            if self.bulk_depth > 0:
+                return version
+            self.publish()
+            return self.published
+        finally:
+            self.lock.release()
+    def publish(self):
+        """
+        Make a copy of the tags as they are the version given to the readers.
+        Done on creation and after each load or replace_by, so that version()
+        never waits.
+        """
+        self.published = self.copy()
+    def writable(self, node):
+        """
+        :Return:
+        - the TagNode of 'node', to be changed : first copied if it is
+          shared with a copy of the tree.
+        """
+        tag_node = self.tag_nodes[node]
+        shared = self.shared
+        if shared is not None and node < len(shared) and shared[node] is tag_node:
+            tag_node = TagNode( tag_node.tag, tag_node.parent,
+                                tag_node.selected, tag_node.editable )
+            tag_node.children = list(shared[node].children)
+            self.tag_nodes[node] = tag_node
+        return tag_node
+    def replace_by(self, tag_data):
+        """
+        Take the tags of 'tag_data' (a TagDataTree, for example loaded by a
+        worker thread), which must not be used any more. The observers are
+        told by on_tags_reset(). Tags of the file of the journal get its
+        changes replayed.
+        """
+        with self.bulk_edit():
+            self.tag_nodes = tag_data.tag_nodes
+            # still shared with the copies of 'tag_data', if any
+            self.shared = tag_data.shared
+            self.tag_id = tag_data.tag_id
+            self.selected_nodes = tag_data.selected_nodes
+            self.tag_element = None
+            self.revision = max( self.revision, tag_data.revision ) + 1
+            self.hierarchy = None
+            self.generation = tag_data.generation
+            # before on_tags_reset(), for a journal of another file
+            self.filename = tag_data.filename
+            self.to_save = tag_data.to_save
+            if self.journal is not None and self.journal.db_file_name == self.filename:
+                self.journal.reload()
+        self.publish()
 
     # sec ---------------------------------------------------------------------- str
     def __str__(self):
-        return self.str_treestore(self.tag_treestore.iter_children(None), "", 0)
+        return "".join( self.iter_lines() )
     def display_str(self):
-        return self.str_treestore(self.tag_treestore.iter_children(None), "", 0)
+        return "".join( self.iter_lines() )
     def dump_str(self):
-        dump_str = self.str_treestore(self.tag_treestore.iter_children(None), "", 0,1,2)
-        dump_str += "\n" + str(self.tag_set)
-        dump_str += "\nTo be saved : " + str(self.to_save)
-        return dump_str
+        return "".join( self.iter_dump() )
+    def iter_dump(self):
+        """
+        Generate the pieces of dump_str : the tree with all the columns, then
+        tag_set as a dict, then to_save.
+        """
+        for line in self.iter_lines( columns=(0, 1, 2) ):
+            yield line
+        yield "\n{"
+        separator = ""
+        for tag, strpath in self.tag_set.iteritems():
+            yield separator + repr(tag) + ": " + repr(strpath)
+            separator = ", "
+        yield "}"
+        yield "\nTo be saved : " + str(self.to_save)
+    def write_dump(self, out=None, lines=None):
+        """
+        Write 'lines' (iter_dump() by default) to the file 'out' (sys.stdout
+        by default) as they are made.
+        """
+        if out is None:
+            out = sys.stdout
+        if lines is None:
+            lines = self.iter_dump()
+        for line in lines:
+            if isinstance(line, unicode):
+                line = line.encode( 'utf-8' )
+            out.write( line )
+    def dump_page(self, page, page_size=100, columns=(0,), max_depth=None):
+        """
+        :Return:
+        - the lines number page*page_size to (page+1)*page_size of iter_lines
+        """
+        return "".join( islice( self.iter_lines( columns=columns, max_depth=max_depth ),
+                                page * page_size, (page+1) * page_size ))
 #     def affiche(self):
 #         """
-#         Print the entire treestore.
+#         Print the entire tree.
 #         """
-#         print self.str_treestore(self.tag_treestore.iter_children(None), "", 0, 1)
+#         print self.str_treestore(self.get_children(None), "", 0, 1)
+
+    COLUMNS = ('tag', 'selected', 'editable')
+    def str_treestore(self, nodes, indent="", *args ): 
+        """
+        Print a list of nodes and all their sub-nodes.
+        'args' are the columns to print : 0=tag, 1=selected, 2=editable.
+        """
+        return "".join( self.iter_lines( nodes, args, indent ))
+    def iter_lines(self, nodes=None, columns=(0,), indent="", max_depth=None):
+        """
+        Generate, in preorder and without recursion, one line for each node
+        of 'nodes' (the top level tags by default) and of their sub-nodes.
+
+        :Params:
+        - columns : to print, 0=tag, 1=selected, 2=editable
+        - indent : of the first level, then two more spaces for each level
+        - max_depth : levels printed, None for all. The sub-nodes below are
+          only counted, on a '...' line.
+        """
+        if nodes is None:
+            nodes = self.get_children(None)
+        names = [self.COLUMNS[col] for col in columns]
+        stack = [(node, 0) for node in reversed(nodes)]
+        while stack:
+            node, depth = stack.pop()
+            tag_node = self.tag_nodes[node]
+            values = tuple([getattr(tag_node, name) for name in names])
+            yield indent + "  " * depth + str(values) + "\n"
+            if not tag_node.children:
+                continue
+            if max_depth is not None and depth + 1 >= max_depth:
+                yield "%s  ... %d subtags\n" % (indent + "  " * depth,
+                                                self.count_subtags( node ))
+            else:
+                stack.extend( [(child, depth + 1) for child in reversed(tag_node.children)] )
+    def count_subtags(self, node):
+        """
+        :Return:
+        - the number of nodes below 'node'
+        """
+        count = 0
+        stack = list(self.tag_nodes[node].children)
+        while stack:
+            count += 1
+            stack.extend( self.tag_nodes[stack.pop()].children )
+        return count
 
-    def str_treestore(self, iter, indent="", *args ): 
+    # sec ------------------------------------------------------------------- access
+    def has_node(self, node):
+        """
+        :Return:
+        - True if 'node' is the index of a node still in the tree
+        """
+        return 0 < node < len(self.tag_nodes) and self.tag_nodes[node] is not None
+    def find_node(self, tag):
         """
-        Print an element of self.tag_treestore and all its sub-nodes.
+        :Return:
+        - index of the node of 'tag', None if not in the tree
+        """
+        return self.tag_id.get(tag)
+    def get_tag(self, node):
+        return self.tag_nodes[node].tag
+    def get_parent(self, node):
+        """
+        :Return:
+        - index of the parent node, TagDataTree.ROOT for top level tags.
+        """
+        return self.tag_nodes[node].parent
+    def get_children(self, node):
         """
-        ret_str = ""
-        while iter:
-            ret_str = ret_str + indent + str(self.tag_treestore.get(iter, *args )) + "\n"
-            ret_str += self.str_treestore(self.tag_treestore.iter_children(iter),
-                                   indent+"  ", *args)
-            iter = self.tag_treestore.iter_next(iter)
-        return ret_str
+        :Return:
+        - list of the indexes of the children of 'node' (None for root).
+          Must not be modified.
+        """
+        if node is None:
+            node = self.ROOT
+        return self.tag_nodes[node].children
+    def is_selected(self, node):
+        return self.tag_nodes[node].selected
+    def set_selected(self, node, status):
+        with self.lock:
+            self.writable( node ).selected = status
+            if status:
+                self.selected_nodes.add( node )
+            else:
+                self.selected_nodes.discard( node )
+            self.edits += 1
+            for observer in self.observers:
+                observer.on_tag_changed( node )
+    def is_editable(self, node):
+        return self.tag_nodes[node].editable
+    def set_editable(self, node, status):
+        with self.lock:
+            self.writable( node ).editable = status
+            self.edits += 1
+            for observer in self.observers:
+                observer.on_tag_changed( node )
 
     # sec -------------------------------------------------------- add/remove/update
-    def add_check_unique(self, iter, tag):
+    def append_node(self, node, tag, selected=False, editable=True, position=None):
         """
-        Add 'tag' to 'tag_set' and the treestore if not existing.
+        Create a new TagNode under 'node', without any check on 'tag'.
+
+        :Params:
+        - node : index of the parent node, None for root
+        - tag : tag of the new node
+        - position : among the children of 'node', None for last
+
+        :Returns:
+        - index of the new node
+        """
+        with self.lock:
+            if node is None:
+                node = self.ROOT
+            index = len(self.tag_nodes)
+            self.tag_nodes.append( TagNode(tag, node, selected, editable) )
+            if selected:
+                self.selected_nodes.add( index )
+            children = self.writable( node ).children
+            if position is None:
+                children.append( index )
+            else:
+                children.insert( position, index )
+            self.revision += 1
+            for observer in self.observers:
+                observer.on_tag_added( index )
+            return index
+
+    def add_check_unique(self, node, tag, position=None):
+        """
+        Add 'tag' to 'tag_set' and the tree if not existing.
         
         :Params:
-        - path : where to add the tag in the TagTree
+        - node : where to add the tag in the TagTree (None for root)
         - tag : tag to be added
+        - position : among the children of 'node', None for last
 
         :Returns:
-        - iter to the added tag
+        - index of the added node
 
         :Throws:
         - TagData_UnicityWarning( 'tag: '+tag+' already in TagDataTree')
         """
-        # if exists -> raise Exception
-        if( tag in self.tag_set.keys()):
-            raise TagData_UnicityWarning( 'tag: '+tag+' already in TagDataTree')
-
-        #iter = None
-        #if( path is not None ):
-        #    iter = self.tag_treestore.get_iter( path )
-        iter_added =  self.tag_treestore.append(iter, ( tag, False, True))
-        path_added = self.tag_treestore.get_path(iter_added) 
-        # add it to the tagtree
-        self.tag_set[tag] = self.strpath_from_path(path_added)
-        self.to_save = True
-        return iter_added
-    def add_sibling_check_unique(self, iter, tag):
+        with self.lock:
+            # if exists -> raise Exception
+            if( tag in self.tag_set ):
+                raise TagData_UnicityWarning( 'tag: '+tag+' already in TagDataTree')
+
+            node_added = self.append_node(node, tag, False, True, position)
+            # add it to the tagtree
+            self.tag_id[tag] = node_added
+            self.to_save = True
+            return node_added
+    def add_sibling_check_unique(self, node, tag):
         """
-        Add 'tag' to 'tag_set' and 'treestore', as a sibling of 'iter'
+        Add 'tag' to 'tag_set' and the tree, as a sibling of 'node'
         if not exist already.
 
         :Params:
-        - iter : where is the sibling in the TagTree
+        - node : where is the sibling in the TagTree
         - tag : tag to be added
 
         :Returns:
-        - iter to the added tag
+        - index of the added node
 
         :Throws:
         - TagData_UnicityWarning( 'tag: '+tag+' already in TagDataTree')
         """
-        # if exists -> raise Exception
-        if( tag in self.tag_set.keys()):
-            raise TagData_UnicityWarning( 'tag: '+tag+' already in TagDataTree')
-        
-        # iter of parent
-        iter_parent = self.tag_treestore.iter_parent( iter )
-        # add as a sibling
-        iter_added = self.tag_treestore.insert_after( iter_parent, iter, 
-                                                      (tag, False, True))
-        path_added = self.tag_treestore.get_path(iter_added) 
-        # add it to the tagtree
-        self.tag_set[tag] = self.strpath_from_path(path_added)
-        self.to_save = True
-        return iter_added        
+        with self.lock:
+            # if exists -> raise Exception
+            if( tag in self.tag_set ):
+                raise TagData_UnicityWarning( 'tag: '+tag+' already in TagDataTree')
+
+            # node of parent
+            parent = self.tag_nodes[node].parent
+            # add as a sibling
+            position = self.tag_nodes[parent].children.index( node ) + 1
+            node_added = self.append_node(parent, tag, False, True, position)
+            # add it to the tagtree
+            self.tag_id[tag] = node_added
+            self.to_save = True
+            return node_added
 
-    def update_check_unique(self, iter, new_tag):
+    def update_check_unique(self, node, new_tag):
         """
-        Update 'tag_set' and the treestore with the 'new_tag' if not existing.
+        Update 'tag_set' and the tree with the 'new_tag' if not existing.
         
         :Params:
-        - iter : where to add the tag in the TagTree
+        - node : the node to update in the TagTree
         - new_tag : new value for tag
 
         :Throws:
         - TagData_UnicityWarning( 'tag: '+tag+' already in TagDataTree')
         """
-        
-        tmp_changed = self.to_save # will be modified by remove
-        old_tag = self.tag_treestore.get_value(iter, 0)
-        #self.tag_set.remove( old_tag )
-        old_strpath = self.tag_set.pop( old_tag )
-        
-        # if exists -> raise Exception
-        if( new_tag in self.tag_set.keys()):
-            self.tag_set[old_tag] = old_strpath
-            # back to old setting
-            self.to_save = tmp_changed
-            raise TagData_UnicityWarning( 'tag: '+new_tag+' already in TagDataTree')
-
-        self.tag_treestore.set_value(iter, 0, new_tag)
-        strpath = self.strpath_from_path( self.tag_treestore.get_path(iter) )
-        self.tag_set[new_tag] = strpath
-        self.to_save = True
+        with self.lock:
+            old_tag = self.tag_nodes[node].tag
+            # if exists (but not as itself) -> raise Exception
+            if( new_tag in self.tag_id and new_tag != old_tag ):
+                raise TagData_UnicityWarning( 'tag: '+new_tag+' already in TagDataTree')
 
-    def remove(self, iter):
+            del self.tag_id[old_tag]
+            self.writable( node ).tag = new_tag
+            self.tag_id[new_tag] = node
+            self.to_save = True
+            self.revision += 1
+            for observer in self.observers:
+                observer.on_tag_changed( node )
+
+    def move(self, node, parent, position=None):
         """
-        Remove the tag from 'tag_set' and the treestore.
+        Move 'node', and its subtags, under 'parent'.
         
         :Params:
-        - iter : where to remove the tag in the TagTree
-        """
-        self.tag_set.pop( self.tag_treestore.get_value( iter, 0))
-        self.tag_treestore.remove(iter)
-        self.to_save = True
+        - node : the node to move
+        - parent : the new parent node, None for root
+        - position : before the child of 'parent' currently at 'position',
+                     None for last
+
+        :Throws:
+        - TagData_HierarchyWarning if 'parent' is 'node' or one of its subtags
+        """
+        with self.lock:
+            if parent is None:
+                parent = self.ROOT
+            ancestor = parent
+            while ancestor != self.ROOT:
+                if ancestor == node:
+                    raise TagData_HierarchyWarning( 'tag: '+self.tag_nodes[node].tag+
+                                                    ' cannot be moved under itself')
+                ancestor = self.tag_nodes[ancestor].parent
+
+            for observer in self.observers:
+                if hasattr(observer, 'on_tag_moving'):
+                    observer.on_tag_moving( node )
+            tag_node = self.writable( node )
+            old_children = self.writable( tag_node.parent ).children
+            old_position = old_children.index( node )
+            del old_children[old_position]
+            children = self.writable( parent ).children
+            if position is None:
+                children.append( node )
+            else:
+                if tag_node.parent == parent and old_position < position:
+                    position -= 1
+                children.insert( position, node )
+            tag_node.parent = parent
+            self.to_save = True
+            self.revision += 1
+            for observer in self.observers:
+                observer.on_tag_moved( node )
+
+    def remove(self, node):
+        """
+        Remove the tag and its subtags from 'tag_set' and the tree.
+        
+        :Params:
+        - node : where to remove the tag in the TagTree
+        """
+        with self.lock:
+            for observer in self.observers:
+                observer.on_tag_removed( node )
+            self.writable( self.tag_nodes[node].parent ).children.remove( node )
+            # free the whole subtree
+            stack = [node]
+            while stack:
+                index = stack.pop()
+                tag_node = self.tag_nodes[index]
+                stack.extend( tag_node.children )
+                self.tag_id.pop( tag_node.tag, None )
+                self.selected_nodes.discard( index )
+                self.tag_nodes[index] = None
+            self.to_save = True
+            self.revision += 1
+
+    def clear(self):
+        """
+        Remove all the tags.
+        """
+        with self.lock:
+            for node in list(self.get_children(None)):
+                for observer in self.observers:
+                    observer.on_tag_removed( node )
+            self.tag_nodes = [TagNode(None, -1, False, False)]
+            self.shared = None
+            self.tag_id = {}
+            self.selected_nodes = set()
+            self.to_save = True
+            self.revision += 1
 
     def is_in(self, tag):
         """
@@ -238,128 +1006,920 @@ class TagDataTree(object):
     # sec ---------------------------------------------------------------- selection
     def get_selected_tag(self):
         """
-        Return the list of selected tags
+        Return the list of selected tags, in the order their nodes were
+        added. Costs the number of selected tags.
         """
-        return self.rec_selected_tag(self.tag_treestore.iter_children(None), [])
-    def rec_selected_tag(self,iter,selecgted):
+        return [self.tag_nodes[node].tag for node in sorted(self.selected_nodes)]
+    def get_selected_tag_strpath(self):
         """
-        For a given 'iter' of treestore nodes, populate list of 'selected' and
-        call same function on subnodes.
+        Return the list of selected tags as strpath, as get_selected_tag.
         """
-        while iter:
-            if self.tag_treestore.get_value( iter, 1) == True:
-                selected.append(self.tag_treestore.get_value( iter, 0))
-            selected = self.rec_selected_tag( self.tag_treestore.iter_children(iter),
-                                              selected)
-            iter = self.tag_treestore.iter_next(iter)
-        return selected
+        return [self.strpath( node ) for node in sorted(self.selected_nodes)]
 
-    def get_selected_tag_strpath(self):
+    def clean_selected(self):
         """
-        Return the list of selected tags as strpath
+        Unselect all tags. Costs the number of tags selected before.
         """
-        return self.rec_selected_tag_strpath(self.tag_treestore.iter_children(None), [])
-    def rec_selected_tag_strpath(self,iter,selected):
+        self.set_selected_nodes( sorted(self.selected_nodes), False )
+    def select_all(self):
         """
-        For a given 'iter' of treestore nodes, populate list of 'selected' and
-        call same function on subnodes.
+        Select all tags.
+        """
+        self.set_selected_nodes( [node for node, tag_node in enumerate(self.tag_nodes)
+                                  if node != self.ROOT and tag_node is not None
+                                  and not tag_node.selected], True )
+    def select_subtree(self, node, status=True):
+        """
+        Select (or unselect with 'status' False) 'node' and all its subtags.
+        """
+        nodes = []
+        stack = [node]
+        while stack:
+            index = stack.pop()
+            tag_node = self.tag_nodes[index]
+            if tag_node.selected != status:
+                nodes.append( index )
+            stack.extend( reversed(tag_node.children) )
+        self.set_selected_nodes( nodes, status )
+    def set_selected_nodes(self, nodes, status):
+        """
+        Set the selection of all the 'nodes', as a bulk_edit if there are
+        more than BULK_SIZE.
+        """
+        if len(nodes) <= self.BULK_SIZE:
+            for node in nodes:
+                self.set_selected( node, status )
+            return
+        with self.bulk_edit():
+            for node in nodes:
+                self.writable( node ).selected = status
+            if status:
+                self.selected_nodes.update( nodes )
+            else:
+                self.selected_nodes.difference_update( nodes )
+
+    # sec ------------------------------------------------------------------ strpath
+    def strpath(self, node):
+        """
+        From a node, build a str .X.Y.Tags by following the parents.
+        
+        :Return:
+        A str full path (.X.Y.Tags) of the tag of node.
+        """
+        names = []
+        while node != self.ROOT:
+            tag_node = self.tag_nodes[node]
+            names.append( '.' + tag_node.tag )
+            node = tag_node.parent
+        names.reverse()
+        return ''.join( names )
+    def node_from_path(self, path):
+        """
+        From a path (tuple of positions among children, as in a gtk.TreeStore),
+        find the node.
+        """
+        node = self.ROOT
+        for position in path:
+            node = self.tag_nodes[node].children[position]
+        return node
+    def strpath_from_path(self, path):
         """
-        while iter:
-            if self.tag_treestore.get_value( iter, 1) == True:
-                selected.append( 
-                    self.strpath_from_path( self.tag_treestore.get_path( iter ) ))
-            selected = self.rec_selected_tag_strpath( self.tag_treestore.iter_children(iter),
-                                              selected)
-            iter = self.tag_treestore.iter_next(iter)
-        return selected
-
-    def clean_selected(self):
+        From a path (as in a gtk.TreeStore), build a str .X.Y.Tags.
+        
+        :Return:
+        A str full path (.X.Y.Tags) of the tags at path.
         """
-        Unselect all tags in treestore.
+        return self.strpath( self.node_from_path( path ))
+    def id_of(self, keyword):
         """
-        self.rec_set_selected(self.tag_treestore.iter_children(None), False)
-    def select_all(self):
+        :Return:
+        - the id (index of the node) of 'keyword', a tag or already an id,
+          None if not a tag (nor the id of one still in the tree)
         """
-        Select all tags in treestore.
+        if isinstance(keyword, (int, long)):
+            if self.ROOT < keyword < len(self.tag_nodes) and self.tag_nodes[keyword] is not None:
+                return keyword
+            return None
+        return self.tag_id.get( keyword )
+    def ids(self, keyword_list):
         """
-        self.rec_set_selected(self.tag_treestore.iter_children(None), True)
-    def rec_set_selected(self, iter, status):
+        :Return:
+        - the list of the ids of the keywords of 'keyword_list' (see id_of),
+          None for the ones that are not tags. Searches take these ids as
+          well as the keywords, and compare or hash them faster.
         """
-        For a given 'iter' of treestore nodes, set selected and call
-        same function on subnodes
+        tag_id = self.tag_id
+        id_of = self.id_of
+        return [id_of( keyword ) if isinstance(keyword, (int, long)) else tag_id.get( keyword )
+                for keyword in keyword_list]
+    def check_index(self):
         """
-        while iter:
-            self.tag_treestore.set_value(iter, 1, status)
-            self.rec_set_selected( self.tag_treestore.iter_children(iter), status)
-            iter = self.tag_treestore.iter_next(iter)
+        Check that 'tag_id' is consistent with the tree, and that parent and
+        children indexes agree.
 
-    # sec -------------------------------------------------------- strpath_from_path
-    def strpath_from_path(self, path):
+        :Return:
+        - list of str describing the problems, void if all is right.
+        """
+        problems = []
+        seen = set()
+        stack = [self.ROOT]
+        while stack:
+            node = stack.pop()
+            seen.add( node )
+            for child in self.tag_nodes[node].children:
+                tag_node = self.tag_nodes[child]
+                if tag_node is None:
+                    problems.append( 'node %d: removed child %d' % (node, child) )
+                    continue
+                if tag_node.parent != node:
+                    problems.append( 'node %d: parent is %d, not %d'
+                                     % (child, tag_node.parent, node) )
+                if child in seen:
+                    problems.append( 'node %d: more than one parent' % child )
+                    continue
+                stack.append( child )
+        for index, tag_node in enumerate(self.tag_nodes):
+            if tag_node is not None and index not in seen:
+                problems.append( 'node %d: not in the tree' % index )
+        for tag, node in self.tag_id.items():
+            if node not in seen or self.tag_nodes[node].tag != tag:
+                problems.append( 'tag %s: tag_id %d is not its node' % (tag, node) )
+        selected = set( [node for node in seen
+                         if node != self.ROOT and self.tag_nodes[node].selected] )
+        if selected != self.selected_nodes:
+            problems.append( 'selected_nodes differ from the selected nodes : %s'
+                             % sorted( selected ^ self.selected_nodes ))
+        return problems
+    def pattern_node(self, pattern):
+        """
+        Find the node of a search pattern, given as a tag or a strpath (.X.Y.tag).
+
+        :Return:
+        - index of the node, None if the pattern is not in the tree
+        """
+        if pattern.startswith('.'):
+            # tags may hold dots : try each end of the strpath as the tag
+            start = len(pattern)
+            while start > 0:
+                start = pattern.rfind( '.', 0, start )
+                node = self.tag_id.get( pattern[start+1:] )
+                if node is not None and self.strpath( node ) == pattern:
+                    return node
+            return None
+        return self.tag_id.get( pattern )
+
+    # sec ---------------------------------------------------------------- hierarchy
+    def hierarchy_index(self):
         """
-        From a path of treestore, build a str .X.Y.Tags.
-        
         :Return:
-        A str full path (.X.Y.Tags) of the tags at path.
+        - the TagHierarchyIndex of the current revision, built only if needed.
         """
-        strpath = ''
-        for long in range(1,len(path)+1):
-            strpath = strpath + '.' + self.tag_treestore[path[0:long]][0]
-        return strpath
+        if self.hierarchy is None or self.hierarchy.revision != self.revision:
+            self.hierarchy = TagHierarchyIndex( self )
+        return self.hierarchy
 
     # sec -------------------------------------------------------- ElementTree (XML)
     def to_element(self):
         """
-        Turn the treestore to a structure of ET.Element stored in self.tag_element
+        Turn the tree to a structure of ET.Element stored in self.tag_element
         """
         self.tag_element = ET.Element("root")
-        self.tagnode_to_element( self.tag_treestore.iter_children(None),
-                                 self.tag_element )
+        self.tagnode_to_element( self.get_children(None), self.tag_element )
 
-    def tagnode_to_element(self, tag_iter, et_node):
+    def tagnode_to_element(self, nodes, et_node):
         """
-        Create a node ET.Element for the current node and recursively iterate
+        Create a node ET.Element for the current nodes and recursively iterate
         to all subnode.
         Element node is a 'tag' with str val.
 
         :Param:
-        - tag_iter: iterable through treestore nodes of same level
+        - nodes: list of nodes of same level
         - et_node: current ET.Element to which one ET.Element by node will be added 
         """
-        while tag_iter:
+        for node in nodes:
+            tag_node = self.tag_nodes[node]
             new_node = ET.SubElement(et_node,"tag")
-            new_node.text = self.tag_treestore.get_value(tag_iter, 0 )
-            self.tagnode_to_element( self.tag_treestore.iter_children(tag_iter),
-                                     new_node )
-            tag_iter = self.tag_treestore.iter_next(tag_iter)
+            new_node.text = tag_node.tag
+            self.tagnode_to_element( tag_node.children, new_node )
         return None
 
-    def element_to_tagnode(self, et_node, tag_iter):
+    def element_to_tagnode(self, et_node, node):
         """
-        Add nodes from et_node to the treestore, by default not editable
+        Add nodes from et_node to the tree, by default editable
         and not selected.
         
         :Param:
         - et_node: iterable of ET.Element
-        - tag_iter : where are the new nodes and subnodes added in treestore
+        - node : where are the new nodes and subnodes added in the tree
 
         :Throws:
         - TagData_UnicityWarning( 'tag:' + node.text + ' already in TagData')
         """
-        for node in et_node:
-            print "tag_iter=",tag_iter
-            tmp_tagiter = self.add_check_unique( tag_iter, node.text )
-            #if( node.text not in self.tag_set):
-            #    self.tag_set.add( node.text )
-            #    tmp_tagiter = self.tag_treestore.append(tag_iter, 
-            #                                            (node.text, False, False))
-            #    print "added ", self.strpath_from_path( self.tag_treestore.get_path( tmp_tagiter))
-            #else:
-            #    raise TagData_UnicityWarning( 'tag:' + node.text + ' already in TagData')
-            self.element_to_tagnode( node, tmp_tagiter )
+        for element in et_node:
+            if self.probe is not None:
+                self.probe.event( 'load_tag', element.text )
+            tmp_node = self.add_check_unique( node, element.text )
+            self.element_to_tagnode( element, tmp_node )
 # **********************************************************************************
 
 # **********************************************************************************
-# ********************************************************************** TagDataTree
+# ********************************************************************* TagXMLLoader
+# **********************************************************************************
+class TagXMLLoader(object):
+    """
+    Streaming loader of the XML format of TagDataTree, on expat events :
+    every element below the document root is a tag, whose text is the tag.
+
+    A tag is added to the TagDataTree as soon as its text is complete, that
+    is at the start of its first subtag or at its end. Only the stack of the
+    open tags is kept, so memory does not depend on the size of the file
+    and there is no recursion.
+
+    It may run in a worker thread : progress() tells how much of the file is
+    read, and cancel() stops it before the next chunk.
+    """
+    CHUNK_SIZE = 64 * 1024
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, tag_data, node=None):
+        """
+        :Params:
+        - tag_data : the TagDataTree to fill
+        - node : where are the new nodes and subnodes added (None for root)
+        """
+        self.tag_data = tag_data
+        self.source = '<xml>'
+        # nodes of the open tags, the root element is not a tag
+        self.stack = [node]
+        self.depth = 0
+        # 'generation' attribute of the root element
+        self.generation = 0
+        # text (and position) of the last open tag, not yet added
+        self.pending = None
+        self.size = 0
+        self.bytes_read = 0
+        self.cancelled = False
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.character_data
+
+    # sec ---------------------------------------------------------------------- I/O
+    def parse_file(self, db_file_name):
+        self.source = db_file_name
+        db_file = open( db_file_name, 'rb' )
+        try:
+            self.size = os.fstat( db_file.fileno() ).st_size
+            self.parse( db_file )
+        finally:
+            db_file.close()
+    def parse(self, db_file):
+        """
+        Feed the parser with 'db_file' (a file object), chunk by chunk.
+
+        :Throws:
+        - TagData_CancelledWarning if cancel() was called
+        """
+        while True:
+            if self.cancelled:
+                raise TagData_CancelledWarning( 'loading '+self.source+' cancelled' )
+            chunk = db_file.read( self.CHUNK_SIZE )
+            if not chunk:
+                break
+            self.parser.Parse( chunk, False )
+            self.bytes_read += len(chunk)
+        self.parser.Parse( '', True )
+    def progress(self):
+        """
+        :Return:
+        - fraction of the file already parsed, None if the size is unknown
+        """
+        if self.size == 0:
+            return None
+        return min( 1.0, self.bytes_read / float(self.size) )
+    def cancel(self):
+        self.cancelled = True
+
+    # sec ---------------------------------------------------------------- callbacks
+    def start_element(self, name, attrs):
+        if self.depth == 0:
+            self.generation = int( attrs.get('generation', 0) )
+        if self.pending is not None:
+            self.add_pending()
+        if self.depth > 0:
+            # expat columns start at 0
+            self.pending = ([], self.parser.CurrentLineNumber,
+                            self.parser.CurrentColumnNumber + 1)
+        self.depth += 1
+    def character_data(self, data):
+        if self.pending is not None:
+            self.pending[0].append( data )
+    def end_element(self, name):
+        if self.pending is not None:
+            self.add_pending()
+        self.depth -= 1
+        if self.depth > 0:
+            self.stack.pop()
+    def add_pending(self):
+        """
+        Add the pending tag, now that its text is complete.
+
+        :Throws:
+        - TagData_UnicityWarning, with the line and column of the tag
+        """
+        text, line, column = self.pending
+        self.pending = None
+        tag = u''.join( text )
+        # as ElementTree, keep ascii text as str, interned : the keywords
+        # of the images share it
+        try:
+            tag = intern( tag.encode( 'ascii' ))
+        except UnicodeError:
+            pass
+        if self.tag_data.probe is not None:
+            self.tag_data.probe.event( 'load_tag', tag )
+        try:
+            node = self.tag_data.add_check_unique( self.stack[-1], tag )
+        except TagData_UnicityWarning as warn:
+            warn = TagData_UnicityWarning( '%s (%s, line %d, column %d)' %
+                                           (warn, self.source, line, column) )
+            warn.line, warn.column = line, column
+            raise warn
+        self.stack.append( node )
+# **********************************************************************************
+
+# **********************************************************************************
+# ******************************************************************* TagDataJournal
+# **********************************************************************************
+class TagDataJournal(object):
+    """
+    Append-only journal of the changes of a TagDataTree saved as the XML file
+    'db_file_name' : saving costs the changes, not the whole tree.
+
+    Journal files are 'db_file_name'.journal.G with one json record per line :
+      ["add", tag, parent tag (null for root), position (null for last)]
+      ["rename", old tag, new tag]
+      ["move", tag, parent tag, position]
+      ["remove", tag]
+      ["select", tag, status]
+    A record is written at once, and fsync'ed by sync() (on close() and
+    each compaction too) or with the first record written SYNC_DELAY seconds
+    or more after the last fsync : with no record after it, the last one may
+    wait for close(). Tags being unique, records use them instead of
+    nodes, which change from one load to another.
+
+    The XML has a generation G (see TagDataTree.generation) : on load, the
+    journals of generation G and more are replayed on it. Past COMPACT_SIZE
+    bytes of journal, compact() writes a copy of the tree as the XML of
+    generation G+1 from a thread, while the new records go to the journal
+    G+1, and removes the journal G when done. Whenever it crashes, the XML
+    and the journals left give back the tags as last synced.
+    """
+    SYNC_DELAY = 1.0
+    COMPACT_SIZE = 1024 * 1024
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, tag_data, db_file_name):
+        """
+        Replay the journals of 'db_file_name' on 'tag_data', which has just
+        been loaded from it, then record the changes of 'tag_data'.
+
+        :Throws:
+        - TagData_UnicityWarning, TagData_HierarchyWarning if a journal does
+          not fit the XML
+        """
+        self.tag_data = tag_data
+        self.db_file_name = db_file_name
+        self.compaction = None
+        self.compact_pending = False
+        self.replay()
+        self.journal_file = open( self.journal_name(self.generation), 'ab' )
+        self.size = self.journal_file.tell()
+        self.last_sync = time.time()
+        self.follow()
+        tag_data.journal = self
+        tag_data.add_observer( self )
+    def close(self):
+        """
+        Wait for the compaction, if any, sync and stop recording.
+        """
+        if self.journal_file.closed:
+            return
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
+        self.sync()
+        self.journal_file.close()
+        self.tag_data.remove_observer( self )
+        self.tag_data.journal = None
+
+    def journal_name(self, generation):
+        return journal_name( self.db_file_name, generation )
+    def journal_generations(self):
+        return journal_generations( self.db_file_name )
+
+    # sec ------------------------------------------------------------------- replay
+    def replay(self):
+        """
+        Replay the journals of generation tag_data.generation and more, as a
+        bulk_edit, and remove the older ones (already in the XML).
+        """
+        base = self.tag_data.generation
+        self.generation = base
+        with self.tag_data.bulk_edit():
+            for generation in self.journal_generations():
+                if generation < base:
+                    os.remove( self.journal_name(generation) )
+                else:
+                    self.replay_file( self.journal_name(generation) )
+                    self.generation = generation
+        self.tag_data.to_save = False
+    def reload(self):
+        """
+        Replay the journals again, on tags just loaded anew from the XML
+        (see TagDataTree.load, replace_by) : the file alone misses the
+        changes since, and must not be compacted as it is.
+        """
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
+        self.sync()
+        self.replay()
+    def replay_file(self, journal_file_name):
+        """
+        Apply the records of 'journal_file_name'. A last record cut by a
+        crash is dropped from the file.
+        """
+        journal_file = open( journal_file_name, 'r+b' )
+        try:
+            good_size = 0
+            for line in journal_file:
+                if not line.endswith( '\n' ):
+                    break
+                try:
+                    record = json.loads( line )
+                except ValueError:
+                    break
+                self.apply( record )
+                good_size += len(line)
+            journal_file.truncate( good_size )
+        finally:
+            journal_file.close()
+    def apply(self, record):
+        tag_data = self.tag_data
+        record = [_json_tag( value ) for value in record]
+        op = record[0]
+        if op == 'add':
+            tag, parent, position = record[1:]
+            tag_data.add_check_unique( tag_data.tag_id.get( parent ), tag, position )
+        elif op == 'rename':
+            tag_data.update_check_unique( tag_data.tag_id[record[1]], record[2] )
+        elif op == 'move':
+            tag, parent, position = record[1:]
+            node = tag_data.tag_id[tag]
+            parent = tag_data.tag_id.get( parent, tag_data.ROOT )
+            # 'position' is where the node ended, move() counts it before the
+            # node leaves its place
+            if position is not None and tag_data.tag_nodes[node].parent == parent \
+                    and tag_data.tag_nodes[parent].children.index( node ) < position:
+                position += 1
+            tag_data.move( node, parent, position )
+        elif op == 'remove':
+            tag_data.remove( tag_data.tag_id[record[1]] )
+        elif op == 'select':
+            tag_data.set_selected( tag_data.tag_id[record[1]], record[2] )
+
+    # sec ------------------------------------------------------------------- record
+    def follow(self):
+        """
+        Remember what the records are made from : the tag and selection of
+        every node, and the revision of the tree.
+        """
+        # from the nodes : an added tag is told before it is in tag_id
+        self.tags = dict( [(node, tag_node.tag)
+                           for node, tag_node in enumerate(self.tag_data.tag_nodes)
+                           if tag_node is not None and node != TagDataTree.ROOT] )
+        self.selected = set(self.tag_data.selected_nodes)
+        self.revision = self.tag_data.revision
+    def record(self, record):
+        line = json.dumps( record ) + '\n'
+        self.journal_file.write( line )
+        self.journal_file.flush()
+        self.size += len(line)
+        if time.time() - self.last_sync > self.SYNC_DELAY:
+            self.sync()
+        # not yet : the change may not be done in the tree (see on_tag_removed)
+        if self.size > self.COMPACT_SIZE and self.compaction is None:
+            self.compact_pending = True
+    def compact_if_pending(self):
+        """
+        Compact if the journal went past COMPACT_SIZE, once the tree holds
+        every change recorded.
+        """
+        if self.compact_pending:
+            self.compact()
+    def sync(self):
+        """
+        Make the records written so far survive a crash.
+        """
+        self.journal_file.flush()
+        os.fsync( self.journal_file.fileno() )
+        self.last_sync = time.time()
+    def parent_position(self, node):
+        """
+        :Return:
+        - (parent tag, position) of 'node', None for root or last
+        """
+        tag_nodes = self.tag_data.tag_nodes
+        parent = tag_nodes[node].parent
+        children = tag_nodes[parent].children
+        position = None
+        if children[-1] != node:
+            position = children.index( node )
+        return tag_nodes[parent].tag, position
+
+    # sec ---------------------------------------------------------------- observer
+    def on_tag_added(self, node):
+        tag_node = self.tag_data.tag_nodes[node]
+        parent, position = self.parent_position( node )
+        self.record( ['add', tag_node.tag, parent, position] )
+        self.tags[node] = tag_node.tag
+        self.revision = self.tag_data.revision
+        if tag_node.selected:
+            self.on_tag_changed( node )
+        self.compact_if_pending()
+    def on_tag_changed(self, node):
+        tag_node = self.tag_data.tag_nodes[node]
+        if self.tags.get( node ) != tag_node.tag:
+            self.record( ['rename', self.tags.get( node ), tag_node.tag] )
+            self.tags[node] = tag_node.tag
+            self.revision = self.tag_data.revision
+        if (node in self.selected) != tag_node.selected:
+            self.record( ['select', tag_node.tag, tag_node.selected] )
+            if tag_node.selected:
+                self.selected.add( node )
+            else:
+                self.selected.discard( node )
+        self.compact_if_pending()
+    def on_tag_moved(self, node):
+        parent, position = self.parent_position( node )
+        self.record( ['move', self.tag_data.tag_nodes[node].tag, parent, position] )
+        self.revision = self.tag_data.revision
+        self.compact_if_pending()
+    def on_tag_removed(self, node):
+        # told before the subtree is freed : the compaction waits for the
+        # next change, or reset
+        self.record( ['remove', self.tag_data.tag_nodes[node].tag] )
+        stack = [node]
+        while stack:
+            index = stack.pop()
+            self.tags.pop( index, None )
+            self.selected.discard( index )
+            stack.extend( self.tag_data.tag_nodes[index].children )
+        # counted once the subtree is freed
+        self.revision = self.tag_data.revision + 1
+    def on_tags_reset(self):
+        """
+        After a bulk_edit : only the selection changed if the revision is the
+        same, else compact. Tags loaded from another file (or from none) close
+        the journal instead.
+        """
+        if self.tag_data.filename != self.db_file_name:
+            self.close()
+            return
+        if self.revision == self.tag_data.revision:
+            for node in sorted(self.selected ^ self.tag_data.selected_nodes):
+                tag_node = self.tag_data.tag_nodes[node]
+                self.record( ['select', tag_node.tag, tag_node.selected] )
+            self.selected = set(self.tag_data.selected_nodes)
+            self.compact_if_pending()
+        else:
+            self.compact()
+
+    # sec ------------------------------------------------------------- compaction
+    def compact(self, background=True):
+        """
+        Write the tags as the XML of the next generation, from a thread if
+        'background'. Records go to the journal of this generation from now.
+        If the write fails, the older journals stay and are still replayed.
+        """
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
+        self.compact_pending = False
+        self.sync()
+        self.journal_file.close()
+        old_generation = self.generation
+        self.generation += 1
+        tag_data = self.tag_data.copy()
+        tag_data.generation = self.generation
+        self.tag_data.generation = self.generation
+        self.journal_file = open( self.journal_name(self.generation), 'wb' )
+        self.size = 0
+        self.follow()
+        # the XML does not keep the selection
+        for node in sorted(self.selected):
+            line = json.dumps( ['select', self.tag_data.tag_nodes[node].tag, True] ) + '\n'
+            self.journal_file.write( line )
+            self.size += len(line)
+        self.sync()
+        def work():
+            # not tag_data.write(), which drops the journals
+            write_atomic( self.db_file_name, tag_data.iter_xml() )
+            for generation in self.journal_generations():
+                if generation <= old_generation:
+                    os.remove( self.journal_name(generation) )
+        if background:
+            self.compaction = threading.Thread( target=work )
+            self.compaction.daemon = True
+            self.compaction.start()
+        else:
+            work()
+# **********************************************************************************
+
+# **********************************************************************************
+# ************************************************************************ TagFinder
+# **********************************************************************************
+class TagFinder(object):
+    """
+    Type-ahead search of the tags of a TagDataTree, by prefix then fuzzy,
+    on tags folded to lower case without accents (see fold).
+
+    'self.entries' is the sorted list of (folded tag, node), searched by
+    bisect for the prefixes.
+    'self.grams' is a dictionary {trigram : list of nodes}, the candidates of
+    the fuzzy search, ranked by their prefix edit distance to the query.
+    Lists only grow : a removed or renamed node stays until the index is
+    rebuilt, once they are more than half, and is checked on each search.
+
+    It observes the TagDataTree and follows every change.
+    """
+    # count at most MAX_POSTINGS nodes from the trigram lists, and compute the
+    # distance to at most MAX_CANDIDATES of them
+    MAX_POSTINGS = 5000
+    MAX_CANDIDATES = 200
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, tag_data, max_distance=2):
+        """
+        :Params:
+        - tag_data : the TagDataTree
+        - max_distance : of the fuzzy search, in edits
+        """
+        self.tag_data = tag_data
+        self.max_distance = max_distance
+        self.build()
+        tag_data.add_observer( self )
+    def detach(self):
+        self.tag_data.remove_observer( self )
+    def build(self):
+        """
+        Index all the tags of the tree.
+        """
+        self.keys = {}
+        self.entries = []
+        self.grams = {}
+        self.stale = 0
+        for node, tag_node in enumerate(self.tag_data.tag_nodes):
+            if node != TagDataTree.ROOT and tag_node is not None:
+                key = fold( tag_node.tag )
+                self.keys[node] = key
+                self.entries.append( (key, node) )
+                self.add_grams( key, node )
+        self.entries.sort()
+    def add_grams(self, key, node):
+        for gram in _trigrams( key ):
+            self.grams.setdefault( gram, [] ).append( node )
+    def add(self, node):
+        key = fold( self.tag_data.tag_nodes[node].tag )
+        self.keys[node] = key
+        insort( self.entries, (key, node) )
+        self.add_grams( key, node )
+    def discard(self, node):
+        key = self.keys.pop( node, None )
+        if key is None:
+            return
+        index = bisect_left( self.entries, (key, node) )
+        del self.entries[index]
+        self.stale += 1
+        if self.stale > len(self.keys):
+            self.build()
+
+    # sec ------------------------------------------------------------------- search
+    def find(self, query, k=10):
+        """
+        :Return:
+        - at most 'k' nodes matching 'query' : the tags starting with it, in
+          alphabetical order, then the tags whose start is at most
+          'max_distance' edits from it, the closest first.
+        """
+        nodes = self.find_prefix( query, k )
+        if len(nodes) < k:
+            found = set(nodes)
+            nodes.extend( [node for node in self.find_fuzzy( query, k )
+                           if node not in found][:k - len(nodes)] )
+        return nodes
+    def find_prefix(self, prefix, k=10):
+        """
+        :Return:
+        - at most 'k' nodes whose tag starts with 'prefix', in alphabetical order
+        """
+        prefix = fold( prefix )
+        nodes = []
+        index = bisect_left( self.entries, (prefix,) )
+        while index < len(self.entries) and len(nodes) < k:
+            key, node = self.entries[index]
+            if not key.startswith( prefix ):
+                break
+            nodes.append( node )
+            index += 1
+        return nodes
+    def find_fuzzy(self, query, k=10):
+        """
+        :Return:
+        - at most 'k' nodes whose tag starts at most 'max_distance' edits
+          from 'query', the closest first. Only the tags sharing the most
+          trigrams with 'query', and the tags starting as 'query' with a
+          swap or a letter less (see prefix_candidates), are tried, so it is
+          bounded whatever the number of tags.
+        """
+        query = fold( query )
+        grams = _trigrams( query )
+        if len(query) < 3 or not grams:
+            return []
+        # the rarest trigrams first, each with all its nodes while they fit
+        # in MAX_POSTINGS : whatever the order the tags were added in
+        grams = sorted(grams, key=lambda gram: len(self.grams.get( gram, () )))
+        budget = self.MAX_POSTINGS
+        counts = {}
+        common = []
+        for gram in grams:
+            postings = self.grams.get( gram, () )
+            if len(postings) > budget:
+                common.append( gram )
+                continue
+            budget -= len(postings)
+            for node in postings:
+                counts[node] = counts.get( node, 0 ) + 1
+        # too common to list, only counted for the nodes found so far
+        if common:
+            for node in counts:
+                key = u' ' + self.keys.get( node, u'' )
+                counts[node] += sum( [gram in key for gram in common] )
+        candidates = set(nlargest( self.MAX_CANDIDATES, counts, key=counts.get ))
+        # a swap in a short query leaves few trigrams, if any, in common
+        candidates.update( self.prefix_candidates( query ) )
+        # the distance to a prefix never needs more of the key
+        length = len(query) + self.max_distance
+        scored = []
+        for node in candidates:
+            key = self.keys.get( node )
+            # removed, or renamed without this trigram any more
+            if key is None:
+                continue
+            distance = _prefix_distance( query, key[:length], self.max_distance )
+            if distance <= self.max_distance:
+                scored.append( (distance, key, node) )
+        scored.sort()
+        return [node for distance, key, node in scored[:k]]
+    def prefix_candidates(self, query):
+        """
+        :Return:
+        - at most MAX_CANDIDATES nodes whose tag starts as 'query' with two
+          letters next to each other swapped, or with one letter less
+        """
+        starts = set()
+        for index in range(len(query)):
+            starts.add( query[:index] + query[index+1:] )
+            if index + 1 < len(query):
+                starts.add( query[:index] + query[index+1] + query[index] + query[index+2:] )
+        share = max( 1, self.MAX_CANDIDATES // len(starts) )
+        nodes = []
+        for start in starts:
+            index = bisect_left( self.entries, (start,) )
+            for key, node in self.entries[index:index+share]:
+                if not key.startswith( start ):
+                    break
+                nodes.append( node )
+        return nodes
+
+    # sec ---------------------------------------------------------------- observer
+    def on_tag_added(self, node):
+        self.add( node )
+    def on_tag_changed(self, node):
+        if self.keys.get( node ) != fold( self.tag_data.tag_nodes[node].tag ):
+            self.discard( node )
+            self.add( node )
+    def on_tag_moved(self, node):
+        pass
+    def on_tag_removed(self, node):
+        if not self.tag_data.tag_nodes[node].children:
+            self.discard( node )
+            return
+        # a subtree : 'entries' filtered once, not a del for each node
+        removed = set()
+        stack = [node]
+        while stack:
+            index = stack.pop()
+            if self.keys.pop( index, None ) is not None:
+                removed.add( index )
+            stack.extend( self.tag_data.tag_nodes[index].children )
+        self.entries = [entry for entry in self.entries if entry[1] not in removed]
+        self.stale += len(removed)
+        if self.stale > len(self.keys):
+            self.build()
+    def on_tags_reset(self):
+        self.build()
+# **********************************************************************************
+
+# **********************************************************************************
+# **************************************************************** TagHierarchyIndex
+# **********************************************************************************
+class TagHierarchyIndex(object):
+    """
+    Euler-tour (preorder) intervals of the nodes of a TagDataTree, for one
+    revision of the tree. With 'first[n]' the preorder position of node n and
+    'last[n]' the position just after its last descendant :
+      'a' is 'd' or one of its ancestors <=> first[a] <= first[d] < last[a]
+    which is an O(1) test, whatever the length of the strpaths.
+
+    'self.order' is the list of nodes in preorder (the root is at position 0).
+    Removed nodes have first = last = -1.
+    """
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, tag_data):
+        """
+        Build the intervals by an iterative walk of 'tag_data' (a TagDataTree).
+        """
+        self.revision = tag_data.revision
+        tag_nodes = tag_data.tag_nodes
+        self.order = []
+        stack = [TagDataTree.ROOT]
+        while stack:
+            node = stack.pop()
+            self.order.append( node )
+            stack.extend( reversed(tag_nodes[node].children) )
+        self.first = [-1] * len(tag_nodes)
+        for position, node in enumerate(self.order):
+            self.first[node] = position
+        # size of subtrees, children are after their parent in preorder
+        size = [1] * len(tag_nodes)
+        for node in reversed(self.order[1:]):
+            size[tag_nodes[node].parent] += size[node]
+        self.last = [-1] * len(tag_nodes)
+        for node in self.order:
+            self.last[node] = self.first[node] + size[node]
+
+    @classmethod
+    def from_preorder(cls, revision, last):
+        """
+        Index of a tree whose nodes are numbered in preorder, as loaded from
+        a snapshot : nothing to walk, only 'last' is needed.
+        """
+        index = cls.__new__( cls )
+        index.revision = revision
+        index.order = range( len(last) )
+        index.first = range( len(last) )
+        index.last = last
+        return index
+
+    # sec ------------------------------------------------------------------ queries
+    def is_ancestor(self, ancestor, node):
+        """
+        :Return:
+        - True if 'ancestor' is 'node' or one of its ancestors
+        """
+        return self.first[ancestor] <= self.first[node] < self.last[ancestor]
+    def subtree(self, node):
+        """
+        :Return:
+        - the list of 'node' and all its descendants, in preorder
+        """
+        return self.order[self.first[node]:self.last[node]]
+    def coverage(self, nodes):
+        """
+        :Return:
+        - a bytearray, indexed by preorder position, set to 1 for
+          every position within the subtree of one of 'nodes'
+        """
+        covered = bytearray( len(self.order) )
+        for node in nodes:
+            first, last = self.first[node], self.last[node]
+            covered[first:last] = b'\x01' * (last - first)
+        return covered
+    def intersection(self, nodes):
+        """
+        :Return:
+        - (first, last), the interval of the positions within the subtrees of
+          every one of 'nodes'. Empty (first >= last) if there is none.
+        """
+        first, last = 0, len(self.order)
+        for node in nodes:
+            first = max( first, self.first[node] )
+            last = min( last, self.last[node] )
+        return first, last
+# **********************************************************************************
+
+# **********************************************************************************
+# ******************************************************************** TagDataSearch
 # **********************************************************************************
 class TagDataSearch(object):
     """
@@ -369,14 +1929,40 @@ class TagDataSearch(object):
     - look_for_one_in : implement a kind of OR (keyword is in one of tag_pattern_list)
     # look_for_all_in : all keywords must be looked for.
     - is_matched_by : implement a kind of ALL (all tag_pattern are found in keywords)
+    The same tests can be done for a whole catalogue of images at once with
+    match_batch (needs numpy).
+
+    A tag_pattern is a tag or a strpath (.X.Y.tag) and matches the tag and
+    its children. Patterns are compiled against the TagHierarchyIndex of the
+    tree, and compiled again when the tree has changed. Keywords are tags or
+    their ids (see TagDataTree.ids).
     
     tag_searched : result of previous search. Usefull for repeated look_for_xxx
+                   A TagSearchCache by id, bounded to 'cache_size' results and
+                   emptied when the tree has changed.
+    probe : optional TagDataProbe, counting hits and misses in tag_searched,
+            timing every look_for_xxx/is_matched_by/match_batch call and
+            tracing events. Nothing is measured when None.
+    pin : search a TagDataTree.version() of 'tag_data' instead of the tree,
+          so that the tags do not change under a search run by another
+          thread than the one editing them. refresh() pins the last version.
     """
     # sec -------------------------------------------------------------------- init
-    def __init__(self, tag_pattern_list, tag_data=None):
+    TIMED_METHODS = ('look_for_one_in', 'look_for_all_in', 'is_matched_by',
+                     'match_batch')
+    def __init__(self, tag_pattern_list, tag_data=None, probe=None,
+                 cache_size=10000, pin=False):
+        self.source = tag_data
+        if pin:
+            tag_data = tag_data.version()
         self.tag_data = tag_data
-        self.tag_searched = {}
+        self.tag_searched = TagSearchCache( cache_size )
         self.tag_pattern_list = tag_pattern_list
+        self.hierarchy = None
+        self.probe = probe
+        if probe is not None:
+            for name in self.TIMED_METHODS:
+                setattr( self, name, probe.timed( name, getattr(self, name) ))
         #
         # concatenation des pattern
         #self.pattern = ''
@@ -384,63 +1970,101 @@ class TagDataSearch(object):
         #    self.pattern += t 
         #print self.pattern
 
+    def compile(self):
+        """
+        Resolve the patterns to nodes and compute, at the current revision
+        of the tree :
+        - pattern_nodes : node of each pattern (None if not in the tree)
+        - covered : positions under one of the patterns (see look_for)
+        - common : interval of the positions under all the patterns (see is_in_all)
+        """
+        self.hierarchy = self.tag_data.hierarchy_index()
+        self.first_array = None
+        self.pattern_nodes = [self.tag_data.pattern_node(pattern)
+                              for pattern in self.tag_pattern_list]
+        known_nodes = [node for node in self.pattern_nodes if node is not None]
+        self.covered = self.hierarchy.coverage( known_nodes )
+        if len(known_nodes) == len(self.pattern_nodes):
+            self.common = self.hierarchy.intersection( known_nodes )
+        else:
+            self.common = (0, 0)
+    def refresh(self):
+        """
+        With pin, search the last version of the tags from now on. The
+        patterns are compiled again if they have changed.
+        """
+        if self.tag_data is not self.source:
+            self.tag_data = self.source.version()
+    def check_compiled(self):
+        """
+        Compile the patterns if never done or if the tree has changed since.
+        """
+        if self.hierarchy is None or self.hierarchy.revision != self.tag_data.revision:
+            self.compile()
+    def position(self, keyword):
+        """
+        :Return:
+        - preorder position of the node of 'keyword' (a tag or its id), None
+          if not in the tree
+        """
+        self.check_compiled()
+        node = self.tag_data.id_of( keyword )
+        if node is None or node >= len(self.hierarchy.first):
+            return None
+        position = self.hierarchy.first[node]
+        if position < 0:
+            # removed since
+            return None
+        return position
+
     # sec ------------------------------------------------------------- ONE keyword
     def look_for(self, keyword):
         """
         Look if 'keyword' is present in the list of tag_pattern of their children.
-        """
-        print "looking for ",keyword
+        'keyword' is a tag or its id (see TagDataTree.ids), results are kept
+        by id in tag_searched.
+        """
+        node = self.tag_data.id_of( keyword )
+        if node is None:
+            if self.probe is not None:
+                self.probe.event( 'look_for', keyword, False )
+            return False
         # first, may already be in tag_searched
-        try:
-            #print self.tag_searched[keyword]," Seen"
-            return self.tag_searched[keyword]
+        found = self.tag_searched.get( node, self.tag_data.revision )
+        if found is not None:
+            if self.probe is not None:
+                self.probe.count( 'cache_hit' )
+            return found
         # ok, so now we have to look for it
-        except KeyError:
-            try:
-                strpath = self.tag_data.tag_set[keyword]
-                #print "strpath ",strpath
-                for pattern in self.tag_pattern_list:
-                    if strpath.find( pattern ) != -1:
-                        self.tag_searched[keyword] = True
-                        #print "OK ", keyword
-                        return True
-            except KeyError:
-                self.tag_searched[keyword] = False
-                #print "Not found ", keyword
-                #return False
-        self.tag_searched[keyword] = False
-        print "No ", keyword
-        return False
+        if self.probe is not None:
+            self.probe.count( 'cache_miss' )
+        position = self.position( node )
+        found = position is not None and self.covered[position] == 1
+        self.tag_searched.put( node, found )
+        if self.probe is not None:
+            self.probe.event( 'look_for', keyword, found )
+        return found
     def is_in_all(self, keyword):
         """
         Look if 'keyword' is in EVERY tag_pattern or their children.
         @todo Not usefull, as unlikely to be used (one keyword in a list of different tag?)
         """
-        print "looking for ",keyword
-        # first, may already be in tag_searched
-        try:
-            #print self.tag_searched[keyword]," Seen"
-            return self.tag_searched[keyword]
+        # first, may already be in tag_searched (not as a look_for result)
+        key = ('is_in_all', self.tag_data.id_of( keyword ))
+        found = self.tag_searched.get( key, self.tag_data.revision )
+        if found is not None:
+            if self.probe is not None:
+                self.probe.count( 'cache_hit' )
+            return found
         # ok, so now we have to look for it
-        except KeyError:
-            try:
-                strpath = self.tag_data.tag_set[keyword]
-                print "strpath ",strpath
-                for pattern in self.tag_pattern_list:
-                    if strpath.find( pattern ) == -1:
-                        print "No ", keyword
-                        self.tag_searched[keyword] = False
-                        return False
-                self.tag_searched[keyword] = True
-                print "OK ", keyword
-                return True
-            except KeyError:
-                self.tag_searched[keyword] = False
-                print "Not found ", keyword
-                #return False
-        self.tag_searched[keyword] = False
-        print "No ", keyword
-        return False
+        if self.probe is not None:
+            self.probe.count( 'cache_miss' )
+        position = self.position( keyword )
+        found = position is not None and self.common[0] <= position < self.common[1]
+        self.tag_searched.put( key, found )
+        if self.probe is not None:
+            self.probe.event( 'is_in_all', keyword, found )
+        return found
     # sec ----------------------------------------------------------- MANY keywords
     def look_for_one_in(self, keyword_list):
         """
@@ -461,597 +2085,568 @@ class TagDataSearch(object):
     def is_matched_by(self, keyword_list):
         """
         The set of keywords is enough to be present in every tag_pattern.
-        Longer to compute (inverse from is_in).
+        Costs (number of patterns) x (number of keywords) interval tests.
         """
-        for pattern in self.tag_pattern_list:
-            print "Is ",pattern," matched?"
+        self.check_compiled()
+        positions = [self.position( keyword ) for keyword in keyword_list]
+        first, last = self.hierarchy.first, self.hierarchy.last
+        for pattern, node in zip(self.tag_pattern_list, self.pattern_nodes):
             found = False
-            for keyword in keyword_list:
-                if self.tag_data.tag_set[keyword].find( pattern ) != -1:
-                    found = True
-                    print "=> YES : ", keyword
-                    break
+            if node is not None:
+                for keyword, position in zip(keyword_list, positions):
+                    if position is not None and first[node] <= position < last[node]:
+                        found = True
+                        break
+            if self.probe is not None:
+                self.probe.event( 'is_matched_by', pattern, found )
             if not found:
-                print "=> NO : exit"
                 return False
-        print "MATCHED"
         return True
 
-# **********************************************************************************
-# ****************************************************************** TagData_Warning
-# **********************************************************************************
-class TagData_UnicityWarning(UserWarning):
-    """
-    Raised when trying to insert an existing tag to the TagData.
-    """
-    pass
+    # sec ------------------------------------------------------------------- BATCH
+    ONE_IN = 'one_in'
+    ALL_IN = 'all_in'
+    MATCHED_BY = 'matched_by'
+    def match_batch(self, keywords, mode=ONE_IN):
+        """
+        Test the keyword lists of many images at once, with array operations
+        against the TagHierarchyIndex. Needs numpy.
+
+        :Params:
+        - keywords : a TagKeywordMatrix, or a list of keyword lists
+        - mode : ONE_IN (as look_for_one_in), ALL_IN (as look_for_all_in)
+                 or MATCHED_BY (as is_matched_by)
+
+        :Returns:
+        - numpy array of booleans, one for each image
+        """
+        import numpy
+        if not isinstance(keywords, TagKeywordMatrix):
+            keywords = TagKeywordMatrix( keywords, self.tag_data )
+        self.check_compiled()
+        if self.first_array is None:
+            self.first_array = numpy.array( self.hierarchy.first, dtype=numpy.int64 )
+            self.covered_array = numpy.frombuffer( self.covered, dtype=numpy.uint8 )
+        nb_images = keywords.nb_images()
+        # preorder position of every keyword, -1 if not in the tree
+        known = keywords.indices >= 0
+        positions = numpy.where( known, self.first_array[keywords.indices], -1 )
+        known = positions >= 0
+
+        if mode == self.ONE_IN or mode == self.ALL_IN:
+            hit = numpy.zeros( len(positions), dtype=bool )
+            hit[known] = self.covered_array[positions[known]] != 0
+            nb_hits = numpy.bincount( keywords.rows[hit], minlength=nb_images )
+            if mode == self.ONE_IN:
+                return nb_hits > 0
+            return nb_hits == numpy.diff( keywords.indptr )
+        elif mode == self.MATCHED_BY:
+            matched = numpy.ones( nb_images, dtype=bool )
+            for node in self.pattern_nodes:
+                if node is None:
+                    return numpy.zeros( nb_images, dtype=bool )
+                hit = known & (positions >= self.hierarchy.first[node]) \
+                    & (positions < self.hierarchy.last[node])
+                matched &= numpy.bincount( keywords.rows[hit], minlength=nb_images ) > 0
+            return matched
+        raise ValueError( 'mode: '+str(mode)+' is not a mode of match_batch' )
+
 # **********************************************************************************
 
 # **********************************************************************************
-# ******************************************************************** TagDataGadget
+# ********************************************************************* TagDataQuery
 # **********************************************************************************
-class TagDataGadget(gtk.Frame):
+class TagDataQuery(object):
     """
-    A GTK Frame to manage TagDataTree.
+    A boolean query over the tags of a TagDataTree, tested against the
+    keywords of images, for example :
+      .Gens.Bob AND (.Nature.Lac OR .Nature.Foret) AND NOT .Gens.Marcel
+    A term is a tag or a strpath (.X.Y.tag) and is true when one keyword is
+    the tag or one of its children. NOT binds tighter than AND, which binds
+    tighter than OR.
+
+    The query is parsed once, then compiled against the tree into a plan
+    where the terms of every AND/OR are ordered to be decided as soon as
+    possible (smallest cost / probability to stop), and the evaluation stops
+    as soon as the result is known. Terms not in the tree are false and are
+    folded away. The plan is compiled again when the tree has changed.
+
+    statistics : optional ImageTagIndex (or anything with count_under(pattern)
+                 and len()) giving the probability of a term, otherwise
+                 estimated with the size of the subtree of the term.
+
+    Plan nodes are lists [op, p, cost, args] with 'p' the estimated
+    probability of being true and 'cost' the estimated number of terms
+    tested. 'args' is the (pattern, first, last) of a TERM, the plan nodes
+    of AND/OR/NOT, and the value of a CONST.
     """
-    # sec --------------------------------------------------------------------- init
-    def __init__(self, tag_data=None):
-        """
-        :Param:
-        - tag_data: a TagDataTree
-        """
-        gtk.Frame.__init__(self)
-        self.list_actions = []
-        self.init_actions()
-
-        # store tag_data
-        self.tag_store = tag_data
-        
-        # create the TreeView using treestore
-        self.treeview = gtk.TreeView(self.tag_store.tag_treestore)
-        # allow the selection of more than one row
-        self.treeview.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
-        # allow reordring of elements
-        self.treeview.set_reorderable( True )
-        # can click on header
-        # listen for some keyboard events
-        self.treeview.add_events(gtk.gdk.KEY_PRESS_MASK)
-        self.treeview.connect("key-press-event", self.__on_key_press_event)
-
-        # create the TreeViewColumn to display the tags
-        self.tvcolumn0 = gtk.TreeViewColumn('Mot clef')
-        self.tvcolumn0.set_fixed_width( 40 )
-        self.tvcolumn0.set_expand( True )
-        self.tvcolumn0.set_clickable( True )
-        self.tvcolumn0.connect( 'clicked', self.__on_title0_clicked )
-        # create a CellRendererText to render the tags
-        self.text_cell = gtk.CellRendererText()
-        #self.text_cell.set_property('editable', True)
-        self.text_cell.connect('edited', self.__on_cell_edited, self.tag_store.tag_treestore)
-        # add the cell to the tvcolumn and allow it to expand
-        self.tvcolumn0.pack_start(self.text_cell, True)
-        # set the cell "text" attribute to column 0 - retrieve text
-        # from that column in treestore
-        # and its editable capacity from column 2
-        self.tvcolumn0.add_attribute(self.text_cell, 'text', 0)
-        self.tvcolumn0.add_attribute(self.text_cell, 'editable', 2)
-
-        # The toggle cellrenderer is setup and we allow it to be
-        # changed (toggled) by the user.
-        self.toggle_cell = gtk.CellRendererToggle()
-        self.toggle_cell.set_property('activatable', True)
-        self.toggle_cell.connect( 'toggled', self.__on_cell_toggled,
-                                  (self.tag_store.tag_treestore, 1))
-        # The columns active state is attached to the second column
-        # in the model.  So when the model says True then the button
-        # will show as active e.g on.
-        self.tvcolumn1 = gtk.TreeViewColumn("Selection", self.toggle_cell )
-        self.tvcolumn1.add_attribute( self.toggle_cell, "active", 1)
-        self.tvcolumn1.set_clickable( True )
-        self.tvcolumn1.connect( 'clicked', self.__on_title1_clicked )
-
-        # add columns
-        self.treeview.append_column( self.tvcolumn0 )
-        self.treeview.append_column( self.tvcolumn1 ) 
-
-        self.treeview.show()
-
-        # put it all into a scrolled window
-        self.scroll_window = gtk.ScrolledWindow(hadjustment=None, vadjustment=None)
-        # with always a vertical scrollbar
-        self.scroll_window.set_policy(hscrollbar_policy=gtk.POLICY_AUTOMATIC,
-                                      vscrollbar_policy=gtk.POLICY_ALWAYS)
-        self.scroll_window.add_with_viewport( self.treeview )
-        self.scroll_window.show()
-        self.add( self.scroll_window )
-    def init_actions(self):
-        # load
-        action_load = gtk.Action('tag_data_load', label='Load Tag',
-                                 tooltip='Load hierarchy of Tags',
-                                      stock_id=gtk.STOCK_OPEN)
-        action_load.connect( 'activate', self.__cb_action_load )
-        self.list_actions.append( action_load )
-        # save
-        action_save = gtk.Action('tag_data_save', label='Save Tag',
-                                 tooltip='Save hierarchy of Tags',
-                                      stock_id=gtk.STOCK_SAVE)
-        action_save.connect( 'activate', self.__cb_action_save )
-        self.list_actions.append( action_save )
-        # save_as
-        action_save_as = gtk.Action('tag_data_save_as', label='Save Tag As',
-                                    tooltip='Save hierarchy of Tags',
-                                    stock_id=gtk.STOCK_SAVE)
-        action_save_as.connect( 'activate', self.__cb_action_save_as )
-        self.list_actions.append( action_save_as )
-        # add (as a sibling)
-        action_add = gtk.Action( 'add_tag', label='Add Tag',
-                                 tooltip='Add a sibling Tag',
-                                 stock_id=gtk.STOCK_ADD)
-        action_add.connect( 'activate', self.__cb_action_add )
-        self.list_actions.append( action_add )
-        # delete tag
-        action_delete = gtk.Action( 'delete_tag', label='Delete Tag',
-                                    tooltip='Delete Tag',
-                                    stock_id=gtk.STOCK_DELETE)
-        action_delete.connect( 'activate', self.__cb_action_delete )
-        self.list_actions.append( action_delete )
-        # help
-        action_help =  gtk.Action( 'help_tag', label='Help Tags',
-                                    tooltip='Key bindings about Tags',
-                                    stock_id=gtk.STOCK_HELP)
-        action_help.connect( 'activate', self.__cb_action_help )
-        self.list_actions.append( action_help )
-    def delete_event(self, widget, event, data=None):
-        gtk.main_quit()
-        return False
-
-    # sec ----------------------------------------------------------------- callback
-    def __on_key_press_event(self, widget, event):
-        """
-        :Warning: With MacOS, may change 
-        and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)
-        to
-        and (event.state == gtk.gdk.CONTROL_MASK)
-        """
-        # keyval is in gtk.keysyms.Insert (par exemple)
-        # print "TagDataGadget __on_key_press_event"
-        # print "event.keyval =",event.keyval
-        # print "event.string =",event.string
-        # print "event.state =", event.state, event.state.__class__
-        # print "Ctrl ? =", (event.state & gtk.gdk.CONTROL_MASK)
-        # print "event.group =",event.group
-        # print event
-        # Insert or Ctrl-i -> insert new tag
-        if( event.keyval == gtk.keysyms.Insert or 
-            ((event.keyval == gtk.keysyms.i or event.keyval == gtk.keysyms.I)
-             #and (event.state == gtk.gdk.CONTROL_MASK))):
-            and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK))):
-            self.insert_tag()
-            return True  # NO event propagation
-        # Ctr-j -> add as simbling
-        elif( (event.keyval == gtk.keysyms.j or event.keyval == gtk.keysyms.J)
-              #and (event.state == gtk.gdk.CONTROL_MASK)):
-              and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
-            self.add_sibling_tag()
-            return True  # NO event propagation
-        # Delete or Ctrl-x -> delete_tag
-        elif( event.keyval == gtk.keysyms.Delete or
-            ((event.keyval == gtk.keysyms.x or event.keyval == gtk.keysyms.X)
-             #and (event.state == gtk.gdk.CONTROL_MASK))):
-             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK))):
-            self.delete_tag()
-            return True  # NO event propagation
-        # Ctrl-e -> edit tag
-        elif( (event.keyval == gtk.keysyms.e or event.keyval == gtk.keysyms.E)
-             #and (event.state == gtk.gdk.CONTROL_MASK)):
-             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
-            self.edit_tag()
-            return True  # NO event propagation
-        # Ctrl-p -> print_tree
-        elif( (event.keyval == gtk.keysyms.p or  event.keyval == gtk.keysyms.P)
-             #and (event.state == gtk.gdk.CONTROL_MASK)):
-             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
-            print self.tag_store.display_str()
-            return True  # NO event propagation
-        # Ctrl-l -> print selection
-        elif( (event.keyval == gtk.keysyms.l or event.keyval == gtk.keysyms.L)
-             #and (event.state == gtk.gdk.CONTROL_MASK)):
-             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
-            print self.tag_store.get_selected_tag()
-            return True  # NO event propagation
-        # Ctrl-z -> clear selection
-        elif( (event.keyval == gtk.keysyms.z or event.keyval == gtk.keysyms.Z)
-             #and (event.state == gtk.gdk.CONTROL_MASK)):
-             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
-            print self.tag_store.clean_selected()
-            return True  # NO event propagation
-        # Ctrl-f -> print str_path
-        elif( (event.keyval == gtk.keysyms.f or event.keyval == gtk.keysyms.F)
-             #and (event.state == gtk.gdk.CONTROL_MASK)):
-             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
-            print self.print_strpath()
-            return True  # NO event propagation
-        # Ctrl-b -> print tag_set
-        elif( (event.keyval == gtk.keysyms.b or event.keyval == gtk.keysyms.B)
-             #and (event.state == gtk.gdk.CONTROL_MASK)):
-             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
-            print self.print_tag_set()
-            return True  # NO event propagation
-        # Ctrl-h -> HelpDialog
-        elif( (event.keyval == gtk.keysyms.h or event.keyval == gtk.keysyms.H)
-             #and (event.state == gtk.gdk.CONTROL_MASK)):
-             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
-            self.help_message()
-            return True  # NO event propagation
-        
-        return False #event propagation
-    # ------------------------------------------------------------------------------
-    # ---------------------------------------------------------- __on_title0_clicked
-    def __on_title0_clicked(self, widget, *args ):
-        """
-        Toggle between expand all and none, according to status of first element.
-        """
-        if self.treeview.row_expanded( (0,) ):
-            self.treeview.collapse_all()
-        else:
-            self.treeview.expand_all()
-    # ------------------------------------------------------------------------------
-    # ---------------------------------------------------------- __on_title1_clicked
-    def __on_title1_clicked(self, widget, *args ):
-        """
-        Toggle between all toggled or None, according to first element.
+    # sec -------------------------------------------------------------------- init
+    TERM = 'TERM'
+    AND = 'AND'
+    OR = 'OR'
+    NOT = 'NOT'
+    CONST = 'CONST'
+    TOKEN = re.compile( r'\s*(?:([()])|([^\s()]+))' )
+    def __init__(self, query, tag_data, statistics=None):
         """
-        status = self.tag_store.tag_treestore.get_value( self.tag_store.tag_treestore.iter_children(None), 1)
-        if status :
-            self.tag_store.clean_selected()
-        else:
-            self.tag_store.select_all()
-    # ------------------------------------------------------------------------------
-    # ------------------------------------------------------------- __on_cell_edited
-    def __on_cell_edited(self, cell, path, new_text, user_data):
+        :Throws:
+        - TagData_QueryWarning if 'query' is not well formed
         """
-        Called when a cell has been edited. Set its status to non-editable.
-
-        :Param:
-        - cell: (not used) cell edited
-        - path: path to the treestore node edited
-        - new_text: new value of the node
-        - user_data: (not used)
+        self.query = query
+        self.tag_data = tag_data
+        self.statistics = statistics
+        self.tree = self.parse( query )
+        self.plan = None
+        self.revision = None
 
+    # sec ------------------------------------------------------------------- parse
+    def parse(self, query):
         """
-        iter = self.tag_store.tag_treestore.get_iter(path)
-        # print "Cell edited : ",new_text
-        # set cell new value if valid value
-        try:
-            self.tag_store.update_check_unique( iter, new_text )
-        except TagData_UnicityWarning as warn:
-            dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
-                                gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
-                                ("Ok", gtk.RESPONSE_OK))
-            dialog.vbox.pack_start(gtk.Label( warn.__str__() ))
-            dialog.show_all()
-            result = dialog.run()
-            dialog.destroy()
-
-        # and cannot be edited any more
-        self.tag_store.tag_treestore.set_value(iter, 2, False)
-        return False #allow event propagation
-
-    # ------------------------------------------------------------------------------
-    # ------------------------------------------------------------ __on_cell_toggled
-    def __on_cell_toggled(self, cell, path, user_data):
-        """
-        Called when a cell status has been changed.
-        
-        DRAFT: intelligent way to access data for changing state of button.
+        Parse 'query' by recursive descent.
 
-        :Param:
-        - cell: (not used) cell edited
-        - path: path to the treestore node edited
-        - user_data: model,column
-        """
-        model, column = user_data
-        model[path][column] = not model[path][column]
-        return False #allow event propagation
-
-    # ------------------------------------------------------------------------------
-    # ---------------------------------------------------------------------      ???
-    def __on_button_press_event(self, treeview, event):
-        """
-        Not used ???
-        """
-        if event.button == 3:
-            x = int(event.x)
-            y = int(event.y)
-            time = event.time
-            pthinfo = treeview.get_path_at_pos(x, y)
-            if pthinfo is not None:
-                path, col, cellx, celly = pthinfo
-                treeview.grab_focus()
-                treeview.set_cursor( path, col, 0)
-                self.popup.popup( None, None, None, event.button, time)
-                return 1
-
-    def __cb_action_load(self, *args ):
-        """
-        Open a FileDialogManager to choose a file to load tag_data from.
-        """
-        load_dialog = gtk.FileChooserDialog( title='Open TagData',
-                                             parent=self.get_toplevel(),
-                                             action=gtk.FILE_CHOOSER_ACTION_OPEN,
-                                             buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT, gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
-        answer = load_dialog.run()
-        print "FileDialogLoad answer = ",answer
-        if answer == gtk.RESPONSE_ACCEPT :
-            self.tag_store.load( load_dialog.get_filename() )
-        load_dialog.destroy()
-    def __cb_action_save(self, *args ):
-        """
-        If self.tag_store has already a filename, try to save using it.
-        If not, ask for a filename.
-        """
-        if( self.tag_store.filename is None ):
-            save_dialog = gtk.FileChooserDialog( title='Save TagData',
-                                                 parent=self.get_toplevel(),
-                                                 action=gtk.FILE_CHOOSER_ACTION_SAVE,
-                                                 buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT, gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
-            # confirm if already exists
-            save_dialog.set_do_overwrite_confirmation( True )
-            answer = save_dialog.run()
-            print "FileDialogSave answer =",answer
-            if answer == gtk.RESPONSE_ACCEPT :
-                self.tag_store.write( save_dialog.get_filename() )
-            save_dialog.destroy()
+        :Returns:
+        - syntax tree of tuples (TERM, pattern), (NOT, tree), (AND, [trees])
+          and (OR, [trees])
+        """
+        self.tokens = []
+        position = 0
+        query = query.rstrip()
+        while position < len(query):
+            match = self.TOKEN.match( query, position )
+            group = match.lastindex
+            self.tokens.append( (match.group( group ), match.start( group )) )
+            position = match.end()
+        self.next_token = 0
+        tree = self.parse_or()
+        if self.next_token < len(self.tokens):
+            self.parse_error( 'unexpected %s' % self.tokens[self.next_token][0] )
+        return tree
+    def parse_error(self, message):
+        if self.next_token < len(self.tokens):
+            column = self.tokens[self.next_token][1]
         else:
-            print "Saving as ", self.tag_store.filename
-            self.tag_store.write( self.tag_store.filename )
-    def __cb_action_save_as(self, *args ):
-        """
-        Ask for a filename and save, with confirmation if already exists.
-        """
-        save_dialog = gtk.FileChooserDialog( title='Save TagData',
-                                             parent=self.get_toplevel(),
-                                             action=gtk.FILE_CHOOSER_ACTION_SAVE,
-                                             buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT, gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
-            # confirm if already exists
-        save_dialog.set_do_overwrite_confirmation( True )
-        answer = save_dialog.run()
-        print "FileDialogSave answer =",answer
-        if answer == gtk.RESPONSE_ACCEPT :
-            self.tag_store.write( save_dialog.get_filename() )
-        save_dialog.destroy()
-    def __cb_action_add(self, *args ):
-        """
-        Add a nexw tag as sibling.
-        """
-        self.add_sibling_tag()
-    def __cb_action_delete(self, *args ):
-        """
-        Delete the current tag.
-        """
-        self.delete_tag()
-    def __cb_action_help(self, *args ):
-        """
-        Dialog with Key Bindings;
+            column = len(self.query)
+        raise TagData_QueryWarning( '%s at column %d of query: %s'
+                                    % (message, column + 1, self.query) )
+    def peek(self):
+        if self.next_token < len(self.tokens):
+            return self.tokens[self.next_token][0]
+        return None
+    def parse_or(self):
+        trees = [self.parse_and()]
+        while self.peek() == self.OR:
+            self.next_token += 1
+            trees.append( self.parse_and() )
+        if len(trees) == 1:
+            return trees[0]
+        return (self.OR, trees)
+    def parse_and(self):
+        trees = [self.parse_not()]
+        while self.peek() == self.AND:
+            self.next_token += 1
+            trees.append( self.parse_not() )
+        if len(trees) == 1:
+            return trees[0]
+        return (self.AND, trees)
+    def parse_not(self):
+        token = self.peek()
+        if token == self.NOT:
+            self.next_token += 1
+            return (self.NOT, self.parse_not())
+        if token == '(':
+            self.next_token += 1
+            tree = self.parse_or()
+            if self.peek() != ')':
+                self.parse_error( 'missing )' )
+            self.next_token += 1
+            return tree
+        if token is None or token in (')', self.AND, self.OR):
+            self.parse_error( 'expected a tag' )
+        self.next_token += 1
+        return (self.TERM, token)
+
+    # sec ----------------------------------------------------------------- compile
+    def compile(self):
+        """
+        Make the plan of the query for the current revision of the tree.
+        """
+        self.hierarchy = self.tag_data.hierarchy_index()
+        self.revision = (self.tag_data.revision,
+                         getattr(self.statistics, 'revision', None))
+        self.plan = self.make_plan( self.tree )
+    def check_compiled(self):
+        """
+        Compile the query if never done or if the tree has changed since.
+        """
+        if self.plan is None or self.revision != \
+                (self.tag_data.revision, getattr(self.statistics, 'revision', None)):
+            self.compile()
+    def probability(self, pattern, node):
         """
-        self.help_message()
-    # sec ------------------------------------------------------------------ actions
-    def insert_tag(self):
+        :Return:
+        - estimated probability for an image to have a keyword under 'node'
+        """
+        if self.statistics is not None:
+            return self.statistics.count_under( pattern ) / float( max(1, len(self.statistics)) )
+        return (self.hierarchy.last[node] - self.hierarchy.first[node]) \
+            / float( max(1, len(self.hierarchy.order) - 1) )
+    def make_plan(self, tree):
+        op = tree[0]
+        if op == self.TERM:
+            node = self.tag_data.pattern_node( tree[1] )
+            if node is None:
+                return [self.CONST, 0.0, 0.0, False]
+            return [self.TERM, self.probability( tree[1], node ), 1.0,
+                    (tree[1], self.hierarchy.first[node], self.hierarchy.last[node])]
+        if op == self.NOT:
+            plan = self.make_plan( tree[1] )
+            if plan[0] == self.CONST:
+                return [self.CONST, 1.0 - plan[1], 0.0, not plan[3]]
+            return [self.NOT, 1.0 - plan[1], plan[2], plan]
+        # AND stops on the first false term, OR on the first true one
+        stop_on = (op == self.OR)
+        plans = []
+        for plan in [self.make_plan( subtree ) for subtree in tree[1]]:
+            if plan[0] != self.CONST:
+                plans.append( plan )
+            elif plan[3] == stop_on:
+                return [self.CONST, plan[1], 0.0, stop_on]
+        if not plans:
+            return [self.CONST, float(not stop_on), 0.0, not stop_on]
+        def stop_probability(plan):
+            if stop_on:
+                return plan[1]
+            return 1.0 - plan[1]
+        plans.sort( key=lambda plan: plan[2] / max(stop_probability( plan ), 1e-9) )
+        cost = 0.0
+        go_on = 1.0
+        for plan in plans:
+            cost += go_on * plan[2]
+            go_on *= 1.0 - stop_probability( plan )
+        if len(plans) == 1:
+            return plans[0]
+        return [op, float(stop_on) + (1.0 - 2 * stop_on) * go_on, cost, plans]
+
+    # sec ------------------------------------------------------------------ match
+    def matches(self, keyword_list):
         """
-        DRAFT: test how to retrieve selection list from treeview
-        and insert new elements to tree that can be edited.
-
-        If no row selected, a tag '_New_' is added to the root of the tree.
-        If one row is selected, a tag '_New_' is added and can be edited.
-        If more than one row is selected, nothing happens.
+        :Return:
+        - True if the image with keywords 'keyword_list' (tags or their ids)
+          is selected by the query
         """
-        # print "** insert_tag**"
-        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
-        if( len(pathlist) == 0):
-            # print "Adding to Root"
-            try:
-                iter_added = self.tag_store.add_check_unique( None, "_New_" )
-                path_added = self.tag_store.tag_treestore.get_path( iter_added )
-                self.treeview.set_cursor(path_added, self.tvcolumn0, start_editing=True)
-            except TagData_UnicityWarning as warn:
-                dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
-                                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
-                                    ("Ok", gtk.RESPONSE_OK))
-                dialog.vbox.pack_start(gtk.Label(warn.__str__()))
-                dialog.show_all()
-                result = dialog.run()
-                dialog.destroy()
-        elif( len(pathlist) == 1):
-            # print "Insert possible"
-            try:
-                iter_added = self.tag_store.add_check_unique( self.tag_store.tag_treestore.get_iter(pathlist[0]), "_New_" )
-                self.treeview.expand_row(pathlist[0], False)
-                self.treeview.set_cursor(self.tag_store.tag_treestore.get_path(iter_added), self.tvcolumn0, start_editing=True)
-            except TagData_UnicityWarning as warn:
-                dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
-                                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
-                                    ("Ok", gtk.RESPONSE_OK))
-                dialog.vbox.pack_start(gtk.Label(warn.__str__()))
-                dialog.show_all()
-                result = dialog.run()
-                dialog.destroy()
-        else:
-            # print "More than one selection"
-            pass
-    def add_sibling_tag(self):
+        self.check_compiled()
+        first = self.hierarchy.first
+        positions = sorted( [first[node] for node in self.tag_data.ids( keyword_list )
+                             if node is not None] )
+        return self.evaluate( self.plan, positions )
+    def evaluate(self, plan, positions):
         """
-        DRAFT: test how to retrieve selection list from treeview
-        and insert new elements to tree that can be edited.
-
-        If no row selected, a tag '_New_' is added to the root of the tree.
-        If one row is selected, a tag '_New_' is added as a sibling 
-        and can be edited.
-        If more than one row is selected, nothing happens.
+        :Return:
+        - value of 'plan' for the sorted preorder 'positions' of the keywords
+        """
+        op = plan[0]
+        if op == self.TERM:
+            pattern, first, last = plan[3]
+            index = bisect_left( positions, first )
+            return index < len(positions) and positions[index] < last
+        if op == self.AND:
+            for subplan in plan[3]:
+                if not self.evaluate( subplan, positions ):
+                    return False
+            return True
+        if op == self.OR:
+            for subplan in plan[3]:
+                if self.evaluate( subplan, positions ):
+                    return True
+            return False
+        if op == self.NOT:
+            return not self.evaluate( plan[3], positions )
+        return plan[3]
+
+    def explain(self):
         """
-        # print "** insert_tag**"
-        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
-        if( len(pathlist) == 0):
-            # print "Adding to Root"
-            try:
-                iter_added = self.tag_store.add_check_unique( None, "_New_" )
-                path_added = self.tag_store.tag_treestore.get_path( iter_added )
-                self.treeview.set_cursor(path_added, self.tvcolumn0, start_editing=True)
-            except TagData_UnicityWarning as warn:
-                dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
-                                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
-                                    ("Ok", gtk.RESPONSE_OK))
-                dialog.vbox.pack_start(gtk.Label(warn.__str__()))
-                dialog.show_all()
-                result = dialog.run()
-                dialog.destroy()
-        elif( len(pathlist) == 1):
-            # print "Insert possible"
-            try:
-                iter_added = self.tag_store.add_sibling_check_unique( self.tag_store.tag_treestore.get_iter(pathlist[0]), "_New_" )
-                self.treeview.expand_row(pathlist[0], False)
-                self.treeview.set_cursor(self.tag_store.tag_treestore.get_path(iter_added), self.tvcolumn0, start_editing=True)
-            except TagData_UnicityWarning as warn:
-                dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
-                                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
-                                    ("Ok", gtk.RESPONSE_OK))
-                dialog.vbox.pack_start(gtk.Label(warn.__str__()))
-                dialog.show_all()
-                result = dialog.run()
-                dialog.destroy()
-        else:
-            # print "More than one selection"
-            pass
-    def edit_tag(self):
-        """
-        DRAFT: edit a tag if only one row is selected
-        """
-        # print "** edit_tag**"
-        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
-        if( len(pathlist) == 1):
-            # print "Editing possible"
-            iter = self.tag_store.tag_treestore.get_iter(pathlist[0])
-            path = self.tag_store.tag_treestore.get_path(iter)
-            # set editable
-            self.tag_store.tag_treestore.set_value(iter,2,True)
-            self.treeview.set_cursor(path, self.tvcolumn0, start_editing=True)
-        else:
-            # print "Not one selection"
-            pass
-
-    def delete_tag(self):
-        """
-        DRAFT: ask before deleting all tags selected.
-        """
-        # print "** delete_tag**"
-        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
-        if( len(pathlist) >= 1 ):
-            #ask confirmation by dialog
-            dialog = gtk.Dialog('Suppress Tags ?', self.get_toplevel(),
-                                gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
-                                ("Ok", gtk.RESPONSE_OK, "Cancel", gtk.RESPONSE_CANCEL))
-            dialog.vbox.pack_start(gtk.Label('On supprime VRAIMENT tout Ã§a ?'))
-            dialog.show_all()
-            result = dialog.run()
-            if result == gtk.RESPONSE_OK:
-                iter_list = []
-                for path in pathlist:
-                    iter_list.append(self.tag_store.tag_treestore.get_iter(path))
-                for iter in iter_list:
-                    self.tag_store.remove( iter )
-            dialog.destroy()
-
-    def print_strpath(self):
-        """
-        DRAFT : print full strPath of selected nodes
-        """
-        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
-        if( len(pathlist) >= 1 ):
-            for path in pathlist:
-                print self.tag_store.strpath_from_path( path )
-
-    def print_tag_set(self):
-        """
-        DEBUG: print the set of 'unique' tags
-        """
-        print self.tag_store.tag_set
-    def help_message(self):
-        # Create dialog if needed
-        help_dialog = gtk.MessageDialog( parent= self.get_toplevel(),
-                                         flags=gtk.DIALOG_DESTROY_WITH_PARENT,
-            message_format="Insert or Ctrl-i -> insert new tag as child\n" \
-                "Ctrl-j -> insert new tag, brother\n" \
-                "Delete or Ctrl-x -> delete_tag\n" \
-                "Ctrl-e -> edit tag\n" \
-                "Ctrl-l -> print selection\n" \
-                "Ctrl-z -> clear selection\n" \
-                "Ctrl-f -> print str_path\n" \
-                "Ctrl-b -> print tag_set\n" \
-                "Ctlr-h -> this help"
-            )
-        help_dialog.set_title( "Shortcut for TagTree" )
-        help_dialog.show_all()
-
+        :Return:
+        - the plan, one line by node, in the order of evaluation, with the
+          estimated probability and cost
+        """
+        self.check_compiled()
+        lines = []
+        stack = [(self.plan, 0)]
+        while stack:
+            plan, depth = stack.pop()
+            op, p, cost, args = plan
+            if op == self.TERM:
+                label = args[0]
+            elif op == self.CONST:
+                label = str(args)
+            else:
+                label = op
+            lines.append( '%s%-*s p=%.4f cost=%.2f'
+                          % ('  ' * depth, max(1, 30 - 2 * depth), label, p, cost) )
+            if op == self.NOT:
+                stack.append( (args, depth + 1) )
+            elif op in (self.AND, self.OR):
+                stack.extend( [(subplan, depth + 1) for subplan in reversed(args)] )
+        return '\n'.join( lines )
 
 # **********************************************************************************
 
 # **********************************************************************************
-# ************************************************************************** TagData
+# ***************************************************************** TagKeywordMatrix
 # **********************************************************************************
-class TagDataApplication(object):
+class TagKeywordMatrix(object):
     """
-    Basic application for testing TagDataTree.
+    The keyword lists of many images, in a compressed sparse row (CSR) layout
+    of numpy arrays, the keywords being encoded as nodes of a TagDataTree :
+    - indptr : the keywords of image i are at indices[indptr[i]:indptr[i+1]]
+    - indices : node of each keyword, -1 if the keyword is not in the tree
+    - rows : image of each keyword
+
+    Nodes do not change when tags are added or renamed, so a matrix can be
+    used with all the searches on the same tree.
     """
     # sec --------------------------------------------------------------------- init
-    def __init__(self):
-        # Create a new window
-        self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
-
-        self.window.set_title("Basic TreeView Example")
+    def __init__(self, keyword_lists, tag_data):
+        """
+        :Params:
+        - keyword_lists : a list of keyword lists (tags or their ids), one
+          by image
+        - tag_data : the TagDataTree the keywords come from
+        """
+        import numpy
+        lengths = numpy.fromiter( (len(keyword_list) for keyword_list in keyword_lists),
+                                  dtype=numpy.int64, count=len(keyword_lists) )
+        self.indptr = numpy.zeros( len(keyword_lists)+1, dtype=numpy.int64 )
+        numpy.cumsum( lengths, out=self.indptr[1:] )
+        self.indices = numpy.fromiter( (-1 if node is None else node
+                                        for keyword_list in keyword_lists
+                                        for node in tag_data.ids( keyword_list )),
+                                       dtype=numpy.int64, count=self.indptr[-1] )
+        self.rows = numpy.repeat( numpy.arange(len(keyword_lists)), lengths )
+    def nb_images(self):
+        return len(self.indptr) - 1
 
-        self.window.set_size_request(200, 600)
-        self.window.connect("delete_event", self.delete_event)
+# **********************************************************************************
+# ******************************************************************* TagSearchCache
+# **********************************************************************************
+class TagSearchCache(object):
+    """
+    Results of a TagDataSearch, {keyword : found}, for one revision of the
+    TagDataTree : asking with another revision empties the cache.
+    At most 'maxsize' results are kept, the least recently used are evicted.
 
-        # Create data by loading file
-        tag_store = TagDataTree("data/tag_data.xml")
+    hits, misses, evictions : statistics since creation.
+    """
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.revision = None
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-        self.tag_gadget = TagDataGadget( tag_store )
-        self.tag_gadget.show()
-        self.window.add(self.tag_gadget)
-        self.window.show_all()
+    # sec ------------------------------------------------------------------- access
+    def get(self, key, revision):
+        """
+        :Return:
+        - the result for 'key' at 'revision' of the tree, None if not known
+        """
+        if revision != self.revision:
+            self.results.clear()
+            self.revision = revision
+        try:
+            # most recently used go at the end
+            value = self.results.pop( key )
+        except KeyError:
+            self.misses += 1
+            return None
+        self.results[key] = value
+        self.hits += 1
+        return value
+    def put(self, key, value):
+        """
+        Store a result, for the revision of the last 'get'.
+        """
+        self.results[key] = value
+        if len(self.results) > self.maxsize:
+            self.results.popitem( last=False )
+            self.evictions += 1
+    def clear(self):
+        self.results.clear()
+        self.revision = None
+    def __len__(self):
+        return len(self.results)
+    def __contains__(self, key):
+        return key in self.results
 
-    def delete_event(self, widget, event, data=None):
+    # sec ---------------------------------------------------------------------- str
+    def stats(self):
         """
-        Close the window and quit.
+        :Return:
+        - a dictionary with size, maxsize, hits, misses and evictions
         """
-        gtk.main_quit()
-        return False
+        return {'size' : len(self.results), 'maxsize' : self.maxsize,
+                'hits' : self.hits, 'misses' : self.misses,
+                'evictions' : self.evictions}
+    def __str__(self):
+        return str(dict(self.results))
 # **********************************************************************************
 
 # **********************************************************************************
-# ************************************************************************* TagGLADE
+# ********************************************************************* TagDataProbe
 # **********************************************************************************
-class TagGLADE(object):
-    """
+class TagDataProbe(object):
     """
+    Instrumentation for TagDataSearch and TagDataTree, given as their 'probe'.
+    - counters : {name : count}, e.g. 'cache_hit', 'cache_miss' of tag_searched
+    - timings : {name : [nb of calls, total time, max time]} in seconds
+    - histograms : {name : [nb of calls for each bound of HISTOGRAM_MS]}
+    - events : list of (name, details...) if 'trace' is True
 
+    'trace' can also be a function, called as trace(name, *details) for every
+    event. Events are only counted when not traced.
+
+    With a 'budget' (in seconds), a time longer than it is an 'over_budget'
+    event (name, elapsed), and kept in 'slow' as (name, elapsed, date).
+    """
+    # upper bounds of the buckets of the histograms, in ms
+    HISTOGRAM_MS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, float('inf'))
     # sec --------------------------------------------------------------------- init
-    def __init__(self ):
+    def __init__(self, trace=False, budget=None):
+        self.counters = {}
+        self.timings = {}
+        self.histograms = {}
+        self.events = []
+        self.trace = trace
+        self.budget = budget
+        self.slow = []
+
+    # sec ------------------------------------------------------------------ measure
+    def count(self, name, nb=1):
+        self.counters[name] = self.counters.get(name, 0) + nb
+    def event(self, name, *details):
+        """
+        Count an event, and trace it if asked for.
+        """
+        self.counters[name] = self.counters.get(name, 0) + 1
+        if self.trace is True:
+            self.events.append( (name,) + details )
+        elif self.trace:
+            self.trace( name, *details )
+    def add_time(self, name, elapsed):
+        timing = self.timings.get(name)
+        if timing is None:
+            self.timings[name] = [1, elapsed, elapsed]
+            self.histograms[name] = [0] * len(self.HISTOGRAM_MS)
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max( timing[2], elapsed )
+        self.histograms[name][bisect_left( self.HISTOGRAM_MS, 1000.0 * elapsed )] += 1
+        if self.budget is not None and elapsed > self.budget:
+            self.slow.append( (name, elapsed, time.time()) )
+            self.event( 'over_budget', name, elapsed )
+    def timed(self, name, function):
+        """
+        :Return:
+        - 'function' wrapped so that every call is timed under 'name'
+        """
+        def timed_function(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time( name, time.time() - start )
+        timed_function.__name__ = function.__name__
+        timed_function.__doc__ = function.__doc__
+        return timed_function
+
+    # sec ------------------------------------------------------------------ summary
+    def summary(self):
+        """
+        :Return:
+        - a dictionary with counters and timings, ready for json
+        """
+        timings = {}
+        for name, (nb, total, longest) in self.timings.items():
+            histogram = dict( zip( self.histogram_labels(), self.histograms[name] ))
+            timings[name] = {'calls' : nb, 'total' : total,
+                             'mean' : total / nb, 'max' : longest,
+                             'histogram' : histogram}
+        summary = {'counters' : self.counters, 'timings' : timings}
+        if self.budget is not None:
+            summary['budget'] = self.budget
+            summary['slow'] = self.slow
+        return summary
+    def histogram_labels(self):
+        """
+        :Return:
+        - the names of the buckets of the histograms, '<1ms' ... '>1024ms'
+        """
+        bounds = self.HISTOGRAM_MS
+        return ['<%dms' % bound for bound in bounds[:-1]] + ['>%dms' % bounds[-2]]
+    def dump_str(self):
+        dump_str = ""
+        for name in sorted(self.counters):
+            dump_str += "%-20s %10d\n" % (name, self.counters[name])
+        for name in sorted(self.timings):
+            nb, total, longest = self.timings[name]
+            dump_str += "%-20s %10d calls, total %.3f s, mean %.3f ms, max %.3f ms\n" % (
+                name, nb, total, 1000.0 * total / nb, 1000.0 * longest)
+            dump_str += "%20s %s\n" % ('', ' '.join(
+                ['%s:%d' % (label, count)
+                 for label, count in zip(self.histogram_labels(), self.histograms[name])
+                 if count > 0] ))
+        if self.budget is not None:
+            dump_str += "%d calls over %.1f ms\n" % (len(self.slow), 1000.0 * self.budget)
+            for name, elapsed, date in self.slow[-20:]:
+                dump_str += "  %s %-20s %.3f ms\n" % (
+                    time.strftime( '%H:%M:%S', time.localtime(date) ), name, 1000.0 * elapsed)
+        return dump_str
+    def write(self, filename):
         """
-        Read XML UI file and create.
+        Export the summary to a json file.
         """
-        builder = gtk.Builder()
-        builder.add_from_file( "tag_data.glade" )
+        summary_file = open( filename, 'w' )
+        try:
+            json.dump( self.summary(), summary_file, indent=2, sort_keys=True )
+        finally:
+            summary_file.close()
+# **********************************************************************************
 
-        self.tag_data_frame = builder.get_object( "tag_data_frame" )
-        self.tag_data_treeview = builder.get_object( "tag_data_treeview" )
 # **********************************************************************************
-            
+# ****************************************************************** TagData_Warning
+# **********************************************************************************
+class TagData_UnicityWarning(UserWarning):
+    """
+    Raised when trying to insert an existing tag to the TagData.
+    """
+    pass
+class TagData_HierarchyWarning(UserWarning):
+    """
+    Raised when trying to move a tag under itself.
+    """
+    pass
+class TagData_FormatWarning(UserWarning):
+    """
+    Raised when a file is not a snapshot, or not of a known version.
+    """
+    pass
+class TagData_CancelledWarning(UserWarning):
+    """
+    Raised when a load or write running in a worker thread is cancelled.
+    """
+    pass
+class TagData_QueryWarning(UserWarning):
+    """
+    Raised when a query of TagDataQuery is not well formed.
+    """
+    pass
+# **********************************************************************************
 
 
 # sec ******************************************************************************
-def main():
-    gtk.main()
-
 def test_basic():
     print "*** test_basic()"
     data = TagDataTree()
@@ -1069,63 +2664,65 @@ def test_search():
     print data.dump_str();
 
     print "Selected ", data.get_selected_tag()
-    search = TagDataSearch( data.get_selected_tag(), data )
+    probe = TagDataProbe( trace=True )
+    search = TagDataSearch( data.get_selected_tag(), data, probe )
 
     l_test = [['Bob'], ['Marcel'], ['Bob','Marcel'], ['Bob','Nature'], ['Bob','Montagne'], ['Bob','Montagne','Lac'], ['Marcel','Foret','Lac']]
     for k in l_test:
         #print "Look for all in ", k, " ", search.look_for_all_in( k )
         print "Is matched by ", k, " ", search.is_matched_by( k )
-    print "searched : ",search.tag_searched
-   
-
-def test_gtk():
-    appligtk = TagDataApplication()
-    try:
-        main()
-    except TagData_UnicityWarning:
-        #ask confirmation by dialog
-        dialog = gtk.Dialog('Doublon in Tags', appligth.window.get_toplevel(),
-                            gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
-                            ("Ok", gtk.RESPONSE_OK))
-        #dialog.vbox.pack_start(gtk.Label('On supprime VRAIMENT tout ça ?'))
-        dialog.show_all()
-        result = dialog.run()
-        dialog.destroy()
+    print "searched : ",search.tag_searched, search.tag_searched.stats()
+    print "events : ", probe.events
+    print probe.dump_str()
 
+def test_query():
+    print "*** test_query()"
+    data = TagDataTree()
+    data.build_example()
+    query = TagDataQuery( ".Gens.Bob AND (.Nature.Lac OR Foret) AND NOT Marcel", data )
+    print query.explain()
+    l_test = [['Bob'], ['Bob','Lac'], ['Bob','Marcel','Lac'], ['Bob','Foret'], ['Lac']]
+    for k in l_test:
+        print "Matches ", k, " ", query.matches( k )
+   
 
-def test_glade():
-    def cb_destroy(widget, data=None):
-        """
-        Destroy main window, ie: self
-        """
-        gtk.main_quit();
-    
-    # get data
-    tag_data = TagDataTree()
-    tag_data.build_example()
+def test_journal():
+    print "*** test_journal()"
+    directory = tempfile.mkdtemp()
+    db_file_name = os.path.join( directory, "tag_data.xml" )
+    data = TagDataTree()
+    data.build_example()
+    data.write( db_file_name )
+    data = TagDataTree( db_file_name )
+    journal = TagDataJournal( data, db_file_name )
+    gens = data.tag_id['Gens']
+    data.add_check_unique( gens, 'Ana', 0 )
+    # forward move within the same parent : [Ana, Bob, Marcel] -> [Bob, Ana, Marcel]
+    data.move( data.tag_id['Ana'], gens, 2 )
+    data.move( data.tag_id['Lac'], gens, 0 )
+    data.update_check_unique( data.tag_id['Foret'], 'Bois' )
+    data.set_selected( data.tag_id['Bois'], True )
+    data.remove( data.tag_id['Marcel'] )
+    journal.close()
+    print data.dump_str()
+    replayed = TagDataTree( db_file_name )
+    TagDataJournal( replayed, db_file_name ).close()
+    print replayed.dump_str()
+    lines = "".join( data.iter_lines( columns=(0, 1) ) )
+    print "Same tags ", "".join( replayed.iter_lines( columns=(0, 1) ) ) == lines
+    shutil.rmtree( directory )
 
-    # Need a high level window
-    main_window = gtk.Window()
-    # Connect destroy event
-    main_window.connect( 'destroy', cb_destroy )
-    
-    # Get UI from glade
-    tag_data_glade = TagGLADE()
-    # connect to our treestore
-    tag_data_glade.tag_data_treeview.set_model( tag_data.tag_treestore )
-    main_window.add( tag_data_glade.tag_data_frame )
-    
-    main_window.show_all()
-    gtk.main()
+def test_gtk():
+    import tag_data_gtk
+    tag_data_gtk.test_gtk()
 
-    
 # sec ************************************************************************* MAIN
 if __name__ == "__main__":
     #test_basic()
     #test_load()
     #test_search()
+    #test_journal()
     test_gtk()
-    # test_glade()
 
 
 # sec ************************************************************************** END
@@ -0,0 +1,1486 @@
+# tag_data_gtk.py
+# -*- coding: utf-8 -*-
+"""
+GTK user interface for the tags of tag_data.
+
+Kept apart from tag_data so that batch tools using TagDataTree and
+TagDataSearch never import gtk.
+"""
+__docformat__ = "restructuredtext en"
+
+import atexit
+import os
+import gtk
+import gobject
+import threading
+from contextlib import contextmanager
+from tag_data import TagDataTree, TagXMLLoader, TagDataJournal, TagFinder, \
+    TagDataProbe, is_snapshot, write_outside_journal
+from tag_data import TagData_UnicityWarning, TagData_HierarchyWarning, \
+    TagData_CancelledWarning
+
+# loads and writes run in worker threads
+gobject.threads_init()
+
+# **********************************************************************************
+# ***************************************************************** TagDataTreeStore
+# **********************************************************************************
+class TagDataTreeStore(object):
+    """
+    Mirror a TagDataTree into a gtk.TreeStore, only needed when a UI is attached.
+    It observes the TagDataTree and reflects every change.
+
+    Columns of 'self.treestore' are : tag, selected, editable, node
+    where 'node' is the index of the node in the TagDataTree.
+    'self.node_iter' is a dictionary {node : gtk.TreeIter}
+    """
+    NODE_COLUMN = 3
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, tag_data):
+        """
+        :Param:
+        - tag_data: a TagDataTree
+        """
+        self.tag_data = tag_data
+        self.treestore = gtk.TreeStore(str, 'gboolean', 'gboolean', int)
+        self.node_iter = {}
+        self.rec_append( None, tag_data.get_children(None) )
+        tag_data.add_observer( self )
+    def detach(self):
+        """
+        Stop mirroring the TagDataTree.
+        """
+        self.tag_data.remove_observer( self )
+    def get_model(self):
+        """
+        :Return:
+        - the gtk.TreeModel to give to a gtk.TreeView
+        """
+        return self.treestore
+
+    def row(self, node):
+        tag_node = self.tag_data.tag_nodes[node]
+        return (tag_node.tag, tag_node.selected, tag_node.editable, node)
+    def rec_append(self, iter, nodes):
+        """
+        Append rows for 'nodes' (and their subnodes) as children of 'iter'.
+        """
+        for node in nodes:
+            iter_added = self.treestore.append( iter, self.row(node) )
+            self.node_iter[node] = iter_added
+            self.rec_append( iter_added, self.tag_data.get_children(node) )
+
+    # sec ------------------------------------------------------------ path <-> node
+    def node_from_path(self, path):
+        return self.treestore[path][self.NODE_COLUMN]
+    def path_from_node(self, node):
+        return self.treestore.get_path( self.node_iter[node] )
+
+    # sec ---------------------------------------------------------------- observer
+    def on_tag_added(self, node):
+        parent = self.tag_data.get_parent( node )
+        position = self.tag_data.get_children( parent ).index( node )
+        self.node_iter[node] = self.treestore.insert( self.node_iter.get(parent),
+                                                      position, self.row(node) )
+    def on_tag_changed(self, node):
+        tag_node = self.tag_data.tag_nodes[node]
+        self.treestore.set( self.node_iter[node], 0, tag_node.tag,
+                            1, tag_node.selected, 2, tag_node.editable )
+    def on_tag_moved(self, node):
+        """
+        The rows of the subtree, still at the old place, are removed and
+        added back at the new place.
+        """
+        self.on_tag_removed( node )
+        self.on_tag_added( node )
+        self.rec_append( self.node_iter[node], self.tag_data.get_children(node) )
+    def on_tag_removed(self, node):
+        iter = self.node_iter[node]
+        stack = [node]
+        while stack:
+            index = stack.pop()
+            del self.node_iter[index]
+            stack.extend( self.tag_data.get_children(index) )
+        self.treestore.remove( iter )
+    def on_tags_reset(self):
+        """
+        After a bulk_edit : copy the whole tree again.
+        """
+        for done in self.iter_reset():
+            pass
+    def iter_reset(self, step=1000):
+        """
+        Copy the whole tree again, in preorder, pausing every 'step' rows
+        (see TagDataGadget.load_async). The TagDataTree must not change
+        meanwhile.
+        """
+        self.treestore.clear()
+        self.node_iter = {}
+        done = 0
+        stack = [(None, iter( self.tag_data.get_children(None) ))]
+        while stack:
+            for node in stack[-1][1]:
+                iter_added = self.treestore.append( stack[-1][0], self.row(node) )
+                self.node_iter[node] = iter_added
+                stack.append( (iter_added, iter( self.tag_data.get_children(node) )) )
+                done += 1
+                if done % step == 0:
+                    yield done
+                break
+            else:
+                stack.pop()
+# **********************************************************************************
+
+# **********************************************************************************
+# ***************************************************************** TagDataTreeModel
+# **********************************************************************************
+class TagDataTreeModel(gtk.GenericTreeModel):
+    """
+    A gtk.TreeModel reading the TagDataTree itself, instead of copying it into
+    a gtk.TreeStore : nothing is built for a tag until the TreeView asks for
+    it, that is when its parent is expanded. Same columns and same interface
+    (get_model, node_from_path, path_from_node, detach) as TagDataTreeStore.
+
+    The rows (gtk 'rowref') are the nodes of the TagDataTree, which persist
+    while the tag is in the tree. It observes the TagDataTree and emits the
+    row signals.
+
+    'self.positions' is a cache {parent : {child : position}} for the
+    current revision of the tree.
+    'self.hidden' are the nodes being removed or moved : the TreeView is told
+    about the deletion before the TagDataTree is changed, so they must
+    already be gone from the model. Valid for 'self.hidden_revision' only.
+    'self.nb_roots' is the number of top level rows the TreeView knows, the
+    ones to delete on a reset. During a reset, only the first 'self.roots_shown'
+    top level rows are in the model.
+    """
+    NODE_COLUMN = 3
+    COLUMN_TYPES = (str, bool, bool, int)
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, tag_data):
+        """
+        :Param:
+        - tag_data: a TagDataTree
+        """
+        gtk.GenericTreeModel.__init__(self)
+        self.tag_data = tag_data
+        self.positions = {}
+        self.positions_revision = tag_data.revision
+        self.hidden = set()
+        self.hidden_revision = tag_data.revision
+        self.nb_roots = len(tag_data.get_children(None))
+        self.roots_shown = None
+        tag_data.add_observer( self )
+    def detach(self):
+        """
+        Stop following the TagDataTree.
+        """
+        self.tag_data.remove_observer( self )
+    def get_model(self):
+        return self
+
+    # sec ------------------------------------------------------------------- access
+    def children(self, node):
+        """
+        :Return:
+        - the children of 'node' (ROOT for root) seen by the TreeView.
+        """
+        if self.roots_shown is not None and node == TagDataTree.ROOT:
+            return self.tag_data.tag_nodes[node].children[:self.roots_shown]
+        children = self.tag_data.tag_nodes[node].children
+        if self.hidden:
+            if self.hidden_revision != self.tag_data.revision:
+                self.hidden = set()
+            else:
+                return [child for child in children if child not in self.hidden]
+        return children
+    def position(self, node):
+        """
+        :Return:
+        - position of 'node' among the children of its parent
+        """
+        parent = self.tag_data.tag_nodes[node].parent
+        children = self.children( parent )
+        if children and children[-1] == node:
+            return len(children) - 1
+        if self.hidden:
+            return children.index( node )
+        if self.positions_revision != self.tag_data.revision:
+            self.positions = {}
+            self.positions_revision = self.tag_data.revision
+        positions = self.positions.get( parent )
+        if positions is None:
+            # also right for the first 'roots_shown' roots
+            positions = dict( [(child, index) for index, child
+                               in enumerate(self.tag_data.tag_nodes[parent].children)] )
+            self.positions[parent] = positions
+        return positions[node]
+
+    # sec ------------------------------------------------------------ path <-> node
+    def node_from_path(self, path):
+        if isinstance(path, basestring):
+            path = [int(index) for index in path.split(':')]
+        return self.on_get_iter( path )
+    def path_from_node(self, node):
+        return self.on_get_path( node )
+
+    # sec ---------------------------------------------------------- GenericTreeModel
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_ITERS_PERSIST
+    def on_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+    def on_get_column_type(self, column):
+        return self.COLUMN_TYPES[column]
+    def on_get_iter(self, path):
+        node = TagDataTree.ROOT
+        for index in path:
+            children = self.children( node )
+            if index >= len(children):
+                return None
+            node = children[index]
+        return node
+    def on_get_path(self, node):
+        path = []
+        while node != TagDataTree.ROOT:
+            path.append( self.position( node ) )
+            node = self.tag_data.tag_nodes[node].parent
+        path.reverse()
+        return tuple(path)
+    def on_get_value(self, node, column):
+        tag_node = self.tag_data.tag_nodes[node]
+        if column == 0:
+            return tag_node.tag
+        elif column == 1:
+            return tag_node.selected
+        elif column == 2:
+            return tag_node.editable
+        return node
+    def on_iter_next(self, node):
+        children = self.children( self.tag_data.tag_nodes[node].parent )
+        position = self.position( node ) + 1
+        if position < len(children):
+            return children[position]
+        return None
+    def on_iter_children(self, node):
+        if node is None:
+            node = TagDataTree.ROOT
+        children = self.children( node )
+        if children:
+            return children[0]
+        return None
+    def on_iter_has_child(self, node):
+        return len(self.children( node )) > 0
+    def on_iter_n_children(self, node):
+        if node is None:
+            node = TagDataTree.ROOT
+        return len(self.children( node ))
+    def on_iter_nth_child(self, node, n):
+        if node is None:
+            node = TagDataTree.ROOT
+        children = self.children( node )
+        if 0 <= n < len(children):
+            return children[n]
+        return None
+    def on_iter_parent(self, node):
+        parent = self.tag_data.tag_nodes[node].parent
+        if parent == TagDataTree.ROOT:
+            return None
+        return parent
+
+    # sec ---------------------------------------------------------------- observer
+    def on_tag_added(self, node):
+        path = self.on_get_path( node )
+        self.row_inserted( path, self.create_tree_iter(node) )
+        if self.tag_data.tag_nodes[node].children:
+            # a moved subtree, its rows are there when expanded
+            self.row_has_child_toggled( path, self.create_tree_iter(node) )
+        parent = self.tag_data.tag_nodes[node].parent
+        if parent == TagDataTree.ROOT:
+            self.nb_roots += 1
+        elif len(self.children( parent )) == 1:
+            parent_path = self.on_get_path( parent )
+            self.row_has_child_toggled( parent_path, self.create_tree_iter(parent) )
+    def on_tag_changed(self, node):
+        path = self.on_get_path( node )
+        self.row_changed( path, self.create_tree_iter(node) )
+    def on_tag_moving(self, node):
+        self.on_tag_removed( node )
+    def on_tag_moved(self, node):
+        self.hidden.discard( node )
+        self.on_tag_added( node )
+    def on_tag_removed(self, node):
+        path = self.on_get_path( node )
+        if self.hidden_revision != self.tag_data.revision:
+            self.hidden = set()
+            self.hidden_revision = self.tag_data.revision
+        self.hidden.add( node )
+        self.row_deleted( path )
+        parent = self.tag_data.tag_nodes[node].parent
+        if parent == TagDataTree.ROOT:
+            self.nb_roots -= 1
+        elif not self.children( parent ):
+            parent_path = self.on_get_path( parent )
+            self.row_has_child_toggled( parent_path, self.create_tree_iter(parent) )
+    def on_tags_reset(self):
+        """
+        After a bulk_edit : delete all the top level rows the TreeView knows,
+        then insert the new ones, their children are read when expanded.
+        """
+        self.hidden = set()
+        self.roots_shown = 0
+        try:
+            for position in reversed(xrange(self.nb_roots)):
+                self.row_deleted( (position,) )
+            roots = self.tag_data.get_children(None)
+            for position, node in enumerate(roots):
+                self.roots_shown = position + 1
+                self.row_inserted( (position,), self.create_tree_iter(node) )
+                if self.tag_data.tag_nodes[node].children:
+                    self.row_has_child_toggled( (position,), self.create_tree_iter(node) )
+        finally:
+            self.roots_shown = None
+            self.nb_roots = len(self.tag_data.get_children(None))
+    def iter_reset(self, step=1000):
+        """
+        As TagDataTreeStore.iter_reset, but only the top level rows are
+        made, at once.
+        """
+        self.on_tags_reset()
+        yield self.nb_roots
+# **********************************************************************************
+
+# **********************************************************************************
+# ******************************************************************** TagDataWorker
+# **********************************************************************************
+class TagDataWorker(object):
+    """
+    Run 'work' in a thread, and 'done( worker )' in the gtk main loop when
+    it is over, with 'self.error' the exception raised by 'work' (None if
+    none, a TagData_CancelledWarning if cancelled).
+
+    'work' must only use objects no other thread changes : a TagDataTree
+    being loaded or a copy of one.
+    'loader' is what can tell its progress() and be cancel(), or 'progress'
+    is a function giving the fraction done.
+    """
+    POLL_MS = 100
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, kind, work, done, loader=None, progress=None):
+        self.kind = kind
+        self.work = work
+        self.done = done
+        self.loader = loader
+        if loader is not None:
+            progress = loader.progress
+        self.progress = progress
+        self.error = None
+        self.cancelled = False
+        self.thread = threading.Thread( target=self.run )
+        self.thread.daemon = True
+    def start(self, progress_bar=None):
+        """
+        Start the thread, and follow it every POLL_MS ms, showing its
+        progress in 'progress_bar'.
+        """
+        self.progress_bar = progress_bar
+        self.thread.start()
+        gobject.timeout_add( self.POLL_MS, self.poll )
+    def run(self):
+        try:
+            self.work()
+        except Exception as error:
+            self.error = error
+    def cancel(self):
+        self.cancelled = True
+        if self.loader is not None:
+            self.loader.cancel()
+    def poll(self):
+        if self.thread.is_alive():
+            if self.progress_bar is not None:
+                fraction = None
+                if self.progress is not None:
+                    fraction = self.progress()
+                if fraction is None:
+                    self.progress_bar.pulse()
+                else:
+                    self.progress_bar.set_fraction( fraction )
+            return True
+        self.done( self )
+        return False
+# **********************************************************************************
+
+# **********************************************************************************
+# ******************************************************************** TagDataGadget
+# **********************************************************************************
+class TagDataGadget(gtk.Frame):
+    """
+    A GTK Frame to manage TagDataTree.
+
+    Beyond LAZY_SIZE tags, or when asked with 'lazy', the TreeView reads the
+    TagDataTree through a TagDataTreeModel instead of a copy in a
+    TagDataTreeStore, and expanding all the tags is done EXPAND_STEP rows at
+    a time when gtk is idle.
+
+    Loads and writes run in a TagDataWorker thread (see load_async and
+    write_async), with a progress bar and a cancel button.
+
+    The search entry above the tags shows only the FIND_SIZE tags found by a
+    TagFinder as the user types, with their ancestors, through a
+    gtk.TreeModelFilter. The tags added meanwhile are shown too.
+
+    probe : optional TagDataProbe timing the event handlers and action
+            callbacks (TIMED_HANDLERS) as 'gadget.xxx'. Ctrl-d prints it.
+            Made with a budget (e.g. FRAME_BUDGET), it keeps the handlers
+            that blocked the main loop longer. Nothing is measured when None.
+    """
+    LAZY_SIZE = 5000
+    EXPAND_STEP = 200
+    FIND_SIZE = 100
+    # a frame at 60 Hz, in seconds
+    FRAME_BUDGET = 0.016
+    TIMED_HANDLERS = ('__on_key_press_event', '__on_cell_edited',
+                      '__on_cell_toggled', '__on_title0_clicked',
+                      '__on_title1_clicked', '__on_drag_data_received',
+                      '__on_search_changed', '__cb_action_load',
+                      '__cb_action_save', '__cb_action_save_as',
+                      '__cb_action_add', '__cb_action_delete',
+                      '__cb_action_help')
+    # sec --------------------------------------------------------------------- init
+    def __init__(self, tag_data=None, lazy=None, probe=None):
+        """
+        :Param:
+        - tag_data: a TagDataTree
+        - lazy: use a TagDataTreeModel, None to decide by the number of tags
+        - probe: a TagDataProbe, to time the handlers
+        """
+        gtk.Frame.__init__(self)
+        # the handlers are timed before being connected
+        self.probe = probe
+        if probe is not None:
+            for name in self.TIMED_HANDLERS:
+                attribute = '_TagDataGadget' + name
+                setattr( self, attribute, probe.timed( 'gadget.'+name.strip('_'),
+                                                       getattr(self, attribute) ))
+        self.list_actions = []
+        self.init_actions()
+
+        # store tag_data, and mirror it in a treestore or follow it lazily
+        self.tag_store = tag_data
+        if lazy is None:
+            lazy = len(tag_data.tag_id) > self.LAZY_SIZE
+        self.lazy = lazy
+        if lazy:
+            self.tag_mirror = TagDataTreeModel( tag_data )
+        else:
+            self.tag_mirror = TagDataTreeStore( tag_data )
+        self.expand_source = None
+        # TagDataWorker running, and the last load or write asked meanwhile
+        self.worker = None
+        self.pending = None
+        # made at the first search
+        self.finder = None
+        self.filter = None
+        # nodes shown while searching, with the ones from 'visible_from'
+        self.visible = None
+        self.visible_from = 0
+        
+        # create the TreeView using treestore
+        self.treeview = gtk.TreeView(self.tag_mirror.get_model())
+        # allow the selection of more than one row
+        self.treeview.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
+        # allow reordring of elements, moves are done by the TagDataTree
+        self.treeview.set_reorderable( True )
+        self.treeview.connect("drag-data-received", self.__on_drag_data_received)
+        # can click on header
+        # listen for some keyboard events
+        self.treeview.add_events(gtk.gdk.KEY_PRESS_MASK)
+        self.treeview.connect("key-press-event", self.__on_key_press_event)
+
+        # create the TreeViewColumn to display the tags
+        self.tvcolumn0 = gtk.TreeViewColumn('Mot clef')
+        self.tvcolumn0.set_fixed_width( 40 )
+        self.tvcolumn0.set_expand( True )
+        self.tvcolumn0.set_clickable( True )
+        self.tvcolumn0.connect( 'clicked', self.__on_title0_clicked )
+        # create a CellRendererText to render the tags
+        self.text_cell = gtk.CellRendererText()
+        #self.text_cell.set_property('editable', True)
+        self.text_cell.connect('edited', self.__on_cell_edited, self.tag_mirror.get_model())
+        # add the cell to the tvcolumn and allow it to expand
+        self.tvcolumn0.pack_start(self.text_cell, True)
+        # set the cell "text" attribute to column 0 - retrieve text
+        # from that column in treestore
+        # and its editable capacity from column 2
+        self.tvcolumn0.add_attribute(self.text_cell, 'text', 0)
+        self.tvcolumn0.add_attribute(self.text_cell, 'editable', 2)
+
+        # The toggle cellrenderer is setup and we allow it to be
+        # changed (toggled) by the user.
+        self.toggle_cell = gtk.CellRendererToggle()
+        self.toggle_cell.set_property('activatable', True)
+        self.toggle_cell.connect( 'toggled', self.__on_cell_toggled,
+                                  (self.tag_mirror.get_model(), 1))
+        # The columns active state is attached to the second column
+        # in the model.  So when the model says True then the button
+        # will show as active e.g on.
+        self.tvcolumn1 = gtk.TreeViewColumn("Selection", self.toggle_cell )
+        self.tvcolumn1.add_attribute( self.toggle_cell, "active", 1)
+        self.tvcolumn1.set_clickable( True )
+        self.tvcolumn1.connect( 'clicked', self.__on_title1_clicked )
+
+        # add columns
+        self.treeview.append_column( self.tvcolumn0 )
+        self.treeview.append_column( self.tvcolumn1 ) 
+
+        self.treeview.show()
+
+        # put it all into a scrolled window
+        self.scroll_window = gtk.ScrolledWindow(hadjustment=None, vadjustment=None)
+        # with always a vertical scrollbar
+        self.scroll_window.set_policy(hscrollbar_policy=gtk.POLICY_AUTOMATIC,
+                                      vscrollbar_policy=gtk.POLICY_ALWAYS)
+        self.scroll_window.add_with_viewport( self.treeview )
+        self.scroll_window.show()
+
+        # progress of loads and writes, only shown while one runs
+        self.progress_bar = gtk.ProgressBar()
+        self.cancel_button = gtk.Button( stock=gtk.STOCK_CANCEL )
+        self.cancel_button.connect( 'clicked', self.__on_cancel_clicked )
+        self.status_box = gtk.HBox()
+        self.status_box.pack_start( self.progress_bar, True, True )
+        self.status_box.pack_start( self.cancel_button, False, False )
+        self.status_box.set_no_show_all( True )
+        self.progress_bar.show()
+        self.cancel_button.show()
+
+        # type-ahead search, Escape to show all the tags again
+        self.search_entry = gtk.Entry()
+        self.search_entry.connect( 'changed', self.__on_search_changed )
+        self.search_entry.connect( 'key-press-event', self.__on_search_key_press )
+        self.search_entry.show()
+
+        vbox = gtk.VBox()
+        vbox.pack_start( self.search_entry, False, False )
+        vbox.pack_start( self.scroll_window, True, True )
+        vbox.pack_start( self.status_box, False, False )
+        vbox.show()
+        self.add( vbox )
+    def init_actions(self):
+        # load
+        action_load = gtk.Action('tag_data_load', label='Load Tag',
+                                 tooltip='Load hierarchy of Tags',
+                                      stock_id=gtk.STOCK_OPEN)
+        action_load.connect( 'activate', self.__cb_action_load )
+        self.list_actions.append( action_load )
+        # save
+        action_save = gtk.Action('tag_data_save', label='Save Tag',
+                                 tooltip='Save hierarchy of Tags',
+                                      stock_id=gtk.STOCK_SAVE)
+        action_save.connect( 'activate', self.__cb_action_save )
+        self.list_actions.append( action_save )
+        # save_as
+        action_save_as = gtk.Action('tag_data_save_as', label='Save Tag As',
+                                    tooltip='Save hierarchy of Tags',
+                                    stock_id=gtk.STOCK_SAVE)
+        action_save_as.connect( 'activate', self.__cb_action_save_as )
+        self.list_actions.append( action_save_as )
+        # add (as a sibling)
+        action_add = gtk.Action( 'add_tag', label='Add Tag',
+                                 tooltip='Add a sibling Tag',
+                                 stock_id=gtk.STOCK_ADD)
+        action_add.connect( 'activate', self.__cb_action_add )
+        self.list_actions.append( action_add )
+        # delete tag
+        action_delete = gtk.Action( 'delete_tag', label='Delete Tag',
+                                    tooltip='Delete Tag',
+                                    stock_id=gtk.STOCK_DELETE)
+        action_delete.connect( 'activate', self.__cb_action_delete )
+        self.list_actions.append( action_delete )
+        # help
+        action_help =  gtk.Action( 'help_tag', label='Help Tags',
+                                    tooltip='Key bindings about Tags',
+                                    stock_id=gtk.STOCK_HELP)
+        action_help.connect( 'activate', self.__cb_action_help )
+        self.list_actions.append( action_help )
+    def delete_event(self, widget, event, data=None):
+        gtk.main_quit()
+        return False
+
+    # sec ----------------------------------------------------------------- callback
+    def __on_key_press_event(self, widget, event):
+        """
+        :Warning: With MacOS, may change 
+        and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)
+        to
+        and (event.state == gtk.gdk.CONTROL_MASK)
+        """
+        # keyval is in gtk.keysyms.Insert (par exemple)
+        # print "TagDataGadget __on_key_press_event"
+        # print "event.keyval =",event.keyval
+        # print "event.string =",event.string
+        # print "event.state =", event.state, event.state.__class__
+        # print "Ctrl ? =", (event.state & gtk.gdk.CONTROL_MASK)
+        # print "event.group =",event.group
+        # print event
+        # Insert or Ctrl-i -> insert new tag
+        if( event.keyval == gtk.keysyms.Insert or 
+            ((event.keyval == gtk.keysyms.i or event.keyval == gtk.keysyms.I)
+             #and (event.state == gtk.gdk.CONTROL_MASK))):
+            and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK))):
+            self.insert_tag()
+            return True  # NO event propagation
+        # Ctr-j -> add as simbling
+        elif( (event.keyval == gtk.keysyms.j or event.keyval == gtk.keysyms.J)
+              #and (event.state == gtk.gdk.CONTROL_MASK)):
+              and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            self.add_sibling_tag()
+            return True  # NO event propagation
+        # Delete or Ctrl-x -> delete_tag
+        elif( event.keyval == gtk.keysyms.Delete or
+            ((event.keyval == gtk.keysyms.x or event.keyval == gtk.keysyms.X)
+             #and (event.state == gtk.gdk.CONTROL_MASK))):
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK))):
+            self.delete_tag()
+            return True  # NO event propagation
+        # Ctrl-e -> edit tag
+        elif( (event.keyval == gtk.keysyms.e or event.keyval == gtk.keysyms.E)
+             #and (event.state == gtk.gdk.CONTROL_MASK)):
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            self.edit_tag()
+            return True  # NO event propagation
+        # Ctrl-p -> print_tree
+        elif( (event.keyval == gtk.keysyms.p or  event.keyval == gtk.keysyms.P)
+             #and (event.state == gtk.gdk.CONTROL_MASK)):
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            self.tag_store.write_dump( lines=self.tag_store.iter_lines() )
+            return True  # NO event propagation
+        # Ctrl-l -> print selection
+        elif( (event.keyval == gtk.keysyms.l or event.keyval == gtk.keysyms.L)
+             #and (event.state == gtk.gdk.CONTROL_MASK)):
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            print self.tag_store.get_selected_tag()
+            return True  # NO event propagation
+        # Ctrl-z -> clear selection
+        elif( (event.keyval == gtk.keysyms.z or event.keyval == gtk.keysyms.Z)
+             #and (event.state == gtk.gdk.CONTROL_MASK)):
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            self.select( self.tag_store.clean_selected,
+                         len(self.tag_store.selected_nodes) )
+            return True  # NO event propagation
+        # Ctrl-t -> (un)select tag and subtags
+        elif( (event.keyval == gtk.keysyms.t or event.keyval == gtk.keysyms.T)
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            self.select_subtree()
+            return True  # NO event propagation
+        # Ctrl-f -> print str_path
+        elif( (event.keyval == gtk.keysyms.f or event.keyval == gtk.keysyms.F)
+             #and (event.state == gtk.gdk.CONTROL_MASK)):
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            print self.print_strpath()
+            return True  # NO event propagation
+        # Ctrl-b -> print tag_set
+        elif( (event.keyval == gtk.keysyms.b or event.keyval == gtk.keysyms.B)
+             #and (event.state == gtk.gdk.CONTROL_MASK)):
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            print self.print_tag_set()
+            return True  # NO event propagation
+        # Ctrl-d -> print timings of the handlers
+        elif( (event.keyval == gtk.keysyms.d or event.keyval == gtk.keysyms.D)
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            if self.probe is not None:
+                print self.probe.dump_str()
+            return True  # NO event propagation
+        # Ctrl-k -> search tags
+        elif( (event.keyval == gtk.keysyms.k or event.keyval == gtk.keysyms.K)
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            self.search_entry.grab_focus()
+            return True  # NO event propagation
+        # Ctrl-h -> HelpDialog
+        elif( (event.keyval == gtk.keysyms.h or event.keyval == gtk.keysyms.H)
+             #and (event.state == gtk.gdk.CONTROL_MASK)):
+             and (event.state & gtk.gdk.CONTROL_MASK == gtk.gdk.CONTROL_MASK)):
+            self.help_message()
+            return True  # NO event propagation
+        
+        return False #event propagation
+    # ------------------------------------------------------------------------------
+    # ---------------------------------------------------------- __on_title0_clicked
+    def __on_title0_clicked(self, widget, *args ):
+        """
+        Toggle between expand all and none, according to status of first element.
+        """
+        if self.expand_source is not None or self.treeview.row_expanded( (0,) ):
+            self.collapse_all()
+        else:
+            self.expand_all()
+    # ------------------------------------------------------------------------------
+    # ---------------------------------------------------------- __on_title1_clicked
+    def __on_title1_clicked(self, widget, *args ):
+        """
+        Toggle between all toggled or None, according to first element.
+        """
+        roots = self.tag_store.get_children(None)
+        if len(roots) == 0:
+            return
+        if self.tag_store.is_selected( roots[0] ):
+            self.select( self.tag_store.clean_selected,
+                         len(self.tag_store.selected_nodes) )
+        else:
+            self.select( self.tag_store.select_all,
+                         len(self.tag_store.tag_id) - len(self.tag_store.selected_nodes) )
+    # ------------------------------------------------------------------------------
+    # ------------------------------------------------------------- __on_cell_edited
+    def __on_cell_edited(self, cell, path, new_text, user_data):
+        """
+        Called when a cell has been edited. Set its status to non-editable.
+
+        :Param:
+        - cell: (not used) cell edited
+        - path: path to the treestore node edited
+        - new_text: new value of the node
+        - user_data: (not used)
+
+        """
+        node = self.node_from_path(path)
+        # print "Cell edited : ",new_text
+        # set cell new value if valid value
+        try:
+            self.tag_store.update_check_unique( node, new_text )
+        except TagData_UnicityWarning as warn:
+            dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
+                                gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                                ("Ok", gtk.RESPONSE_OK))
+            dialog.vbox.pack_start(gtk.Label( warn.__str__() ))
+            dialog.show_all()
+            result = dialog.run()
+            dialog.destroy()
+
+        # and cannot be edited any more
+        self.tag_store.set_editable(node, False)
+        return False #allow event propagation
+
+    # ------------------------------------------------------------------------------
+    # ------------------------------------------------------------ __on_cell_toggled
+    def __on_cell_toggled(self, cell, path, user_data):
+        """
+        Called when a cell status has been changed.
+        
+        DRAFT: intelligent way to access data for changing state of button.
+
+        :Param:
+        - cell: (not used) cell edited
+        - path: path to the treestore node edited
+        - user_data: model,column
+        """
+        node = self.node_from_path(path)
+        self.tag_store.set_selected( node, not self.tag_store.is_selected(node) )
+        return False #allow event propagation
+
+    # ------------------------------------------------------------------------------
+    # ------------------------------------------------------- __on_drag_data_received
+    def __on_drag_data_received(self, treeview, context, x, y, selection, info, etime):
+        """
+        Called when a row is dropped. Instead of letting the treestore copy
+        the rows, the node is moved in the TagDataTree (which keeps tag_set
+        up to date), and the mirror follows.
+        """
+        treeview.emit_stop_by_name( 'drag-data-received' )
+        model, source_path = selection.tree_get_row_drag_data()
+        node = self.node_from_path( source_path )
+        drop_info = treeview.get_dest_row_at_pos(x, y)
+        if drop_info is None:
+            # on the void, at the end
+            parent, position = None, None
+        else:
+            dest_path, drop_position = drop_info
+            dest_node = self.node_from_path( dest_path )
+            if( drop_position == gtk.TREE_VIEW_DROP_INTO_OR_BEFORE or
+                drop_position == gtk.TREE_VIEW_DROP_INTO_OR_AFTER ):
+                parent, position = dest_node, 0
+            else:
+                parent = self.tag_store.get_parent( dest_node )
+                position = self.tag_store.get_children( parent ).index( dest_node )
+                if drop_position == gtk.TREE_VIEW_DROP_AFTER:
+                    position += 1
+        try:
+            self.tag_store.move( node, parent, position )
+        except TagData_HierarchyWarning:
+            context.finish( False, False, etime )
+            return
+        context.finish( True, False, etime )
+        if parent is not None:
+            treeview.expand_to_path( self.path_from_node(node) )
+
+    # ------------------------------------------------------------------------------
+    # ---------------------------------------------------------------------      ???
+    def __on_button_press_event(self, treeview, event):
+        """
+        Not used ???
+        """
+        if event.button == 3:
+            x = int(event.x)
+            y = int(event.y)
+            time = event.time
+            pthinfo = treeview.get_path_at_pos(x, y)
+            if pthinfo is not None:
+                path, col, cellx, celly = pthinfo
+                treeview.grab_focus()
+                treeview.set_cursor( path, col, 0)
+                self.popup.popup( None, None, None, event.button, time)
+                return 1
+
+    def __cb_action_load(self, *args ):
+        """
+        Open a FileDialogManager to choose a file to load tag_data from.
+        """
+        load_dialog = gtk.FileChooserDialog( title='Open TagData',
+                                             parent=self.get_toplevel(),
+                                             action=gtk.FILE_CHOOSER_ACTION_OPEN,
+                                             buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT, gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
+        answer = load_dialog.run()
+        print "FileDialogLoad answer = ",answer
+        if answer == gtk.RESPONSE_ACCEPT :
+            self.load_async( load_dialog.get_filename() )
+        load_dialog.destroy()
+    def __cb_action_save(self, *args ):
+        """
+        If self.tag_store has already a filename, try to save using it.
+        If not, ask for a filename.
+        """
+        if( self.tag_store.filename is None ):
+            save_dialog = gtk.FileChooserDialog( title='Save TagData',
+                                                 parent=self.get_toplevel(),
+                                                 action=gtk.FILE_CHOOSER_ACTION_SAVE,
+                                                 buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT, gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
+            # confirm if already exists
+            save_dialog.set_do_overwrite_confirmation( True )
+            answer = save_dialog.run()
+            print "FileDialogSave answer =",answer
+            if answer == gtk.RESPONSE_ACCEPT :
+                self.write_async( save_dialog.get_filename() )
+            save_dialog.destroy()
+        else:
+            print "Saving as ", self.tag_store.filename
+            self.write_async( self.tag_store.filename )
+    def __cb_action_save_as(self, *args ):
+        """
+        Ask for a filename and save, with confirmation if already exists.
+        """
+        save_dialog = gtk.FileChooserDialog( title='Save TagData',
+                                             parent=self.get_toplevel(),
+                                             action=gtk.FILE_CHOOSER_ACTION_SAVE,
+                                             buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT, gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
+            # confirm if already exists
+        save_dialog.set_do_overwrite_confirmation( True )
+        answer = save_dialog.run()
+        print "FileDialogSave answer =",answer
+        if answer == gtk.RESPONSE_ACCEPT :
+            self.write_async( save_dialog.get_filename() )
+        save_dialog.destroy()
+    def __on_cancel_clicked(self, *args ):
+        """
+        Cancel the load or write running, and the one asked meanwhile.
+        """
+        self.pending = None
+        if self.worker is not None:
+            self.worker.cancel()
+    def __on_search_changed(self, entry):
+        self.search( entry.get_text() )
+    def __on_search_key_press(self, entry, event):
+        if event.keyval == gtk.keysyms.Escape:
+            entry.set_text( '' )
+            self.treeview.grab_focus()
+            return True  # NO event propagation
+        return False #event propagation
+    def __filter_visible(self, model, iter):
+        node = model.get_value( iter, self.tag_mirror.NODE_COLUMN )
+        return node in self.visible or node >= self.visible_from
+    def __cb_action_add(self, *args ):
+        """
+        Add a nexw tag as sibling.
+        """
+        self.add_sibling_tag()
+    def __cb_action_delete(self, *args ):
+        """
+        Delete the current tag.
+        """
+        self.delete_tag()
+    def __cb_action_help(self, *args ):
+        """
+        Dialog with Key Bindings;
+        """
+        self.help_message()
+    # sec ------------------------------------------------------------------- search
+    def search(self, text):
+        """
+        Show only the tags found for 'text' by the TagFinder, and their
+        ancestors, all expanded. Show all the tags if 'text' is empty.
+        """
+        if not text:
+            if self.visible is not None:
+                self.visible = None
+                self.treeview.set_model( self.tag_mirror.get_model() )
+            return
+        if self.finder is None:
+            self.finder = TagFinder( self.tag_store )
+        visible = set()
+        for node in self.finder.find( text, self.FIND_SIZE ):
+            while node != TagDataTree.ROOT and node not in visible:
+                visible.add( node )
+                node = self.tag_store.get_parent( node )
+        self.visible = visible
+        self.visible_from = len(self.tag_store.tag_nodes)
+        self.cancel_expand()
+        if self.filter is None:
+            self.filter = self.tag_mirror.get_model().filter_new()
+            self.filter.set_visible_func( self.__filter_visible )
+        # refilter without the TreeView, then show all the rows found
+        self.treeview.set_model( None )
+        self.filter.refilter()
+        self.treeview.set_model( self.filter )
+        self.treeview.expand_all()
+    def node_from_path(self, path):
+        """
+        :Return:
+        - the node of 'path' in the TreeView, searching or not
+        """
+        if self.visible is not None:
+            if isinstance(path, str):
+                path = tuple( [int(index) for index in path.split(':')] )
+            path = self.filter.convert_path_to_child_path( path )
+        return self.tag_mirror.node_from_path( path )
+    def path_from_node(self, node):
+        """
+        :Return:
+        - the path of 'node' in the TreeView, None if hidden by the search
+        """
+        path = self.tag_mirror.path_from_node( node )
+        if self.visible is not None:
+            path = self.filter.convert_child_path_to_path( path )
+        return path
+
+    # sec ---------------------------------------------------------------- expansion
+    def expand_all(self):
+        """
+        Expand all the rows, at once for a TagDataTreeStore, by steps of
+        EXPAND_STEP rows when idle for a TagDataTreeModel (but at once
+        when searching, there are few rows).
+        """
+        self.cancel_expand()
+        if not self.lazy or self.visible is not None:
+            self.treeview.expand_all()
+            return
+        steps = self.iter_expand()
+        def expand_step():
+            try:
+                steps.next()
+                return True
+            except StopIteration:
+                self.expand_source = None
+                return False
+        self.expand_source = gobject.idle_add( expand_step )
+    def iter_expand(self):
+        """
+        Expand, in preorder so that a parent is expanded before its children,
+        the rows having children. Pause every EXPAND_STEP rows.
+        """
+        tag_data = self.tag_store
+        stack = list(reversed(tag_data.get_children(None)))
+        done = 0
+        while stack:
+            node = stack.pop()
+            # the tree may have changed since the last step
+            if not tag_data.has_node( node ):
+                continue
+            children = tag_data.get_children( node )
+            if children:
+                self.treeview.expand_row( self.path_from_node(node), False )
+                stack.extend( reversed(children) )
+                done += 1
+                if done % self.EXPAND_STEP == 0:
+                    yield done
+    def cancel_expand(self):
+        """
+        Stop an expansion in progress.
+        """
+        if self.expand_source is not None:
+            gobject.source_remove( self.expand_source )
+            self.expand_source = None
+    def collapse_all(self):
+        self.cancel_expand()
+        self.treeview.collapse_all()
+
+    # sec ---------------------------------------------------------------- bulk edit
+    @contextmanager
+    def bulk_edit(self):
+        """
+        Context manager for many changes at once : the model is taken away
+        from the TreeView, so that no row is drawn, and the TagDataTree is in
+        bulk_edit. The model is rebuilt once and given back at the end, with
+        the rows that were expanded and still exist.
+        """
+        model = self.treeview.get_model()
+        if model is None:
+            # already in a bulk_edit
+            with self.tag_store.bulk_edit():
+                yield self
+            return
+        self.cancel_expand()
+        expanded = []
+        self.treeview.map_expanded_rows(
+            lambda treeview, path: expanded.append( self.node_from_path(path) ))
+        self.treeview.set_model( None )
+        try:
+            with self.tag_store.bulk_edit():
+                yield self
+        finally:
+            self.treeview.set_model( model )
+            for node in expanded:
+                if self.tag_store.has_node( node ):
+                    path = self.path_from_node( node )
+                    # unless hidden by the search
+                    if path is not None:
+                        self.treeview.expand_to_path( path )
+
+    # sec ------------------------------------------------------------ load / write
+    def load_async(self, db_file_name):
+        """
+        Replace the tags by the ones of 'db_file_name' (XML or snapshot),
+        read by a worker thread into a new TagDataTree. The rows are then
+        made when gtk is idle, APPLY_STEP at a time, with the TreeView
+        detached.
+        If a load is running, it is cancelled and only the last one asked
+        is done. If a write is running, the load waits for it.
+        """
+        if self.worker is not None:
+            self.pending = (self.load_async, db_file_name)
+            if self.worker.kind == 'load':
+                self.worker.cancel()
+            return
+        tag_data = TagDataTree()
+        if is_snapshot( db_file_name ):
+            loader = None
+            work = lambda : tag_data.load_snapshot( db_file_name )
+        else:
+            loader = TagXMLLoader( tag_data )
+            def work():
+                loader.parse_file( db_file_name )
+                tag_data.generation = loader.generation
+        def done(worker):
+            # a snapshot is not cancelled while read, but not used
+            if worker.error is None and not worker.cancelled:
+                # as TagDataTree.load leaves it
+                tag_data.filename = db_file_name
+                tag_data.to_save = False
+                self.apply_loaded( tag_data )
+            else:
+                self.end_worker()
+        self.start_worker( TagDataWorker( 'load', work, done, loader ),
+                           'Loading '+db_file_name )
+    APPLY_STEP = 2000
+    def apply_loaded(self, tag_data):
+        """
+        Give the loaded 'tag_data' to the TagDataTree, and make the rows of
+        the mirror when gtk is idle.
+        """
+        self.search_entry.set_text( '' )
+        self.cancel_expand()
+        self.cancel_button.set_sensitive( False )
+        self.progress_bar.set_text( 'Displaying '+str(tag_data.filename) )
+        self.treeview.set_model( None )
+        self.tag_mirror.detach()
+        self.tag_store.replace_by( tag_data )
+        nb_tags = max( 1, len(self.tag_store.tag_id) )
+        steps = self.tag_mirror.iter_reset( self.APPLY_STEP )
+        def apply_step():
+            try:
+                self.progress_bar.set_fraction( min(1.0, steps.next() / float(nb_tags)) )
+                return True
+            except StopIteration:
+                self.tag_store.add_observer( self.tag_mirror )
+                self.treeview.set_model( self.tag_mirror.get_model() )
+                self.end_worker()
+                return False
+        gobject.idle_add( apply_step )
+    def write_async(self, db_file_name):
+        """
+        Write the tags in 'db_file_name', from a copy of the TagDataTree, by
+        a worker thread. If a load or write is running, the write waits for
+        it, only the last one asked is done.
+        With a TagDataJournal on 'db_file_name', only the journal is synced.
+        """
+        journal = self.tag_store.journal
+        if journal is not None and journal.db_file_name == db_file_name:
+            journal.sync()
+            self.tag_store.to_save = False
+            return
+        if self.worker is not None:
+            self.pending = (self.write_async, db_file_name)
+            return
+        tag_data = self.tag_store.copy()
+        nb_tags = max( 1, len(tag_data.tag_id) )
+        # one chunk of XML for each tag, and each end of a tag with subtags
+        written = [0]
+        def chunks(generation):
+            for chunk in tag_data.iter_xml( generation ):
+                if worker.cancelled:
+                    raise TagData_CancelledWarning( 'writing '+db_file_name+' cancelled' )
+                written[0] += 1
+                yield chunk
+        work = lambda : write_outside_journal( db_file_name, tag_data.generation, chunks )
+        progress = lambda : min( 1.0, written[0] / (1.5 * nb_tags) )
+        def done(worker):
+            if worker.error is None:
+                self.tag_store.filename = db_file_name
+                if self.tag_store.revision == tag_data.revision:
+                    self.tag_store.to_save = False
+            self.end_worker()
+        worker = TagDataWorker( 'write', work, done, progress=progress )
+        self.start_worker( worker, 'Saving '+db_file_name )
+    def start_worker(self, worker, text):
+        self.worker = worker
+        self.progress_bar.set_text( text )
+        self.progress_bar.set_fraction( 0.0 )
+        self.cancel_button.set_sensitive( True )
+        self.status_box.show()
+        worker.start( self.progress_bar )
+    def end_worker(self):
+        """
+        Tell about the error of the worker, if any, then do what was asked
+        meanwhile.
+        """
+        worker = self.worker
+        self.worker = None
+        self.status_box.hide()
+        if worker.error is not None and \
+                not isinstance(worker.error, TagData_CancelledWarning):
+            dialog = gtk.Dialog('Error in Tags', self.get_toplevel(),
+                                gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                                ("Ok", gtk.RESPONSE_OK))
+            dialog.vbox.pack_start(gtk.Label( worker.error.__str__() ))
+            dialog.show_all()
+            result = dialog.run()
+            dialog.destroy()
+        if self.pending is not None:
+            action, db_file_name = self.pending
+            self.pending = None
+            action( db_file_name )
+
+    # sec ---------------------------------------------------------------- selection
+    def select(self, change, size):
+        """
+        Call 'change', a change of the selection of about 'size' tags, as a
+        bulk_edit of the gadget if the TagDataTree would do it as a bulk_edit.
+        """
+        if size > self.tag_store.BULK_SIZE:
+            with self.bulk_edit():
+                change()
+        else:
+            change()
+    def select_subtree(self):
+        """
+        Select the tags of the selected rows and all their subtags, or
+        unselect them if the first one is selected.
+        """
+        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
+        if len(pathlist) == 0:
+            return
+        nodes = [self.node_from_path(path) for path in pathlist]
+        status = not self.tag_store.is_selected( nodes[0] )
+        hierarchy = self.tag_store.hierarchy_index()
+        size = sum( [hierarchy.last[node] - hierarchy.first[node] for node in nodes] )
+        def change():
+            for node in nodes:
+                self.tag_store.select_subtree( node, status )
+        self.select( change, size )
+
+    # sec ------------------------------------------------------------------ actions
+    def insert_tag(self):
+        """
+        DRAFT: test how to retrieve selection list from treeview
+        and insert new elements to tree that can be edited.
+
+        If no row selected, a tag '_New_' is added to the root of the tree.
+        If one row is selected, a tag '_New_' is added and can be edited.
+        If more than one row is selected, nothing happens.
+        """
+        # print "** insert_tag**"
+        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
+        if( len(pathlist) == 0):
+            # print "Adding to Root"
+            try:
+                node_added = self.tag_store.add_check_unique( None, "_New_" )
+                path_added = self.path_from_node( node_added )
+                self.treeview.set_cursor(path_added, self.tvcolumn0, start_editing=True)
+            except TagData_UnicityWarning as warn:
+                dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
+                                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                                    ("Ok", gtk.RESPONSE_OK))
+                dialog.vbox.pack_start(gtk.Label(warn.__str__()))
+                dialog.show_all()
+                result = dialog.run()
+                dialog.destroy()
+        elif( len(pathlist) == 1):
+            # print "Insert possible"
+            try:
+                node_added = self.tag_store.add_check_unique( self.node_from_path(pathlist[0]), "_New_" )
+                self.treeview.expand_row(pathlist[0], False)
+                self.treeview.set_cursor(self.path_from_node(node_added), self.tvcolumn0, start_editing=True)
+            except TagData_UnicityWarning as warn:
+                dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
+                                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                                    ("Ok", gtk.RESPONSE_OK))
+                dialog.vbox.pack_start(gtk.Label(warn.__str__()))
+                dialog.show_all()
+                result = dialog.run()
+                dialog.destroy()
+        else:
+            # print "More than one selection"
+            pass
+    def add_sibling_tag(self):
+        """
+        DRAFT: test how to retrieve selection list from treeview
+        and insert new elements to tree that can be edited.
+
+        If no row selected, a tag '_New_' is added to the root of the tree.
+        If one row is selected, a tag '_New_' is added as a sibling 
+        and can be edited.
+        If more than one row is selected, nothing happens.
+        """
+        # print "** insert_tag**"
+        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
+        if( len(pathlist) == 0):
+            # print "Adding to Root"
+            try:
+                node_added = self.tag_store.add_check_unique( None, "_New_" )
+                path_added = self.path_from_node( node_added )
+                self.treeview.set_cursor(path_added, self.tvcolumn0, start_editing=True)
+            except TagData_UnicityWarning as warn:
+                dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
+                                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                                    ("Ok", gtk.RESPONSE_OK))
+                dialog.vbox.pack_start(gtk.Label(warn.__str__()))
+                dialog.show_all()
+                result = dialog.run()
+                dialog.destroy()
+        elif( len(pathlist) == 1):
+            # print "Insert possible"
+            try:
+                node_added = self.tag_store.add_sibling_check_unique( self.node_from_path(pathlist[0]), "_New_" )
+                self.treeview.expand_row(pathlist[0], False)
+                self.treeview.set_cursor(self.path_from_node(node_added), self.tvcolumn0, start_editing=True)
+            except TagData_UnicityWarning as warn:
+                dialog = gtk.Dialog('Doublon in Tags', self.get_toplevel(),
+                                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                                    ("Ok", gtk.RESPONSE_OK))
+                dialog.vbox.pack_start(gtk.Label(warn.__str__()))
+                dialog.show_all()
+                result = dialog.run()
+                dialog.destroy()
+        else:
+            # print "More than one selection"
+            pass
+    def edit_tag(self):
+        """
+        DRAFT: edit a tag if only one row is selected
+        """
+        # print "** edit_tag**"
+        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
+        if( len(pathlist) == 1):
+            # print "Editing possible"
+            node = self.node_from_path(pathlist[0])
+            # set editable
+            self.tag_store.set_editable(node, True)
+            self.treeview.set_cursor(pathlist[0], self.tvcolumn0, start_editing=True)
+        else:
+            # print "Not one selection"
+            pass
+
+    def delete_tag(self):
+        """
+        DRAFT: ask before deleting all tags selected.
+        """
+        # print "** delete_tag**"
+        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
+        if( len(pathlist) >= 1 ):
+            #ask confirmation by dialog
+            dialog = gtk.Dialog('Suppress Tags ?', self.get_toplevel(),
+                                gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                                ("Ok", gtk.RESPONSE_OK, "Cancel", gtk.RESPONSE_CANCEL))
+            dialog.vbox.pack_start(gtk.Label('On supprime VRAIMENT tout Ã§a ?'))
+            dialog.show_all()
+            result = dialog.run()
+            if result == gtk.RESPONSE_OK:
+                node_list = []
+                for path in pathlist:
+                    node_list.append(self.node_from_path(path))
+                # one by one, so that a journal records a remove for each
+                for node in node_list:
+                    # may already be gone with a selected ancestor
+                    if self.tag_store.has_node( node ):
+                        self.tag_store.remove( node )
+            dialog.destroy()
+
+    def print_strpath(self):
+        """
+        DRAFT : print full strPath of selected nodes
+        """
+        (model, pathlist) = self.treeview.get_selection().get_selected_rows()
+        if( len(pathlist) >= 1 ):
+            for path in pathlist:
+                print self.tag_store.strpath( self.node_from_path(path) )
+
+    def print_tag_set(self):
+        """
+        DEBUG: print the set of 'unique' tags
+        """
+        print self.tag_store.tag_set
+    def help_message(self):
+        # Create dialog if needed
+        help_dialog = gtk.MessageDialog( parent= self.get_toplevel(),
+                                         flags=gtk.DIALOG_DESTROY_WITH_PARENT,
+            message_format="Insert or Ctrl-i -> insert new tag as child\n" \
+                "Ctrl-j -> insert new tag, brother\n" \
+                "Delete or Ctrl-x -> delete_tag\n" \
+                "Ctrl-e -> edit tag\n" \
+                "Ctrl-l -> print selection\n" \
+                "Ctrl-z -> clear selection\n" \
+                "Ctrl-t -> (un)select tag and subtags\n" \
+                "Ctrl-f -> print str_path\n" \
+                "Ctrl-b -> print tag_set\n" \
+                "Ctrl-k -> search tags, Escape to show all\n" \
+                "Ctrl-d -> print timings (with PYXI_PROBE)\n" \
+                "Ctlr-h -> this help"
+            )
+        help_dialog.set_title( "Shortcut for TagTree" )
+        help_dialog.show_all()
+
+
+# **********************************************************************************
+
+# **********************************************************************************
+# ************************************************************************** TagData
+# **********************************************************************************
+class TagDataApplication(object):
+    """
+    Basic application for testing TagDataTree.
+
+    With the environment variable PYXI_PROBE set to a file name, the handlers
+    of the TagDataGadget are timed, and the timings printed and written to
+    this file (json) at exit.
+    """
+    # sec --------------------------------------------------------------------- init
+    def __init__(self):
+        # Create a new window
+        self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+
+        self.window.set_title("Basic TreeView Example")
+
+        self.window.set_size_request(200, 600)
+        self.window.connect("delete_event", self.delete_event)
+
+        # Create data by loading file, and its journal
+        tag_store = TagDataTree("data/tag_data.xml")
+        self.journal = TagDataJournal( tag_store, "data/tag_data.xml" )
+
+        probe = None
+        probe_file_name = os.environ.get( 'PYXI_PROBE' )
+        if probe_file_name:
+            probe = TagDataProbe( budget=TagDataGadget.FRAME_BUDGET )
+            atexit.register( self.dump_probe, probe, probe_file_name )
+
+        self.tag_gadget = TagDataGadget( tag_store, probe=probe )
+        self.tag_gadget.show()
+        self.window.add(self.tag_gadget)
+        self.window.show_all()
+
+    def delete_event(self, widget, event, data=None):
+        """
+        Close the window and quit.
+        """
+        self.journal.close()
+        gtk.main_quit()
+        return False
+    def dump_probe(self, probe, probe_file_name):
+        print probe.dump_str()
+        probe.write( probe_file_name )
+# **********************************************************************************
+
+# **********************************************************************************
+# ************************************************************************* TagGLADE
+# **********************************************************************************
+class TagGLADE(object):
+    """
+    """
+
+    # sec --------------------------------------------------------------------- init
+    def __init__(self ):
+        """
+        Read XML UI file and create.
+        """
+        builder = gtk.Builder()
+        builder.add_from_file( "tag_data.glade" )
+
+        self.tag_data_frame = builder.get_object( "tag_data_frame" )
+        self.tag_data_treeview = builder.get_object( "tag_data_treeview" )
+# **********************************************************************************
+            
+
+
+# sec ******************************************************************************
+def main():
+    gtk.main()
+
+def test_gtk():
+    appligtk = TagDataApplication()
+    try:
+        main()
+    except TagData_UnicityWarning:
+        #ask confirmation by dialog
+        dialog = gtk.Dialog('Doublon in Tags', appligth.window.get_toplevel(),
+                            gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                            ("Ok", gtk.RESPONSE_OK))
+        #dialog.vbox.pack_start(gtk.Label('On supprime VRAIMENT tout ça ?'))
+        dialog.show_all()
+        result = dialog.run()
+        dialog.destroy()
+
+
+def test_glade():
+    def cb_destroy(widget, data=None):
+        """
+        Destroy main window, ie: self
+        """
+        gtk.main_quit();
+    
+    # get data
+    tag_data = TagDataTree()
+    tag_data.build_example()
+
+    # Need a high level window
+    main_window = gtk.Window()
+    # Connect destroy event
+    main_window.connect( 'destroy', cb_destroy )
+    
+    # Get UI from glade
+    tag_data_glade = TagGLADE()
+    # connect to our treestore
+    tag_data_mirror = TagDataTreeStore( tag_data )
+    tag_data_glade.tag_data_treeview.set_model( tag_data_mirror.get_model() )
+    main_window.add( tag_data_glade.tag_data_frame )
+    
+    main_window.show_all()
+    gtk.main()
+
+    
+# sec ************************************************************************* MAIN
+if __name__ == "__main__":
+    test_gtk()
+    # test_glade()
+
+
+# sec ************************************************************************** END
+
+# Local Variables:
+# coding:utf-8
+# End:
@@ -91,9 +91,9 @@ class TestComponent(object):
         gtk.main()
 # sec ******************************************************************************
 def test_tagdata():
-    import tag_data
+    import tag_data, tag_data_gtk
     data = tag_data.TagDataTree()
-    comp = tag_data.TagDataGadget( data )
+    comp = tag_data_gtk.TagDataGadget( data )
     app = TestComponent( comp )
     app.run()
 # sec ******************************************************************************